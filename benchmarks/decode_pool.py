@@ -0,0 +1,83 @@
+# Benchmark reads through the process-pool decode service against the
+# threaded path on a synthetic image
+
+# Usage:
+# python decode_pool.py <size_mb> [n_workers] [work_dir]
+
+# Example:
+# python decode_pool.py 2048 16 /share/data/tmp
+#   work_dir should be on the filesystem to test (e.g. NFS/Lustre),
+#   a temporary directory is used by default.
+
+import os
+import sys
+import time
+import shutil
+import tempfile
+from pathlib import Path
+
+import numpy as np
+from zarr.codecs import BloscCodec
+
+import visor
+from visor.decode import DecodePool
+
+def make_synthetic_image(vsr_path, size_mb):
+    src = Path(__file__).parent.parent/'visor'/'tests'/'data'/'VISOR001.vsr'
+    shutil.copytree(src, vsr_path)
+    n_z = max(64, size_mb * 2**20 // (2 * 1024 * 1024) // 64 * 64)
+    img = visor.Image(vsr_path, image_type='raw', image_name='synth', create=True)
+    img.save(None, resolution='0', dtype='uint16', shape=(1, 1, n_z, 1024, 1024),
+             shard_size=(1, 1, 64, 1024, 1024), chunk_size=(1, 1, 16, 256, 256),
+             compressors=BloscCodec(cname='zstd', clevel=5))
+    rng = np.random.default_rng(0)
+    for z0 in range(0, n_z, 64):
+        # smooth background with noise, compresses like microscopy data
+        slab = (rng.normal(400, 30, (64, 1024, 1024)) +
+                np.linspace(0, 200, 1024)[None, None, :]).astype('uint16')
+        img.write(slab[None, None], '0', region=(0, 0, slice(z0, z0 + 64)))
+    return img
+
+def timed(func):
+    t0 = time.time()
+    ret = func()
+    return ret, time.time() - t0
+
+def benchmark_decode(size_mb, n_workers, work_dir):
+    tmp_dir = Path(tempfile.mkdtemp(dir=work_dir))
+    try:
+        img = make_synthetic_image(tmp_dir/'SYNTH.vsr', size_mb)
+        arr = img.load('0')
+        n_bytes = int(np.prod(arr.shape)) * arr.dtype.itemsize
+        print(f'Created {n_bytes/2**20:.0f} MB image {arr.shape} at "{img.path}"')
+
+        threaded, t_threads = timed(lambda: visor.Pipeline().read(arr, max_workers=n_workers))
+        with DecodePool(max_workers=n_workers) as pool:
+            pool.read(img, '0', (0, 0, slice(0, 64)))  # start workers
+            pooled, t_pool = timed(lambda: pool.read(img, '0'))
+            # consume views without assembling, the zero-copy path
+            total, t_views = timed(lambda: sum(int(v.sum(dtype=np.uint64)) for _, v in pool.blocks(img, '0')))
+        assert np.array_equal(threaded, pooled)
+        assert total == int(threaded.sum(dtype=np.uint64))
+
+        print('')
+        print('Summary')
+        print('=======')
+        print(f'  n_workers           = {n_workers}')
+        print(f'  threads             = {n_bytes/2**20/t_threads:.1f} MB/s ({t_threads:.2f} s)')
+        print(f'  process pool        = {n_bytes/2**20/t_pool:.1f} MB/s ({t_pool:.2f} s)')
+        print(f'  process pool, views = {n_bytes/2**20/t_views:.1f} MB/s ({t_views:.2f} s)')
+        print(f'  speedup             = {t_threads/t_pool:.2f}x')
+    finally:
+        shutil.rmtree(tmp_dir)
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        print("Test decode throughput of the process pool against threads")
+        print("Usage: python decode_pool.py <size_mb> [n_workers] [work_dir]")
+        sys.exit(1)
+
+    size_mb = int(sys.argv[1])
+    n_workers = int(sys.argv[2]) if len(sys.argv) > 2 else os.cpu_count()
+    work_dir = sys.argv[3] if len(sys.argv) > 3 else None
+    benchmark_decode(size_mb, n_workers, work_dir)
@@ -10,9 +10,9 @@ import os
 import sys
 import time
 import numpy as np
-import dask
 
-import visor.image as vimg
+import visor
+from visor.compute import lazy
 
 def get_total_size(directory):
     total_size = 0
@@ -24,8 +24,8 @@ def get_total_size(directory):
             n_files += 1
     return (total_size, n_files)
 
-def loop_all_stacks(visor_img, res, func):
-    li = visor_img.list('raw')
+def loop_all_stacks(vsr, res, func):
+    li = vsr.images('raw')
     n_ch_set = [len(it['channels']) for it in li]
     if np.max(n_ch_set) == np.min(n_ch_set):
         n_channels = n_ch_set[0]
@@ -40,42 +40,39 @@ def loop_all_stacks(visor_img, res, func):
         "n_bytes": 0,
     }
     s = []
-    for slice_info in visor_img.list('raw'):
-        slice_path = slice_info['path']
-        slice_ch = slice_info['channels']
-        print(f'-- Slice "{slice_path}".')
-        img = visor_img.read('raw', slice_path, res)
-        for stack_name in img.stack_map:
-            print(f'  -- Stack "{stack_name}".')
-            for ch in img.channel_map:
-                print('    -- ch ', ch)
-                da = img.read(stack=stack_name, channel=ch)
-                # print(da.shape, da.dtype, da.size, da.chunks)
-                stats['n_pixels'] += da.size
-                stats['n_frames'] += da.shape[0]
+    for slice_info in li:
+        slice_name = slice_info['name']
+        print(f'-- Slice "{slice_name}".')
+        img = visor.Image(vsr.path, image_type='raw', image_name=slice_name)
+        arr = img.load(res)
+        for stack in img.attrs['visor']['visor_stacks']:
+            print(f'  -- Stack "{stack["label"]}".')
+            for ch in img.attrs['visor']['channels']:
+                print('    -- ch ', ch['wavelength'])
+                # lazy (1,1,z,y,x) view, evaluated shard by shard through zarrs
+                la = lazy(arr, (stack['index'], ch['index']))
+                stats['n_pixels'] += int(np.prod(la.shape))
+                stats['n_frames'] += la.shape[2]
                 stats['n_stacks'] += 1
-                stats['n_bytes'] += da.nbytes
+                stats['n_bytes'] += int(np.prod(la.shape)) * la.dtype.itemsize
                 if func is not None:
-                    s.append(func(da))
+                    s.append(func(la))
                 else:
                     s.append(None)
-    if func is not None:
-        s = dask.compute(s)[0]
-        #print(type(s[0]))
     return s, stats
 
 def benchmark_reader(visor_img_path, res, bench_mode):
     print(f'Dataset "{visor_img_path}"')
     t0 = time.time()
-    visor_img = vimg.open_vsr(visor_img_path, 'r')
+    vsr = visor.VSR(visor_img_path)
     t1 = time.time()
     print(f'Time Init: {t1-t0:.3f}s')
     if bench_mode == 'full-none':
-        ret, stats = loop_all_stacks(visor_img, res, None)
+        ret, stats = loop_all_stacks(vsr, res, None)
         ans_st = 'None'
     elif bench_mode == 'full-sum':
-        func = lambda da: da.sum()
-        ret, stats = loop_all_stacks(visor_img, res, func)
+        func = lambda la: la.sum()
+        ret, stats = loop_all_stacks(vsr, res, func)
         ans_st = f'sum {np.array(ret).sum()}'
     t2 = time.time()
     img_disk_size, n_files = get_total_size(visor_img_path)
@@ -0,0 +1,98 @@
+# Benchmark the metadata discovery of VSR on a synthetic sample
+
+# Usage:
+# python vsr_discovery.py <n_slices> [work_dir]
+
+# Example:
+# python vsr_discovery.py 5000 /share/data/tmp
+#   work_dir should be on the filesystem to test (e.g. NFS/Lustre),
+#   a temporary directory is used by default.
+
+import sys
+import json
+import time
+import shutil
+import tempfile
+from pathlib import Path
+
+import visor
+
+def make_synthetic_vsr(vsr_path, n_slices):
+    src = Path(__file__).parent.parent/'visor'/'tests'/'data'/'VISOR001.vsr'
+    with open(src/'visor_raw_images'/'slice_1_10x.zarr'/'zarr.json') as f:
+        meta = json.load(f)
+
+    visor.VSR(vsr_path, create=True)
+    selected = []
+    for t in ['raw', 'compr']:
+        type_path = vsr_path/f'visor_{t}_images'
+        type_path.mkdir(exist_ok=True)
+        for i in range(n_slices):
+            name = f'slice_{i}_10x'
+            (type_path/f'{name}.zarr').mkdir()
+            with open(type_path/f'{name}.zarr'/'zarr.json', 'w') as f:
+                json.dump(meta, f)
+            if 'raw' == t:
+                selected.append({'name': name, 'channels': ['488', '561']})
+    with open(vsr_path/'visor_raw_images'/'selected.json', 'w') as f:
+        json.dump(selected, f)
+
+def legacy_images(vsr_path):
+    # sequential glob/iterdir/open, as visor-py did before the discovery layer
+    images = {}
+    for d in vsr_path.glob('visor_*_images'):
+        t = d.name.split('_')[1]
+        if 'raw' == t:
+            with open(d/'selected.json') as sf:
+                images['raw'] = json.load(sf)
+            for i in images['raw']:
+                with open(d/f"{i['name']}.zarr"/'zarr.json') as mf:
+                    i['meta'] = json.load(mf)
+        else:
+            images[t] = []
+            for s in d.iterdir():
+                if s.suffix == '.zarr':
+                    with open(s/'zarr.json') as mf:
+                        channels = json.load(mf)
+                    with open(s/'zarr.json') as mf:
+                        resolutions = json.load(mf)
+                    images[t].append((channels, resolutions))
+    return images
+
+def benchmark_discovery(n_slices, work_dir):
+    tmp_dir = Path(tempfile.mkdtemp(dir=work_dir))
+    vsr_path = tmp_dir/'SYNTH.vsr'
+    try:
+        t0 = time.time()
+        make_synthetic_vsr(vsr_path, n_slices)
+        t1 = time.time()
+        print(f'Created {2*n_slices} images in {t1-t0:.2f}s at "{vsr_path}"')
+
+        t0 = time.time()
+        legacy_images(vsr_path)
+        t_legacy = time.time() - t0
+
+        t0 = time.time()
+        images = visor.VSR(vsr_path).images()
+        t_scandir = time.time() - t0
+        n_images = sum(len(v) for v in images.values())
+
+        print('')
+        print('Summary')
+        print('=======')
+        print(f'  n_images        = {n_images}')
+        print(f'  legacy          = {t_legacy:.3f} s')
+        print(f'  scandir+threads = {t_scandir:.3f} s')
+        print(f'  speedup         = {t_legacy/t_scandir:.2f}x')
+    finally:
+        shutil.rmtree(tmp_dir)
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        print("Test metadata discovery speed of VSR")
+        print("Usage: python vsr_discovery.py <n_slices> [work_dir]")
+        sys.exit(1)
+
+    n_slices = int(sys.argv[1])
+    work_dir = sys.argv[2] if len(sys.argv) > 2 else None
+    benchmark_discovery(n_slices, work_dir)
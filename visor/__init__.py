@@ -1,11 +1,18 @@
 from .vsr import VSR
 from .image import Image
 from .roi import ROI
-from .transform import Transform
+from .transform import Transform, AffineTable
+from .pipeline import Pipeline
+from .label import LabelImage
+from .memory import config
 
 __all__ = [
   'VSR',
   'Image',
   'ROI',
   'Transform',
+  'AffineTable',
+  'Pipeline',
+  'LabelImage',
+  'config',
 ]
\ No newline at end of file
@@ -0,0 +1,447 @@
+from pathlib import Path
+import contextlib
+import hashlib
+import json
+import math
+import threading
+import time
+import numpy
+import zarr
+from .memory import config
+from .pipeline import PipelineArray
+from .plan import AMPLIFICATION, AXES
+from .shard import normalize_region, shard_key
+
+# Share of the reads of an image at a scale worth precomputing a level
+LEVEL_SHARE = 0.1
+# Bytes of a typical read above which a coarser level is suggested
+LARGE_READ = 64 * 2**20
+# Reads touching more shards than this on average suggest larger shards
+SHARDS_PER_READ = 2.0
+
+_lock = threading.Lock()
+# Arrays described in each log by this process
+_described = {}
+
+
+def log_path():
+    """
+    Get the access log being recorded to, from visor.config 'access.log'
+
+    Returns:
+        Path, or None if not recording
+    """
+    path = config.get('access.log', None)
+    return Path(path) if path else None
+
+
+@contextlib.contextmanager
+def record(path:str|Path):
+    """
+    Record selections of Image.load arrays and ROI.load into an access
+    log within a with block, like visor.config.set({'access.log': path})
+    or environment variable VISOR_ACCESS__LOG=path
+
+    Parameters:
+        path: local file, appended to
+    """
+    with config.set({'access.log': str(path)}):
+        yield Path(path)
+
+
+def _array_id(image, resolution:str):
+    """
+    Private function to get a short id of an array in a log
+    """
+    return hashlib.sha1(f'{image.storage.url}|{image.key}|{resolution}'.encode()).hexdigest()[:12]
+
+
+def _level_scale(image, resolution:str):
+    """
+    Private function to get the scale of a level relative to the
+    multiscale, None if not described
+    """
+    datasets = image.attrs.get('ome', {}).get('multiscales', [{}])[0].get('datasets', [])
+    for d in datasets:
+        if d['path'] == resolution:
+            return d['coordinateTransformations'][0]['scale']
+    return None
+
+
+def _region(selection, shape:tuple):
+    """
+    Private function to get the bounds of a basic selection, None for
+    other selections (e.g. index arrays or steps)
+    """
+    if selection is Ellipsis:
+        selection = None
+    elif isinstance(selection, tuple) and Ellipsis in selection:
+        i = selection.index(Ellipsis)
+        selection = selection[:i] + (slice(None),) * (len(shape) - len(selection) + 1) + selection[i+1:]
+    try:
+        return [[r.start, r.stop] for r in normalize_region(selection, shape)]
+    except (TypeError, ValueError, IndexError):
+        return None
+
+
+def log_selection(image, resolution:str, arr, selection, seconds:float, factors:tuple=None):
+    """
+    Append a selection to the access log, if recording
+
+    Parameters:
+        image:      visor.Image
+        resolution: resolution level
+        arr:        zarr.Array read from
+        selection:  selection in array coordinates
+        seconds:    latency of the read
+        factors:    binning factors of a pipeline applied while reading
+    """
+    path = log_path()
+    if path is None:
+        return
+    resolution = str(resolution)
+    aid = _array_id(image, resolution)
+    entry = {'a': aid, 't': round(time.time(), 3), 's': _region(selection, arr.shape),
+             'ms': round(seconds * 1e3, 3)}
+    if factors is not None and any(f != 1 for f in factors):
+        entry['b'] = list(factors)
+    with _lock:
+        described = _described.setdefault(str(path), set())
+        if not path.exists():
+            described.clear()
+        lines = []
+        if aid not in described:
+            lines.append({'a': aid, 'url': image.storage.url, 'key': image.key, 'res': resolution,
+                          'shape': list(arr.shape), 'shards': list(arr.shards or arr.chunks),
+                          'chunks': list(arr.chunks), 'dtype': arr.dtype.str,
+                          'scale': _level_scale(image, resolution)})
+            described.add(aid)
+        lines.append(entry)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        # one append per selection, lines of concurrent processes do not interleave
+        with open(path, 'a') as f:
+            f.write(''.join(json.dumps(l, separators=(',', ':')) + '\n' for l in lines))
+
+
+class RecordedArray(zarr.Array):
+
+    def __init__(self, arr, image, resolution:str):
+        """
+        Constructor of RecordedArray, a zarr.Array from Image.load logging
+        the selections read from it to the access log while recording
+
+        Parameters:
+            arr:        zarr.Array
+            image:      visor.Image
+            resolution: resolution level
+        """
+        super().__init__(arr._async_array)
+        self.image = image
+        self.resolution = str(resolution)
+
+
+    @property
+    def array(self):
+        """
+        The zarr.Array behind, reading without logging
+        """
+        return zarr.Array(self._async_array)
+
+
+    def _read(self, read, selection):
+        t0 = time.perf_counter()
+        out = read()
+        log_selection(self.image, self.resolution, self, selection, time.perf_counter() - t0)
+        return out
+
+
+    def get_basic_selection(self, selection=Ellipsis, **kwargs):
+        return self._read(lambda: super(RecordedArray, self).get_basic_selection(selection, **kwargs),
+                          selection)
+
+
+    def get_orthogonal_selection(self, selection, **kwargs):
+        return self._read(lambda: super(RecordedArray, self).get_orthogonal_selection(selection, **kwargs),
+                          selection)
+
+
+    def get_coordinate_selection(self, selection, **kwargs):
+        return self._read(lambda: super(RecordedArray, self).get_coordinate_selection(selection, **kwargs),
+                          selection)
+
+
+    def get_mask_selection(self, selection, **kwargs):
+        return self._read(lambda: super(RecordedArray, self).get_mask_selection(selection, **kwargs),
+                          selection)
+
+
+class RecordedPipelineArray(PipelineArray):
+
+    def __init__(self, arr, pipeline, image, resolution:str):
+        """
+        Constructor of RecordedPipelineArray, a PipelineArray from
+        Image.load logging the source regions it reads with the binning
+        factors of its pipeline while recording
+
+        Parameters:
+            arr:        zarr.Array
+            pipeline:   visor.Pipeline
+            image:      visor.Image
+            resolution: resolution level
+        """
+        super().__init__(arr, pipeline)
+        self.image = image
+        self.resolution = str(resolution)
+
+
+    def __getitem__(self, region):
+        t0 = time.perf_counter()
+        out = super().__getitem__(region)
+        log_selection(self.image, self.resolution, self.array,
+                      self.source_region(region if isinstance(region, tuple) else (region,)),
+                      time.perf_counter() - t0, self.pipeline.factors(self.ndim))
+        return out
+
+
+def unwrap(arr):
+    """
+    Get an array of Image.load not logging its reads, for reads logged by
+    the caller
+
+    Returns:
+        zarr.Array or visor.pipeline.PipelineArray
+    """
+    if isinstance(arr, RecordedArray):
+        return arr.array
+    if isinstance(arr, RecordedPipelineArray):
+        return PipelineArray(arr.array, arr.pipeline)
+    return arr
+
+
+def read_log(paths:str|Path|list):
+    """
+    Read access logs
+
+    Parameters:
+        paths: log file, directory of log files, or list of them
+
+    Returns:
+        (dict of array id to description, list of selections)
+    """
+    if not isinstance(paths, (list, tuple)):
+        paths = [paths]
+    files = []
+    for p in map(Path, paths):
+        files += sorted(f for f in p.iterdir() if f.is_file()) if p.is_dir() else [p]
+    arrays, selections = {}, []
+    for f in files:
+        with open(f) as lines:
+            for line in lines:
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    continue  # torn last line of a crashed writer
+                if 'url' in entry:
+                    arrays[entry['a']] = entry
+                else:
+                    selections.append(entry)
+    return arrays, selections
+
+
+def analyze(paths:str|Path|list, top:int=20):
+    """
+    Analyze access logs: reads per array, heatmaps over shard grids, hot
+    shards to warm caches with, and recommendations on shard and chunk
+    shapes and on pyramid levels worth precomputing
+
+    Parameters:
+        paths: log file, directory of log files, or list of them
+        top:   number of hot shards per array
+
+    Returns:
+        dict with 'arrays', a list of per array reports sorted by reads,
+        each with url, key, resolution, shape, shard and chunk shapes,
+        n_reads, requested_bytes, seconds, latency_ms percentiles,
+        read_shape (median) and read_shape_p90, shards_per_read,
+        amplification (decoded over requested bytes), 'heatmap' of
+        reads per shard over the shard grid, 'hot_shards', 'recommended'
+        shapes and 'suggestions'; and 'levels', suggestions of pyramid
+        levels per image
+    """
+    arrays, selections = read_log(paths)
+    by_array = {}
+    for s in selections:
+        if s['a'] in arrays:
+            by_array.setdefault(s['a'], []).append(s)
+    reports = [_analyze_array(arrays[a], sel, top) for a, sel in by_array.items()]
+    reports.sort(key=lambda r: -r['n_reads'])
+    return {'arrays': reports, 'levels': _levels(arrays, by_array)}
+
+
+def _analyze_array(meta:dict, selections:list, top:int):
+    """
+    Private function to analyze the selections of an array
+    """
+    shape = numpy.array(meta['shape'])
+    shards = numpy.array(meta['shards'])
+    chunks = numpy.array(meta['chunks'])
+    itemsize = numpy.dtype(meta['dtype']).itemsize
+    ms = numpy.array([s['ms'] for s in selections])
+    regions = numpy.array([s['s'] for s in selections if s['s'] is not None],
+                          dtype=numpy.int64).reshape(-1, len(shape), 2)
+    extents = regions[..., 1] - regions[..., 0]
+    regions = regions[(extents > 0).all(axis=1)]
+    extents = regions[..., 1] - regions[..., 0]
+
+    grid = tuple(-(-shape // shards))
+    heatmap = numpy.zeros(grid, dtype=numpy.int64)
+    lo, hi = regions[..., 0] // shards, (regions[..., 1] - 1) // shards + 1
+    for a, b in zip(lo, hi):
+        heatmap[tuple(slice(i, j) for i, j in zip(a, b))] += 1
+    # bytes decoded at chunk granularity over bytes requested
+    decoded = numpy.prod((regions[..., 1] - 1) // chunks - regions[..., 0] // chunks + 1, axis=1) * \
+        numpy.prod(chunks)
+    requested = numpy.prod(extents, axis=1)
+    hot = numpy.argsort(heatmap, axis=None, kind='stable')[::-1][:top]
+    report = {
+        'url':             meta['url'],
+        'key':             meta['key'],
+        'resolution':      meta['res'],
+        'shape':           tuple(meta['shape']),
+        'shard_shape':     tuple(meta['shards']),
+        'chunk_shape':     tuple(meta['chunks']),
+        'n_reads':         len(selections),
+        'requested_bytes': int(requested.sum()) * itemsize,
+        'seconds':         float(ms.sum()) / 1e3,
+        'latency_ms':      {f'p{q}': float(numpy.percentile(ms, q)) for q in (50, 95, 100)},
+        'read_shape':      None,
+        'read_shape_p90':  None,
+        'shards_per_read': float(numpy.prod(hi - lo, axis=1).mean()) if len(regions) else 0.0,
+        'amplification':   float(decoded.sum() / requested.sum()) if len(regions) else 0.0,
+        'heatmap':         heatmap,
+        'hot_shards':      [{'shard': s, 'key': shard_key(s), 'n_reads': int(heatmap[s])}
+                            for s in (tuple(int(i) for i in numpy.unravel_index(h, grid)) for h in hot)
+                            if heatmap[s] > 0],
+        'recommended':     None,
+        'suggestions':     [],
+    }
+    if len(regions):
+        report['read_shape'] = tuple(int(n) for n in numpy.median(extents, axis=0))
+        report['read_shape_p90'] = tuple(int(n) for n in numpy.percentile(extents, 90, axis=0))
+        report['recommended'] = _recommend(report)
+        report['suggestions'] = _suggest(report)
+    return report
+
+
+def _pow2(n:int):
+    return 1 << max(0, math.ceil(math.log2(max(n, 1))))
+
+
+def _recommend(report:dict):
+    """
+    Private function to recommend chunk and shard shapes for the reads
+    of an array: chunks of the typical read, shards holding 90% of reads
+    """
+    chunks = tuple(min(_pow2(r), n) for r, n in zip(report['read_shape'], report['shape']))
+    # at least the current shard, rounded to chunks, at most the array
+    shards = tuple(min(max(c * _pow2(-(-p // c)), -(-s // c) * c), -(-n // c) * c)
+                   for c, p, s, n in zip(chunks, report['read_shape_p90'], report['shard_shape'],
+                                         report['shape']))
+    return {'chunk_shape': chunks, 'shard_shape': shards}
+
+
+def _suggest(report:dict):
+    """
+    Private function to suggest layout changes of an array
+    """
+    suggestions = []
+    rec = report['recommended']
+    if report['amplification'] > AMPLIFICATION and rec['chunk_shape'] != report['chunk_shape']:
+        thin = ', '.join(f'{a}={r}' for a, r, c in zip(AXES, report['read_shape'], report['chunk_shape'])
+                         if r < c)
+        suggestions.append(
+            f"Reads decode {report['amplification']:.1f}x the requested bytes, typical reads "
+            f"({thin}) are thinner than chunks {report['chunk_shape']}: chunks of "
+            f"{rec['chunk_shape']} fit them, see visor.tune.rechunk.")
+    if report['shards_per_read'] > SHARDS_PER_READ and rec['shard_shape'] != report['shard_shape']:
+        suggestions.append(
+            f"Reads touch {report['shards_per_read']:.1f} shards on average: shards of "
+            f"{rec['shard_shape']} hold 90% of reads in one along each axis.")
+    hot = sum(s['n_reads'] for s in report['hot_shards'])
+    total = int(report['heatmap'].sum())
+    if total and len(report['hot_shards']) < report['heatmap'].size and hot >= total / 2:
+        suggestions.append(
+            f"{len(report['hot_shards'])} of {report['heatmap'].size} shards take "
+            f"{hot / total:.0%} of shard reads, warm caches with report['hot_shards'].")
+    return suggestions
+
+
+def _levels(arrays:dict, by_array:dict):
+    """
+    Private function to suggest pyramid levels worth precomputing, from
+    the scales reads are binned to by pipelines and from large reads
+    """
+    images = {}
+    for a, meta in arrays.items():
+        images.setdefault((meta['url'], meta['key']), []).append(meta)
+    suggestions = {}
+    for (url, key), metas in images.items():
+        # levels without multiscale metadata count as scale 1
+        scales = {m['a']: m['scale'] or [1.0] * len(m['shape']) for m in metas}
+        existing = {tuple(float(s) for s in scales[m['a']][2:]) for m in metas}
+        reads = [(m, s) for m in metas for s in by_array.get(m['a'], [])]
+        if not reads:
+            continue
+        counts = {}
+        for m, s in reads:
+            f = s.get('b', [1] * len(m['shape']))
+            scale = tuple(float(a * b) for a, b in zip(scales[m['a']][2:], f[2:]))
+            if scale in existing:
+                continue
+            counts.setdefault(scale, [0, m['res'], tuple(f[2:])])[0] += 1
+        out = []
+        for scale, (n, res, f) in sorted(counts.items(), key=lambda c: -c[1][0]):
+            if n >= LEVEL_SHARE * len(reads):
+                out.append(f"{n} of {len(reads)} reads bin resolution {res} by "
+                           f"{'x'.join(str(b) for b in f)} (z,y,x): precompute a level at scale "
+                           f"{'x'.join(f'{v:g}' for v in scale)} to read it directly.")
+        for m in metas:
+            sel = [s for s in by_array.get(m['a'], []) if s['s'] is not None]
+            if len(sel) < LEVEL_SHARE * len(reads) or not sel:
+                continue
+            nbytes = numpy.median([math.prod(b - a for a, b in s['s']) for s in sel]) * \
+                numpy.dtype(m['dtype']).itemsize
+            if nbytes > LARGE_READ:
+                f = _pow2(math.ceil(math.sqrt(nbytes / LARGE_READ)))
+                out.append(f"Typical reads of resolution {m['res']} are {nbytes / 2**20:.0f} MiB: "
+                           f"a level downsampled {f}x along y and x keeps them under "
+                           f"{LARGE_READ // 2**20} MiB.")
+        if out:
+            suggestions[f'{url}/{key}'] = out
+    return suggestions
+
+
+def explain(report:dict):
+    """
+    Format an access analysis for humans
+
+    Returns:
+        str
+    """
+    lines = []
+    for r in report['arrays']:
+        lines += [
+            f"{r['key']}/{r['resolution']}: {r['n_reads']} reads, "
+            f"{r['requested_bytes'] / 2**20:.1f} MiB in {r['seconds']:.2f} s, "
+            f"latency p50 {r['latency_ms']['p50']:.1f} ms p95 {r['latency_ms']['p95']:.1f} ms",
+            f"  typical read {r['read_shape']}, p90 {r['read_shape_p90']}, "
+            f"{r['shards_per_read']:.1f} shards per read, amplification {r['amplification']:.2f}x",
+            f"  shards {r['shard_shape']}, chunks {r['chunk_shape']}, "
+            f"recommended {r['recommended']}",
+        ]
+        lines += [f"  hot shard {s['key']}: {s['n_reads']} reads" for s in r['hot_shards'][:5]]
+        lines += [f'  suggestion: {s}' for s in r['suggestions']]
+    for image, suggestions in report['levels'].items():
+        lines.append(f'{image}:')
+        lines += [f'  suggestion: {s}' for s in suggestions]
+    return '\n'.join(lines)
@@ -0,0 +1,199 @@
+from concurrent.futures import ThreadPoolExecutor
+import json
+import threading
+import numpy
+from .lock import FileLock, lock_dir, write_atomic
+from .memory import budget
+from .consolidate import sync_image
+
+class Appender:
+
+    def __init__(self, image, resolution:str, stack:int, channel:int,
+                 start:int=0, lock:bool=False, max_pending:int=2):
+        """
+        Constructor of Appender, appends z-frames of one stack and channel
+        to an existing zarr array, growing its z extent on the fly
+
+        Frames are buffered up to the shard boundary along z, full shards
+        are compressed and written on a background thread. Buffers are
+        held against the memory budget, append() blocks while it is full.
+
+        Parameters:
+            image:       visor.Image
+            resolution:  resolution level, see vsr.images()
+            stack:       visor_stack index
+            channel:     channel index
+            start:       z index of the first frame
+            lock:        lock shards while writing, required when shards
+                         span several stacks or channels being appended
+            max_pending: maximum number of shards waiting to be written,
+                         append() blocks when reached
+        """
+        self.image = image
+        self.resolution = str(resolution)
+        self.stack = stack
+        self.channel = channel
+        self.lock = lock
+
+        arr = image.load(self.resolution)
+        if arr.ndim != 5:
+            raise ValueError(f'Appending requires a 5-dimensional array, got {arr.ndim}.')
+        self.frame_shape = tuple(arr.shape[3:])
+        self.dtype = arr.dtype
+        self.shard_z = (arr.shards or arr.chunks)[2]
+        if start % self.shard_z:
+            raise ValueError(f'Start {start} is not aligned to shard size {self.shard_z} along z.')
+
+        self.z = start            # z index of the next frame
+        self._flushed = start     # z index of the first buffered frame
+        self._buf = self._new_buffer()
+        self._n_buf = 0
+        self._pool = ThreadPoolExecutor(max_workers=1)
+        self._slots = threading.BoundedSemaphore(max_pending)
+        self._futures = []
+        self._closed = False
+
+
+    def _new_buffer(self):
+        shape = (self.shard_z,) + self.frame_shape
+        budget.acquire(numpy.prod(shape) * self.dtype.itemsize)
+        return numpy.empty(shape, dtype=self.dtype)
+
+
+    def append(self, frames:numpy.ndarray):
+        """
+        Append a frame (y,x) or a slab of frames (z,y,x)
+
+        Parameters:
+            frames: numpy.ndarray
+        """
+        if self._closed:
+            raise ValueError('Appender is closed.')
+        self._check_errors()
+        frames = numpy.asarray(frames)
+        if frames.ndim == 2:
+            frames = frames[None]
+        if frames.ndim != 3 or tuple(frames.shape[1:]) != self.frame_shape:
+            raise ValueError(f'Frames of shape {frames.shape} do not match frame shape {self.frame_shape}.')
+
+        i = 0
+        while i < len(frames):
+            n = min(len(frames) - i, self.shard_z - self._n_buf)
+            self._buf[self._n_buf:self._n_buf+n] = frames[i:i+n]
+            self._n_buf += n
+            self.z += n
+            i += n
+            if self._n_buf == self.shard_z:
+                self._submit()
+
+
+    def _submit(self):
+        """
+        Private method to hand the buffer over to the background writer
+        """
+        if 0 == self._n_buf:
+            return
+        buf, n, z0 = self._buf, self._n_buf, self._flushed
+        self._slots.acquire()
+        try:
+            self._futures.append(self._pool.submit(self._write, buf, n, z0))
+        except BaseException:
+            self._slots.release()
+            raise
+        self._flushed += n
+        self._buf = self._new_buffer()
+        self._n_buf = 0
+
+
+    def _write(self, buf:numpy.ndarray, n:int, z0:int):
+        """
+        Private method to grow the array and write buffered frames
+        """
+        try:
+            self._grow(z0 + n)
+            self.image.write(
+                buf[None, None, :n],
+                self.resolution,
+                region=(self.stack, self.channel, slice(z0, z0 + n)),
+                lock=self.lock,
+            )
+        finally:
+            budget.release(buf.nbytes)
+            self._slots.release()
+
+
+    def _grow(self, z_stop:int):
+        """
+        Private method to grow the z extent of the array to at least z_stop
+
+        The array metadata is updated under a file lock and replaced
+        atomically, it never shrinks, so appenders of other stacks or
+        channels may grow the same array concurrently. Consolidated
+        metadata is refreshed after growing.
+        """
+        if self.image.load(self.resolution).shape[2] >= z_stop:
+            return
+        meta_file = self.image.path/self.resolution/'zarr.json'
+        with FileLock(lock_dir(self.image.path)/self.resolution/'zarr.json.lock'):
+            with open(meta_file) as mf:
+                meta = json.load(mf)
+            grown = meta['shape'][2] < z_stop
+            if grown:
+                meta['shape'][2] = z_stop
+                write_atomic(meta_file, json.dumps(meta, indent=2))
+        if grown:
+            sync_image(self.image.storage, self.image.key)
+        self.image.zgroup = self.image._open_group()
+
+
+    def _check_errors(self):
+        """
+        Private method to re-raise errors of finished background writes
+        """
+        pending = []
+        for f in self._futures:
+            if f.done():
+                f.result()
+            else:
+                pending.append(f)
+        self._futures = pending
+
+
+    def flush(self):
+        """
+        Write all buffered frames and wait until they are on disk
+
+        A partial shard is written as is, and rewritten when more frames
+        arrive, so flush only at the end or when needed.
+        """
+        if self._n_buf:
+            buf, n, z0 = self._buf, self._n_buf, self._flushed
+            self._slots.acquire()
+            budget.acquire(buf.nbytes)
+            self._futures.append(self._pool.submit(self._write, buf.copy(), n, z0))
+        for f in self._futures:
+            f.result()
+        self._futures = []
+
+
+    def close(self):
+        """
+        Flush and stop the background writer
+        """
+        if self._closed:
+            return
+        try:
+            self.flush()
+        finally:
+            self._closed = True
+            self._pool.shutdown()
+            budget.release(self._buf.nbytes)
+            self._buf = None
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, *exc):
+        self.close()
@@ -0,0 +1,398 @@
+from collections import OrderedDict, deque
+from concurrent.futures import Future, ThreadPoolExecutor
+import itertools
+import math
+import threading
+import numpy
+from .memory import budget
+from .plan import locality_ids
+from .shard import is_shard_aligned
+
+BOUNDARIES = (None, 'reflect', 'edge', 'constant')
+
+
+class Block:
+
+    def __init__(self, index:tuple, stack:int, channel:int, core:tuple, inner:tuple, data:numpy.ndarray):
+        """
+        Constructor of Block, a core region of an array with its halo
+
+        Parameters:
+            index:   (z,y,x) block index
+            stack:   visor_stack index
+            channel: channel index
+            core:    (z,y,x) slices of the core in the array
+            inner:   (z,y,x) slices of the core in data
+            data:    numpy.ndarray (z,y,x) of the core and its halo
+        """
+        self.index = index
+        self.stack = stack
+        self.channel = channel
+        self.core = core
+        self.inner = inner
+        self.data = data
+
+
+    def crop(self, data:numpy.ndarray=None):
+        """
+        Drop the halo
+
+        Parameters:
+            data: result computed on self.data, of the same shape,
+                  default self.data
+
+        Returns:
+            numpy.ndarray of the core
+        """
+        data = self.data if data is None else data
+        if data.shape != self.data.shape:
+            raise ValueError(f'Shape {data.shape} does not match block shape {self.data.shape}.')
+        return data[self.inner]
+
+
+class ChunkCache:
+
+    def __init__(self, arr, stack:int, channel:int, max_chunks:int=256):
+        """
+        Constructor of ChunkCache, an LRU cache of decoded (z,y,x) chunks of
+        a stack and channel, concurrent requests of a chunk decode it once
+
+        Cached chunks are held against the memory budget, when it is full
+        the least recently used chunks are evicted, or the chunk is not
+        cached.
+
+        Parameters:
+            arr:        zarr.Array (vs,ch,z,y,x)
+            stack:      visor_stack index
+            channel:    channel index
+            max_chunks: maximum number of cached chunks
+        """
+        self.arr = arr
+        self.stack = stack
+        self.channel = channel
+        self.chunk_shape = tuple(arr.chunks[2:])
+        self.max_chunks = max_chunks
+        self.n_decoded = 0
+        self.n_hits = 0
+        self._cache = OrderedDict()
+        self._pending = {}
+        self._lock = threading.Lock()
+
+
+    def region(self, index:tuple):
+        """
+        Get (z,y,x) region of a chunk, clipped to array shape
+        """
+        return tuple(slice(i * c, min((i + 1) * c, n))
+                     for i, c, n in zip(index, self.chunk_shape, self.arr.shape[2:]))
+
+
+    def get(self, index:tuple):
+        """
+        Get a decoded chunk, from cache if available
+
+        Parameters:
+            index: (z,y,x) chunk index
+
+        Returns:
+            numpy.ndarray
+        """
+        index = tuple(index)
+        with self._lock:
+            if index in self._cache:
+                self._cache.move_to_end(index)
+                self.n_hits += 1
+                return self._cache[index]
+            future = self._pending.get(index)
+            owner = future is None
+            if owner:
+                future = self._pending[index] = Future()
+            else:
+                self.n_hits += 1
+        if not owner:
+            return future.result()
+
+        try:
+            chunk = self.arr[(self.stack, self.channel) + self.region(index)]
+        except BaseException as e:
+            with self._lock:
+                del self._pending[index]
+            future.set_exception(e)
+            raise
+        with self._lock:
+            del self._pending[index]
+            self.n_decoded += 1
+            self._insert(index, chunk)
+        future.set_result(chunk)
+        return chunk
+
+
+    def _insert(self, index:tuple, chunk:numpy.ndarray):
+        """
+        Private method to cache a chunk, called with the lock held
+        """
+        if self.max_chunks < 1:
+            return
+        while len(self._cache) >= self.max_chunks:
+            budget.release(self._cache.popitem(last=False)[1].nbytes)
+        while not budget.try_acquire(chunk.nbytes):
+            if not self._cache:
+                return
+            budget.release(self._cache.popitem(last=False)[1].nbytes)
+        self._cache[index] = chunk
+
+
+    def clear(self):
+        """
+        Drop all cached chunks and return their memory to the budget
+        """
+        with self._lock:
+            while self._cache:
+                budget.release(self._cache.popitem()[1].nbytes)
+
+
+class BlockIterator:
+
+    def __init__(self, arr, block_shape:tuple, halo:int|tuple, stack:int, channel:int,
+                 boundary:str|None='reflect', cval=0, prefetch:int=4,
+                 cache_chunks:int=256, max_workers:int=None):
+        """
+        Constructor of BlockIterator, iterating shard-aligned (z,y,x) core
+        blocks of a stack and channel, each with a halo of neighbouring
+        voxels for neighbourhood filters
+
+        Blocks are assembled from decoded chunks kept in a ChunkCache, so
+        halos overlapping neighbouring blocks are served from chunks
+        decoded for them instead of being read again. Blocks are visited
+        in C order and the next prefetch blocks are assembled in parallel.
+        Blocks in flight are held against the memory budget.
+
+        Parameters:
+            arr:          zarr.Array (vs,ch,z,y,x)
+            block_shape:  (z,y,x) core shape, multiple of the shard shape,
+                          None for the shard shape
+            halo:         voxels added on each side, int or (z,y,x)
+            stack:        visor_stack index
+            channel:      channel index
+            boundary:     fill of the halo outside the array, 'reflect',
+                          'edge' or 'constant' (cval), None to clip it so
+                          edge blocks have a smaller halo
+            cval:         value of 'constant' boundary
+            prefetch:     number of blocks assembled ahead
+            cache_chunks: maximum number of cached chunks
+            max_workers:  number of threads
+        """
+        if arr.ndim != 5:
+            raise ValueError(f'Block iteration requires a 5-dimensional array, got {arr.ndim}.')
+        if boundary not in BOUNDARIES:
+            raise ValueError(f'Invalid boundary {boundary}. Must be one of {BOUNDARIES}')
+        shards = tuple((arr.shards or arr.chunks)[2:])
+        block_shape = shards if block_shape is None else tuple(int(b) for b in block_shape)
+        if len(block_shape) != 3 or any(b < 1 or b % s for b, s in zip(block_shape, shards)):
+            raise ValueError(f'Block shape {block_shape} must be a multiple of shard shape {shards}.')
+        halo = (int(halo),) * 3 if numpy.isscalar(halo) else tuple(int(h) for h in halo)
+        if len(halo) != 3 or any(h < 0 for h in halo):
+            raise ValueError(f'Invalid halo {halo}. Must be a non-negative int or (z,y,x).')
+
+        self.arr = arr
+        self.shape = tuple(arr.shape[2:])
+        self.block_shape = block_shape
+        self.halo = halo
+        self.stack = stack
+        self.channel = channel
+        self.boundary = boundary
+        self.cval = cval
+        self.prefetch = max(1, prefetch)
+        self.max_workers = max_workers
+        self.grid = tuple(math.ceil(n / b) for n, b in zip(self.shape, block_shape))
+        self.cache = ChunkCache(arr, stack, channel, max_chunks=cache_chunks)
+
+
+    def __len__(self):
+        return int(numpy.prod(self.grid))
+
+
+    def __iter__(self):
+        indices = iter(itertools.product(*map(range, self.grid)))
+        pending = deque()
+        with ThreadPoolExecutor(max_workers=self.max_workers) as pool:
+            try:
+                for index in itertools.islice(indices, self.prefetch):
+                    pending.append(pool.submit(self.block, index))
+                while pending:
+                    block = pending.popleft().result()
+                    for index in itertools.islice(indices, 1):
+                        pending.append(pool.submit(self.block, index))
+                    try:
+                        yield block
+                    finally:
+                        budget.release(block.data.nbytes)
+            finally:
+                for f in pending:
+                    if not f.cancel() and f.exception() is None:
+                        budget.release(f.result().data.nbytes)
+                self.cache.clear()
+
+
+    def block(self, index:tuple):
+        """
+        Assemble a block with its halo, the bytes of its data are acquired
+        from the memory budget and released by the iterator
+
+        Parameters:
+            index: (z,y,x) block index
+
+        Returns:
+            visor.blocks.Block
+        """
+        core = tuple(slice(i * b, min((i + 1) * b, n))
+                     for i, b, n in zip(index, self.block_shape, self.shape))
+        # region to read, clipped to the array, and padding outside of it
+        read = tuple(slice(max(0, c.start - h), min(n, c.stop + h))
+                     for c, h, n in zip(core, self.halo, self.shape))
+        pad = [(r.start - (c.start - h), (c.stop + h) - r.stop) if self.boundary else (0, 0)
+               for r, c, h in zip(read, core, self.halo)]
+        shape = tuple(r.stop - r.start + a + b for r, (a, b) in zip(read, pad))
+        dtype = self.arr.dtype
+
+        budget.acquire(numpy.prod(shape) * dtype.itemsize)
+        try:
+            data = self._read(read)
+            if any(a or b for a, b in pad):
+                kwargs = {'constant_values': self.cval} if 'constant' == self.boundary else {}
+                data = numpy.pad(data, pad, mode=self.boundary, **kwargs)
+        except BaseException:
+            budget.release(numpy.prod(shape) * dtype.itemsize)
+            raise
+        inner = tuple(slice(c.start - r.start + a, c.stop - r.start + a)
+                      for c, r, (a, _) in zip(core, read, pad))
+        return Block(tuple(index), self.stack, self.channel, core, inner, data)
+
+
+    def _read(self, region:tuple):
+        """
+        Private method to assemble a (z,y,x) region from cached chunks
+        """
+        out = numpy.empty(tuple(r.stop - r.start for r in region), dtype=self.arr.dtype)
+        chunks = self.cache.chunk_shape
+        ranges = [range(r.start // c, (r.stop - 1) // c + 1) for r, c in zip(region, chunks)]
+        indices = list(itertools.product(*ranges))
+        # shard by shard, in storage order within a shard
+        ids = locality_ids(indices, chunks, (self.arr.shards or self.arr.chunks)[2:], self.shape)
+        for index in (indices[i] for i in numpy.argsort(ids, kind='stable')):
+            chunk = self.cache.get(index)
+            src, dst = [], []
+            for i, r, c in zip(index, region, chunks):
+                lo, hi = max(r.start, i * c), min(r.stop, (i + 1) * c)
+                src.append(slice(lo - i * c, hi - i * c))
+                dst.append(slice(lo - r.start, hi - r.start))
+            out[tuple(dst)] = chunk[tuple(src)]
+        return out
+
+
+class BlockWriter:
+
+    def __init__(self, image, resolution:str, max_pending:int=4, max_workers:int=None):
+        """
+        Constructor of BlockWriter, writing the cores of blocks into an
+        existing array of the same (z,y,x) shape, on background threads
+
+        Cores aligned to the shards of the target are written concurrently
+        without locks, cores sharing a shard with other cores (e.g. the
+        target has coarser shards than the source) lock the shards they
+        touch, see Image.write. Blocks waiting to be written are held
+        against the memory budget, write() blocks when max_pending are
+        waiting.
+
+        Parameters:
+            image:       visor.Image to write into
+            resolution:  resolution level, see vsr.images()
+            max_pending: maximum number of blocks waiting to be written
+            max_workers: number of threads
+        """
+        self.image = image
+        self.resolution = str(resolution)
+        self._arr = image.load(self.resolution)
+        self._pool = ThreadPoolExecutor(max_workers=max_workers)
+        self._slots = threading.BoundedSemaphore(max_pending)
+        self._futures = []
+        self._closed = False
+
+
+    def write(self, block:Block, data:numpy.ndarray=None):
+        """
+        Drop the halo and write the core of a block
+
+        Parameters:
+            block: visor.blocks.Block from Image.iter_blocks()
+            data:  result computed on block.data, of the same shape,
+                   default block.data
+        """
+        if self._closed:
+            raise ValueError('BlockWriter is closed.')
+        self._check_errors()
+        core = numpy.ascontiguousarray(block.crop(data))[None, None]
+        region = (block.stack, block.channel) + block.core
+        lock = not is_shard_aligned(self._arr, region)
+        self._slots.acquire()
+        budget.acquire(core.nbytes)
+        try:
+            self._futures.append(self._pool.submit(self._write, core, region, lock))
+        except BaseException:
+            budget.release(core.nbytes)
+            self._slots.release()
+            raise
+
+
+    def _write(self, core:numpy.ndarray, region:tuple, lock:bool):
+        """
+        Private method to write a core on a background thread
+        """
+        try:
+            self.image.write(core, self.resolution, region=region, lock=lock)
+        finally:
+            budget.release(core.nbytes)
+            self._slots.release()
+
+
+    def _check_errors(self):
+        """
+        Private method to re-raise errors of finished background writes
+        """
+        pending = []
+        for f in self._futures:
+            if f.done():
+                f.result()
+            else:
+                pending.append(f)
+        self._futures = pending
+
+
+    def flush(self):
+        """
+        Wait until all written blocks are on disk
+        """
+        for f in self._futures:
+            f.result()
+        self._futures = []
+
+
+    def close(self):
+        """
+        Flush and stop the background writers
+        """
+        if self._closed:
+            return
+        try:
+            self.flush()
+        finally:
+            self._closed = True
+            self._pool.shutdown()
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, *exc):
+        self.close()
@@ -0,0 +1,256 @@
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import itertools
+import threading
+import numpy
+import SimpleITK as sitk
+from .image import Image
+from .memory import budget
+from .transform import AffineTable, Transform
+from .shard import normalize_region
+from .util import level_scale, trilinear
+
+BLENDS = ('max', 'mean')
+
+
+class BrainVolume:
+
+    def __init__(self, vsr, recon_version:str, channel:str, resolution:str,
+                 space:str='brain', voxel_size:tuple=None, interp:str='nearest',
+                 blend:str='max', block_shape:tuple=(64, 64, 64), cache_blocks:int=64,
+                 max_workers:int=None):
+        """
+        Constructor of BrainVolume, a lazy (z,y,x) array in a reconstructed
+        space assembled from all slices and stacks of a recon version
+
+        Each slice listed in recon.json contributes the stacks of its raw
+        image that have an affine raw_to_{space} transform. The transform
+        maps raw voxel indices (x,y,z) at resolution 0 to physical (x,y,z)
+        micrometers in the target space. Stacks without such a transform
+        are listed in self.missing.
+
+        Requests are split into blocks of block_shape, only raw regions
+        contributing to a block are read and resampled, blocks are fetched
+        in parallel and kept in an LRU cache. Cached blocks are held
+        against the memory budget, when it is full the least recently
+        used blocks are evicted, or the block is not cached.
+
+        Parameters:
+            vsr:           visor.VSR
+            recon_version: reconstruction version, see vsr.info()['recon_versions']
+            channel:       channel label (wavelength)
+            resolution:    resolution level of raw images to read
+            space:         target space, e.g. 'brain'
+            voxel_size:    (z,y,x) output voxel size in micrometer,
+                           default raw voxel size at the resolution
+            interp:        'nearest' or 'linear'
+            blend:         combine overlapping stacks by 'max' or 'mean'
+            block_shape:   (z,y,x) shape of assembled blocks
+            cache_blocks:  maximum number of cached blocks
+            max_workers:   number of threads
+        """
+        if blend not in BLENDS:
+            raise ValueError(f'Invalid blend {blend}. Must be one of {BLENDS}')
+        if interp not in ('nearest', 'linear'):
+            raise ValueError(f'Invalid interp {interp}. Must be nearest or linear')
+        self.resolution = str(resolution)
+        self.interp = interp
+        self.blend = blend
+        self.block_shape = tuple(block_shape)
+        self.cache_blocks = cache_blocks
+        self.max_workers = max_workers
+        self.missing = []
+
+        recon = vsr.transforms(recon_version)
+        table = AffineTable(vsr.storage, recon_version)
+        self.sources = []
+        for s in recon['slices']:
+            img = Image(vsr.storage, image_type='raw', image_name=s['name'])
+            if f'raw_to_{space}' not in s.get('transforms', []):
+                self.missing.append((s['name'], None))
+                continue
+            xfm = Transform(vsr.storage, recon_version=recon_version, slice_name=s['name'])
+            ch = img.label_to_index('channel', channel)
+            arr = img.load(self.resolution)
+            scale = numpy.asarray(level_scale(img, self.resolution))
+            for st in img.attrs['visor']['visor_stacks']:
+                # rows of the transform table, .tfm files otherwise
+                row = table.row(s['name'], f'raw_to_{space}', st['index'], ch)
+                if row is not None:
+                    t = table.matrices([row])[0]
+                else:
+                    try:
+                        t = xfm.load(from_space='raw', to_space=space, params=[st['index'], ch])
+                    except (FileNotFoundError, NotADirectoryError):
+                        t = None
+                if t is None:
+                    self.missing.append((s['name'], st['label']))
+                    continue
+                # voxel index at resolution (z,y,x) -> physical (z,y,x)
+                m = _affine_zyx(t) @ numpy.diag(numpy.append(scale, 1.0))
+                self.sources.append({'array': arr, 'stack': st['index'], 'channel': ch,
+                                     'matrix': m, 'inverse': numpy.linalg.inv(m),
+                                     'name': s['name']})
+        if not self.sources:
+            raise FileNotFoundError(f'No affine raw_to_{space} transform found in {recon_version}.')
+
+        if voxel_size is None:
+            img = Image(vsr.storage, image_type='raw', image_name=self.sources[0]['name'])
+            ms = img.attrs['ome']['multiscales'][0]
+            base = ms['coordinateTransformations'][0]['scale'][2:]
+            voxel_size = numpy.asarray(base) * level_scale(img, self.resolution)
+        self.voxel_size = numpy.asarray(voxel_size, dtype=numpy.float64)
+
+        # bounding box of all sources in physical space
+        corners = []
+        for src in self.sources:
+            n = src['array'].shape[2:]
+            for c in itertools.product(*[(0, k - 1) for k in n]):
+                corners.append((src['matrix'] @ numpy.append(c, 1.0))[:3])
+        corners = numpy.array(corners)
+        self.origin = corners.min(axis=0)
+        self.shape = tuple(int(k) for k in
+                           numpy.floor((corners.max(axis=0) - self.origin) / self.voxel_size) + 1)
+        self.ndim = 3
+        dtypes = {src['array'].dtype for src in self.sources}
+        self.dtype = numpy.dtype(numpy.float32) if 'linear' == interp or 'mean' == blend \
+            or len(dtypes) > 1 else dtypes.pop()
+
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+
+
+    def __getitem__(self, region):
+        """
+        Read a region of the volume
+
+        Parameters:
+            region: tuple of int or slice (step 1) for (z,y,x)
+
+        Returns:
+            numpy.ndarray
+        """
+        if not isinstance(region, tuple):
+            region = (region,)
+        squeeze = tuple(i for i, r in enumerate(region) if not isinstance(r, slice))
+        region = normalize_region(region, self.shape)
+        out = numpy.zeros(tuple(r.stop - r.start for r in region), dtype=self.dtype)
+        ranges = [range(r.start // b, (r.stop - 1) // b + 1) if r.stop > r.start else range(0)
+                  for r, b in zip(region, self.block_shape)]
+        indices = list(itertools.product(*ranges))
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as pool:
+            blocks = list(pool.map(self.block, indices))
+        for index, block in zip(indices, blocks):
+            src, dst = [], []
+            for i, r, b in zip(index, region, self.block_shape):
+                lo, hi = max(r.start, i * b), min(r.stop, (i + 1) * b)
+                src.append(slice(lo - i * b, hi - i * b))
+                dst.append(slice(lo - r.start, hi - r.start))
+            out[tuple(dst)] = block[tuple(src)]
+        return out.squeeze(axis=squeeze) if squeeze else out
+
+
+    def block(self, index:tuple):
+        """
+        Get an assembled block, from cache if available
+
+        Parameters:
+            index: (z,y,x) block index
+
+        Returns:
+            numpy.ndarray of block_shape, clipped at the volume edge
+        """
+        index = tuple(index)
+        with self._lock:
+            if index in self._cache:
+                self._cache.move_to_end(index)
+                return self._cache[index]
+        block = self._assemble(index)
+        with self._lock:
+            if index in self._cache or self.cache_blocks < 1:
+                return self._cache.get(index, block)
+            while len(self._cache) >= self.cache_blocks:
+                budget.release(self._cache.popitem(last=False)[1].nbytes)
+            while not budget.try_acquire(block.nbytes):
+                if not self._cache:
+                    return block
+                budget.release(self._cache.popitem(last=False)[1].nbytes)
+            self._cache[index] = block
+        return block
+
+
+    def clear_cache(self):
+        """
+        Drop all cached blocks and return their memory to the budget
+        """
+        with self._lock:
+            while self._cache:
+                budget.release(self._cache.popitem()[1].nbytes)
+
+
+    def __del__(self):
+        if hasattr(self, '_cache'):
+            self.clear_cache()
+
+
+    def _assemble(self, index:tuple):
+        """
+        Private method to resample all contributing stacks into a block
+        """
+        lo = numpy.array(index) * self.block_shape
+        hi = numpy.minimum(lo + self.block_shape, self.shape)
+        grid = numpy.stack(numpy.meshgrid(*[numpy.arange(a, b) for a, b in zip(lo, hi)],
+                                          indexing='ij'), axis=-1).reshape(-1, 3)
+        phys = self.origin + grid * self.voxel_size
+        acc = numpy.zeros(len(grid), dtype=numpy.float32 if self.blend == 'mean' else self.dtype)
+        cnt = numpy.zeros(len(grid), dtype=numpy.uint16)
+
+        for src in self.sources:
+            raw = (src['inverse'][:3, :3] @ phys.T).T + src['inverse'][:3, 3]
+            n = numpy.array(src['array'].shape[2:])
+            if 'linear' == self.interp:
+                inside = numpy.all((raw >= 0) & (raw <= n - 1), axis=1)
+                base = numpy.floor(raw).astype(numpy.int64)
+            else:
+                base = numpy.floor(raw + 0.5).astype(numpy.int64)
+                inside = numpy.all((base >= 0) & (base < n), axis=1)
+            if not inside.any():
+                continue
+            b = base[inside]
+            r0 = b.min(axis=0)
+            r1 = numpy.minimum(b.max(axis=0) + 2, n)
+            data = src['array'][src['stack']:src['stack']+1, src['channel']:src['channel']+1,
+                                r0[0]:r1[0], r0[1]:r1[1], r0[2]:r1[2]][0]
+            local = b - r0
+            if 'linear' == self.interp:
+                values = trilinear(data, local, raw[inside] - b)[0]
+            else:
+                values = data[0, local[:, 0], local[:, 1], local[:, 2]]
+            if 'mean' == self.blend:
+                acc[inside] += values
+            else:
+                acc[inside] = numpy.maximum(acc[inside], values.astype(acc.dtype))
+            cnt[inside] += 1
+
+        if 'mean' == self.blend:
+            acc = numpy.divide(acc, cnt, out=numpy.zeros_like(acc), where=cnt > 0)
+        return acc.astype(self.dtype, copy=False).reshape(tuple(hi - lo))
+
+
+def _affine_zyx(t:sitk.Transform|numpy.ndarray):
+    """
+    Private function to convert a SimpleITK affine transform, or a 4x4
+    matrix (e.g. from AffineTable.matrices), on (x,y,z) points into a 4x4
+    matrix on (z,y,x) points
+    """
+    if isinstance(t, sitk.Transform):
+        a = sitk.AffineTransform(t)
+        m = numpy.array(a.GetMatrix()).reshape(3, 3)
+        c = numpy.array(a.GetCenter())
+        t = numpy.eye(4)
+        t[:3, :3] = m
+        t[:3, 3] = numpy.array(a.GetTranslation()) + c - m @ c
+    p = numpy.eye(4)
+    p[:3, :3] = numpy.eye(3)[::-1]
+    return p @ t @ p
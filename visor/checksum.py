@@ -0,0 +1,281 @@
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+import hashlib
+import json
+import os
+import zarr
+from .lock import FileLock, lock_dir, write_atomic
+
+ALGORITHM = 'blake2b'
+
+# Manifest of an image group in its checksums sub-group, so it is copied
+# with the image: compacted checksums.json plus an append-only journal
+# written by concurrent writers, later journal lines win
+GROUP    = 'checksums'
+MANIFEST = 'checksums.json'
+JOURNAL  = 'checksums.log'
+
+
+def hash_file(path:str|Path, block_size:int=2**20):
+    """
+    Hash a file without decoding it
+
+    Parameters:
+        path:       path to the file
+        block_size: bytes per read
+
+    Returns:
+        hex digest
+    """
+    h = hashlib.new(ALGORITHM)
+    with open(path, 'rb') as f:
+        while block := f.read(block_size):
+            h.update(block)
+    return h.hexdigest()
+
+
+def _entry(path:Path):
+    """
+    Private function to hash a shard file and record its stat
+
+    Returns:
+        dict, or None if the file does not exist
+    """
+    try:
+        st = os.stat(path)
+        return {'hash': hash_file(path), 'size': st.st_size, 'mtime_ns': st.st_mtime_ns}
+    except FileNotFoundError:
+        return None
+
+
+def _lock(image_path:Path):
+    return FileLock(lock_dir(image_path)/f'{MANIFEST}.lock')
+
+
+def _create_group(image_path:Path):
+    """
+    Private function to create the checksums sub-group of an image group,
+    the caller must hold the manifest lock
+    """
+    if not manifest_path(image_path, 'zarr.json').exists():
+        zarr.open_group(str(image_path), path=GROUP, mode='a')
+
+
+def manifest_path(image_path:str|Path, name:str=MANIFEST):
+    """
+    Get the path of the checksum manifest or journal of an image group,
+    in its checksums sub-group
+
+    Parameters:
+        image_path: path to the image group
+        name:       MANIFEST or JOURNAL
+
+    Returns:
+        Path
+    """
+    return Path(image_path)/GROUP/name
+
+
+def list_shards(image_path:str|Path, resolution:str):
+    """
+    List shard files of an array on disk
+
+    Parameters:
+        image_path: path to the image group
+        resolution: resolution level
+
+    Returns:
+        list of keys relative to the array, e.g. 'c/0/1/0/0/0'
+    """
+    root = Path(image_path)/str(resolution)
+    keys = []
+    def walk(path, key):
+        with os.scandir(path) as it:
+            for e in it:
+                if e.is_dir():
+                    walk(e.path, f'{key}/{e.name}')
+                elif not e.name.startswith('.'):
+                    keys.append(f'{key}/{e.name}')
+    if (root/'c').is_dir():
+        walk(root/'c', 'c')
+    return sorted(keys)
+
+
+def load_manifest(image_path:str|Path):
+    """
+    Load checksum manifest of an image group
+
+    Parameters:
+        image_path: path to the image group
+
+    Returns:
+        dict of {resolution: {shard key: entry}}
+    """
+    manifest = {}
+    if manifest_path(image_path).exists():
+        with open(manifest_path(image_path)) as f:
+            manifest = json.load(f)['arrays']
+    if manifest_path(image_path, JOURNAL).exists():
+        with open(manifest_path(image_path, JOURNAL)) as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                r = json.loads(line)
+                arr = manifest.setdefault(r['resolution'], {})
+                if r['entry'] is None:
+                    arr.pop(r['key'], None)
+                else:
+                    arr[r['key']] = r['entry']
+    return manifest
+
+
+def save_manifest(image_path:str|Path, manifest:dict):
+    """
+    Save a compacted checksum manifest and clear the journal,
+    the caller must hold the manifest lock
+
+    Parameters:
+        image_path: path to the image group
+        manifest:   dict of {resolution: {shard key: entry}}
+    """
+    _create_group(image_path)
+    write_atomic(manifest_path(image_path), json.dumps({'algorithm': ALGORITHM, 'arrays': manifest}))
+    if manifest_path(image_path, JOURNAL).exists():
+        os.truncate(manifest_path(image_path, JOURNAL), 0)
+
+
+def record_shards(image_path:str|Path, resolution:str, keys:list, max_workers:int=None):
+    """
+    Hash shard files just written, still in the page cache, and append
+    them to the journal. Shards no longer on disk (e.g. written empty)
+    are removed from the manifest.
+
+    Parameters:
+        image_path:  path to the image group
+        resolution:  resolution level
+        keys:        shard keys relative to the array
+        max_workers: number of threads hashing
+    """
+    image_path = Path(image_path)
+    resolution = str(resolution)
+    hash_entry = lambda k: _entry(image_path/resolution/k)
+    if len(keys) > 1:
+        with ThreadPoolExecutor(max_workers=max_workers) as pool:
+            entries = list(pool.map(hash_entry, keys))
+    else:
+        entries = [hash_entry(k) for k in keys]
+    lines = [json.dumps({'resolution': resolution, 'key': k, 'entry': e}) + '\n'
+             for k, e in zip(keys, entries)]
+    with _lock(image_path):
+        _create_group(image_path)
+        with open(manifest_path(image_path, JOURNAL), 'a') as f:
+            f.write(''.join(lines))
+
+
+def record_image(image_path:str|Path, resolutions:list=None, max_workers:int=None):
+    """
+    Build the checksum manifest from the shard files on disk, e.g. for
+    images written before checksums were recorded
+
+    Parameters:
+        image_path:  path to the image group
+        resolutions: resolution levels, None for all arrays
+        max_workers: number of threads
+    """
+    image_path = Path(image_path)
+    resolutions = resolutions or _arrays(image_path)
+    jobs = [(str(r), k) for r in resolutions for k in list_shards(image_path, r)]
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        entries = list(pool.map(lambda j: _entry(image_path/j[0]/j[1]), jobs))
+    with _lock(image_path):
+        manifest = load_manifest(image_path)
+        for r in resolutions:
+            manifest[str(r)] = {}
+        for (r, k), e in zip(jobs, entries):
+            if e is not None:
+                manifest[r][k] = e
+        save_manifest(image_path, manifest)
+
+
+def verify_image(image_path:str|Path, incremental:bool=False,
+                 processes:bool=False, max_workers:int=None):
+    """
+    Verify shard files of an image group against its checksum manifest
+
+    Shards are re-hashed in parallel without decoding. Verified stats are
+    recorded, so an incremental verification only re-hashes shards whose
+    size or modification time changed since.
+
+    Parameters:
+        image_path:  path to the image group
+        incremental: only re-hash shards changed since the last verification
+        processes:   hash on a process pool instead of a thread pool
+        max_workers: number of threads or processes
+
+    Returns:
+        dict with 'ok', 'skipped' counts and lists of 'missing',
+        'corrupt' and 'extra' shards as '{resolution}/{key}'
+    """
+    image_path = Path(image_path)
+    manifest = load_manifest(image_path)
+    report = {'ok': 0, 'skipped': 0, 'missing': [], 'corrupt': [], 'extra': []}
+
+    jobs = []
+    for r in sorted(set(manifest) | set(_arrays(image_path))):
+        recorded = manifest.get(r, {})
+        on_disk = set(list_shards(image_path, r))
+        report['extra'] += [f'{r}/{k}' for k in sorted(on_disk - set(recorded))]
+        for k, e in sorted(recorded.items()):
+            if k not in on_disk:
+                report['missing'].append(f'{r}/{k}')
+                continue
+            st = os.stat(image_path/r/k)
+            if incremental and (st.st_size, st.st_mtime_ns) == (e['size'], e['mtime_ns']):
+                report['skipped'] += 1
+                continue
+            jobs.append((r, k, st))
+
+    Executor = ProcessPoolExecutor if processes else ThreadPoolExecutor
+    with Executor(max_workers=max_workers) as pool:
+        hashes = list(pool.map(hash_file, [image_path/r/k for r, k, _ in jobs], chunksize=16))
+
+    verified = []
+    for (r, k, st), h in zip(jobs, hashes):
+        if h == manifest[r][k]['hash']:
+            report['ok'] += 1
+            verified.append((r, k, st, h))
+        else:
+            report['corrupt'].append(f'{r}/{k}')
+
+    # remember verified stats, on top of writes since the manifest was loaded
+    if verified:
+        with _lock(image_path):
+            current = load_manifest(image_path)
+            for r, k, st, h in verified:
+                e = current.get(r, {}).get(k)
+                # shards rewritten while hashing are left for the next run
+                if e is None or e['hash'] != manifest[r][k]['hash']:
+                    continue
+                current[r][k] = {'hash': h, 'size': st.st_size, 'mtime_ns': st.st_mtime_ns}
+            save_manifest(image_path, current)
+    return report
+
+
+def _arrays(image_path:Path, prefix:str=''):
+    """
+    Private function to list arrays of an image group by path, arrays of
+    nested groups (e.g. the label index) included
+    """
+    arrays = []
+    with os.scandir(Path(image_path)/prefix) as it:
+        for e in it:
+            meta = os.path.join(e.path, 'zarr.json')
+            if not e.is_dir() or e.name.startswith('.') or not os.path.exists(meta):
+                continue
+            with open(meta) as f:
+                node_type = json.load(f).get('node_type')
+            if 'group' == node_type:
+                arrays += _arrays(image_path, f'{prefix}{e.name}/')
+            else:
+                arrays.append(f'{prefix}{e.name}')
+    return sorted(arrays)
@@ -0,0 +1,299 @@
+from concurrent.futures import ThreadPoolExecutor
+import contextlib
+import math
+import operator
+import os
+import threading
+import numpy
+from .memory import budget
+from .shard import is_shard_aligned, normalize_region, shard_region, shards_in_region
+
+REDUCTIONS = ('sum', 'min', 'max', 'mean', 'count')
+
+
+def lazy(arr, region:tuple=None):
+    """
+    Wrap a zarr.Array (e.g. from Image.load) as a LazyArray
+
+    Parameters:
+        arr:    zarr.Array
+        region: tuple of int or slice per dimension, None for all,
+                dimensions are preserved
+
+    Returns:
+        LazyArray
+    """
+    region = normalize_region(region, arr.shape)
+    shape = tuple(r.stop - r.start for r in region)
+    return LazyArray(_Source(arr, region), shape, arr.dtype, arr.shards or arr.chunks)
+
+
+class LazyArray:
+
+    def __init__(self, node, shape:tuple, dtype:numpy.dtype, blocks:tuple):
+        """
+        Constructor of LazyArray, an expression evaluated block by block,
+        use visor.compute.lazy() to create one
+
+        Elementwise operators, astype, map_blocks and threshold build new
+        expressions, reductions (sum, min, max, mean, count) and compute()
+        or to_zarr() evaluate them. Blocks follow the shard grid of the
+        first source array, they are read in shard order, decoded by zarrs
+        and evaluated on a thread pool (NumPy releases the GIL).
+
+        Parameters:
+            node:   expression node
+            shape:  shape of the expression
+            dtype:  dtype of the expression
+            blocks: block shape, the shard shape of the first source
+        """
+        self.node = node
+        self.shape = tuple(shape)
+        self.dtype = numpy.dtype(dtype)
+        self.blocks = tuple(blocks)
+        self.ndim = len(self.shape)
+
+
+    def _elementwise(self, func, *others, dtype=None):
+        args = [self] + list(others)
+        for a in args:
+            if isinstance(a, LazyArray) and a.shape != self.shape:
+                raise ValueError(f'Shapes {self.shape} and {a.shape} do not match.')
+        if dtype is None:
+            probe = [numpy.ones((1,) * self.ndim, dtype=a.dtype) if isinstance(a, LazyArray)
+                     else a for a in args]
+            with numpy.errstate(all='ignore'):
+                dtype = numpy.asarray(func(*probe)).dtype
+        nodes = [a.node if isinstance(a, LazyArray) else a for a in args]
+        return LazyArray(_Map(func, nodes), self.shape, dtype, self.blocks)
+
+
+    def map_blocks(self, func, dtype=None):
+        """
+        Apply func(block) -> block of the same shape to every block
+
+        Parameters:
+            func:  callable on numpy.ndarray
+            dtype: output dtype, inferred from a 1-element block if None
+
+        Returns:
+            LazyArray
+        """
+        return self._elementwise(func, dtype=dtype)
+
+
+    def astype(self, dtype):
+        return self._elementwise(lambda x: x.astype(dtype), dtype=numpy.dtype(dtype))
+
+
+    def threshold(self, value):
+        """
+        Boolean mask of voxels above value
+        """
+        return self > value
+
+
+    def __add__(self, o):      return self._elementwise(operator.add, o)
+    def __radd__(self, o):     return self._elementwise(lambda a, b: b + a, o)
+    def __sub__(self, o):      return self._elementwise(operator.sub, o)
+    def __rsub__(self, o):     return self._elementwise(lambda a, b: b - a, o)
+    def __mul__(self, o):      return self._elementwise(operator.mul, o)
+    def __rmul__(self, o):     return self._elementwise(lambda a, b: b * a, o)
+    def __truediv__(self, o):  return self._elementwise(operator.truediv, o)
+    def __rtruediv__(self, o): return self._elementwise(lambda a, b: b / a, o)
+    def __gt__(self, o):       return self._elementwise(operator.gt, o)
+    def __ge__(self, o):       return self._elementwise(operator.ge, o)
+    def __lt__(self, o):       return self._elementwise(operator.lt, o)
+    def __le__(self, o):       return self._elementwise(operator.le, o)
+    def __eq__(self, o):       return self._elementwise(operator.eq, o)
+    def __ne__(self, o):       return self._elementwise(operator.ne, o)
+    def __and__(self, o):      return self._elementwise(operator.and_, o)
+    def __or__(self, o):       return self._elementwise(operator.or_, o)
+    def __neg__(self):         return self._elementwise(operator.neg)
+    def __invert__(self):      return self._elementwise(operator.invert)
+    __hash__ = None
+
+
+    def sum(self, max_workers:int=None):
+        return self._reduce('sum', max_workers)
+
+
+    def min(self, max_workers:int=None):
+        return self._reduce('min', max_workers)
+
+
+    def max(self, max_workers:int=None):
+        return self._reduce('max', max_workers)
+
+
+    def mean(self, max_workers:int=None):
+        return self._reduce('mean', max_workers)
+
+
+    def count(self, max_workers:int=None):
+        """
+        Number of non-zero (True) voxels, e.g. (arr > 100).count()
+        """
+        return self._reduce('count', max_workers)
+
+
+    def _reduce(self, kind:str, max_workers:int=None):
+        """
+        Private method to reduce the whole expression to a scalar
+
+        Returns:
+            numpy scalar
+        """
+        def partial(region):
+            block = _evaluate(self.node, region)
+            if 'sum' == kind or 'mean' == kind:
+                return block.sum(dtype=_sum_dtype(self.dtype))
+            if 'count' == kind:
+                return numpy.count_nonzero(block)
+            return getattr(block, kind)()
+
+        partials = list(_run(partial, self._regions(), max_workers, self._nbytes))
+        if not partials:
+            raise ValueError(f'Can not reduce an empty array by {kind}.')
+        if 'min' == kind:
+            return min(partials)
+        if 'max' == kind:
+            return max(partials)
+        total = numpy.sum(partials, dtype=_sum_dtype(self.dtype)) if 'count' != kind else sum(partials)
+        return total / math.prod(self.shape) if 'mean' == kind else total
+
+
+    def compute(self, max_workers:int=None):
+        """
+        Evaluate the expression into memory
+
+        Returns:
+            numpy.ndarray
+        """
+        out = numpy.empty(self.shape, dtype=self.dtype)
+        def evaluate(region):
+            out[region] = _evaluate(self.node, region)
+        list(_run(evaluate, self._regions(), max_workers, self._nbytes))
+        return out
+
+
+    def to_zarr(self, target, max_workers:int=None, resolution:str=None):
+        """
+        Evaluate the expression block by block into an existing array of
+        the same shape, written through the zarrs pipeline. Writes into a
+        visor.Image go through Image.write, so checksums are journaled and
+        target shards shared by several blocks are locked. Blocks are
+        shard-aligned when target has the same shard grid as the source.
+
+        Parameters:
+            target:      visor.Image, or zarr.Array e.g. from Image.save(None, ...)
+            max_workers: number of threads
+            resolution:  resolution level of a visor.Image target
+        """
+        from .image import Image
+        if isinstance(target, Image):
+            if resolution is None:
+                raise ValueError('Writing into a visor.Image requires a resolution.')
+            arr = target.load(resolution)
+            def write(region, data):
+                target.write(data, resolution, region=region, lock=not is_shard_aligned(arr, region))
+        else:
+            arr, shared = target, threading.Lock()
+            def write(region, data):
+                with contextlib.nullcontext() if is_shard_aligned(arr, region) else shared:
+                    arr[region] = data
+        if tuple(arr.shape) != self.shape:
+            raise ValueError(f'Shapes {self.shape} and {arr.shape} do not match.')
+        def evaluate(region):
+            write(region, _evaluate(self.node, region))
+        list(_run(evaluate, self._regions(), max_workers, self._nbytes))
+
+
+    def _nbytes(self, region:tuple):
+        """
+        Private method to estimate bytes in flight evaluating a block,
+        the decoded sources and the result
+        """
+        n = math.prod(r.stop - r.start for r in region)
+        return n * (sum(s.arr.dtype.itemsize for s in _sources(self.node)) + self.dtype.itemsize)
+
+
+    def _regions(self):
+        """
+        Private method to iterate blocks in shard order (C order), on the
+        absolute shard grid of the first source array
+        """
+        src = _sources(self.node)[0]
+        for s in shards_in_region(src.arr, src.region):
+            yield tuple(slice(max(r.start, o.start) - o.start, min(r.stop, o.stop) - o.start)
+                        for r, o in zip(shard_region(src.arr, s), src.region))
+
+
+class _Source:
+
+    def __init__(self, arr, region):
+        self.arr = arr
+        self.region = region
+
+
+class _Map:
+
+    def __init__(self, func, args):
+        self.func = func
+        self.args = args
+
+
+def _evaluate(node, region:tuple):
+    """
+    Private function to evaluate an expression node on a block region
+    """
+    if isinstance(node, _Source):
+        return node.arr[tuple(slice(o.start + r.start, o.start + r.stop)
+                              for o, r in zip(node.region, region))]
+    if isinstance(node, _Map):
+        return node.func(*[_evaluate(a, region) for a in node.args])
+    return node
+
+
+def _sources(node):
+    """
+    Private function to list source nodes of an expression
+    """
+    if isinstance(node, _Source):
+        return [node]
+    if isinstance(node, _Map):
+        return [s for a in node.args for s in _sources(a)]
+    return []
+
+
+def _run(func, regions, max_workers:int=None, nbytes=None):
+    """
+    Private function to map func over regions on a thread pool, keeping
+    a bounded number of blocks in flight and results in order, blocks
+    are admitted by the memory budget with nbytes(region) bytes
+    """
+    max_workers = max_workers or min(32, (os.cpu_count() or 1) + 4)
+    window = 2 * max_workers
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        pending = []
+        for region in regions:
+            n = nbytes(region) if nbytes else 0
+            budget.acquire(n)
+            f = pool.submit(func, region)
+            f.add_done_callback(lambda _, n=n: budget.release(n))
+            pending.append(f)
+            if len(pending) >= window:
+                yield pending.pop(0).result()
+        for f in pending:
+            yield f.result()
+
+
+def _sum_dtype(dtype:numpy.dtype):
+    """
+    Private function to get accumulator dtype of sums, as numpy.sum
+    """
+    if dtype.kind in 'bu':
+        return numpy.uint64
+    if dtype.kind == 'i':
+        return numpy.int64
+    return numpy.result_type(dtype, numpy.float64) if dtype.kind == 'f' else dtype
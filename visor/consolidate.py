@@ -0,0 +1,147 @@
+import json
+from .lock import storage_lock
+from .storage import Storage
+
+# Consolidated metadata of a whole .vsr, one read to open it
+VSR_META = 'consolidated.json'
+
+
+def _nodes(storage:Storage, key:str):
+    """
+    Private function to read metadata of the arrays and groups of an image
+    group by path, nested groups (e.g. the label index) included
+    """
+    nodes, level = {}, ['']
+    while level:
+        paths = [f'{p}/{d}'.lstrip('/') for p in level
+                 for d in storage.scan_dirs(f'{key}/{p}'.rstrip('/')) if not d.startswith('.')]
+        paths = [p for p in paths if storage.is_file(f'{key}/{p}/zarr.json')]
+        metas = storage.read_jsons([f'{key}/{p}/zarr.json' for p in paths])
+        nodes.update(zip(paths, metas))
+        level = [p for p, m in zip(paths, metas) if 'group' == m.get('node_type')]
+    return dict(sorted(nodes.items()))
+
+
+def consolidate_image(storage:Storage, key:str):
+    """
+    Write metadata of all arrays into the group zarr.json, in the inline
+    consolidated_metadata of zarr v3, so zarr.open_group reads a single
+    document instead of one per array
+
+    Parameters:
+        storage: storage of the .vsr
+        key:     key of the image group, e.g. visor_raw_images/slice_1.zarr
+
+    Returns:
+        group metadata
+    """
+    with storage_lock(storage, key, 'zarr.json'):
+        meta = storage.read_json(f'{key}/zarr.json')
+        meta['consolidated_metadata'] = {
+            'kind': 'inline',
+            'must_understand': False,
+            'metadata': _nodes(storage, key),
+        }
+        storage.put(f'{key}/zarr.json', json.dumps(meta, indent=2).encode())
+    return meta
+
+
+def is_consolidated(meta:dict):
+    return meta.get('consolidated_metadata') is not None
+
+
+def sync_image(storage:Storage, key:str):
+    """
+    Refresh consolidated metadata of an image group after its attributes
+    or arrays changed, in the group itself if consolidated and in the
+    .vsr document if present
+
+    Parameters:
+        storage: storage of the .vsr
+        key:     key of the image group
+    """
+    meta = storage.read_json(f'{key}/zarr.json')
+    if is_consolidated(meta):
+        meta = consolidate_image(storage, key)
+    if storage.is_file(VSR_META):
+        image_type = key.split('/')[0].split('_')[1]
+        name = key.split('/')[1].removesuffix('.zarr')
+        update_vsr(storage, ['images', image_type, 'groups', name], meta)
+
+
+def _collect(storage:Storage):
+    """
+    Private function to collect metadata of a .vsr
+    """
+    doc = {'info': storage.read_json('info.json'), 'images': {}, 'recon_versions': {}}
+    for d in storage.scan_dirs('', 'visor_', '_images'):
+        images = doc['images'][d.split('_')[1]] = {'groups': {}}
+        if storage.is_file(f'{d}/selected.json'):
+            images['selected'] = storage.read_json(f'{d}/selected.json')
+        names = storage.scan_dirs(d, suffix='.zarr')
+        metas = storage.read_jsons([f'{d}/{n}/zarr.json' for n in names])
+        images['groups'] = {n.removesuffix('.zarr'): m for n, m in zip(names, metas)}
+    dir = 'visor_recon_transforms'
+    for v in storage.scan_dirs(dir):
+        slices = storage.scan_dirs(f'{dir}/{v}')
+        keys = [f'{dir}/{v}/{s}/transforms.json' for s in slices]
+        found = [(s, k) for s, k in zip(slices, keys) if storage.is_file(k)]
+        recon = f'{dir}/{v}/recon.json'
+        doc['recon_versions'][v] = {
+            'recon': storage.read_json(recon) if storage.is_file(recon) else {},
+            'slices': dict(zip([s for s, _ in found], storage.read_jsons([k for _, k in found]))),
+        }
+    return doc
+
+
+def consolidate_vsr(storage:Storage, images:bool=True):
+    """
+    Write the consolidated metadata document of a .vsr, holding info.json,
+    selected.json, the zarr.json of every image group, every recon.json
+    and transforms.json
+
+    Parameters:
+        storage: storage of the .vsr
+        images:  also consolidate arrays into each image group
+    """
+    if images:
+        for d in storage.scan_dirs('', 'visor_', '_images'):
+            for n in storage.scan_dirs(d, suffix='.zarr'):
+                consolidate_image(storage, f'{d}/{n}')
+    with storage_lock(storage, '', VSR_META):
+        storage.put(VSR_META, json.dumps(_collect(storage)).encode())
+
+
+def load_vsr(storage:Storage):
+    """
+    Load the consolidated metadata document of a .vsr
+
+    Returns:
+        dict, or None if the .vsr is not consolidated
+    """
+    try:
+        return storage.read_json(VSR_META)
+    except FileNotFoundError:
+        return None
+
+
+def update_vsr(storage:Storage, path:list, value):
+    """
+    Replace an entry of the consolidated .vsr document, if present
+
+    Parameters:
+        storage: storage of the .vsr
+        path:    keys to the entry, e.g. ['images', 'raw', 'groups', 'slice_1']
+        value:   new entry
+    """
+    if not storage.is_file(VSR_META):
+        return
+    with storage_lock(storage, '', VSR_META):
+        doc = load_vsr(storage)
+        if doc is None:
+            return
+        node = doc
+        for k in path[:-1]:
+            node = node.setdefault(k, {})
+        node[path[-1]] = value
+        storage.put(VSR_META, json.dumps(doc).encode())
@@ -0,0 +1,283 @@
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+import contextlib
+import math
+import multiprocessing
+import os
+import threading
+import numpy
+from zarr.core.buffer.cpu import NDBuffer
+from .access import unwrap
+from .memory import budget
+from .pipeline import Pipeline, _blocks
+from .shard import normalize_region
+
+# Bytes of a ring slot, blocks larger than a slot are split
+SLOT_BYTES = 16 * 2**20
+
+# Arrays and shared memory segments opened by a worker process
+_arrays = {}
+_segments = {}
+
+
+def _worker_array(source:tuple):
+    """
+    Private function to open an array once per worker process
+    """
+    if source not in _arrays:
+        from .image import Image
+        url, image_type, image_name, resolution = source
+        # reads of workers are logged once by the caller
+        _arrays[source] = unwrap(Image(url, image_type=image_type, image_name=image_name).load(resolution))
+    return _arrays[source]
+
+
+def _worker_segment(name:str):
+    """
+    Private function to attach a ring slot once per worker process, the
+    parent owns and unlinks the segment
+    """
+    if name not in _segments:
+        _segments[name] = shared_memory.SharedMemory(name=name)
+    return _segments[name]
+
+
+def _decode(source:tuple, region:list, slot:str, shape:tuple, dtype:str):
+    """
+    Private function to decode a block in a worker process directly into
+    a ring slot
+
+    Returns:
+        name of the slot, the block is handed back by descriptor only
+    """
+    arr = _worker_array(source)
+    view = numpy.ndarray(shape, dtype=dtype, buffer=_worker_segment(slot).buf)
+    arr.get_basic_selection(tuple(slice(a, b) for a, b in region), out=NDBuffer.from_numpy_array(view))
+    del view
+    return slot
+
+
+class DecodePool:
+
+    def __init__(self, max_workers:int=None, ring_size:int=None, slot_bytes:int=SLOT_BYTES):
+        """
+        Constructor of DecodePool, worker processes decoding blocks of
+        Image arrays into a ring of shared memory slots
+
+        Workers open the arrays themselves and decode each block straight
+        into a free slot, only the slot name travels back, so the parent
+        gets zero-copy views instead of pickled arrays. This scales codecs
+        and kernels holding the GIL, where threads do not. Slots are
+        recycled once a block is consumed, the ring is held against the
+        memory budget while the pool is open.
+
+        Arrays are reopened by url in the workers, so storage must be
+        reachable from other processes (not memory://).
+
+        Parameters:
+            max_workers: number of worker processes, default cpu count
+            ring_size:   number of slots, default 2 per worker
+            slot_bytes:  bytes of a slot
+        """
+        self.max_workers = max_workers or os.cpu_count() or 1
+        self.ring_size = ring_size or 2 * self.max_workers
+        self.slot_bytes = int(slot_bytes)
+        self.n_blocks = 0
+        self.n_bytes = 0
+        budget.acquire(self.ring_size * self.slot_bytes)
+        self._slots = []
+        try:
+            for _ in range(self.ring_size):
+                self._slots.append(shared_memory.SharedMemory(create=True, size=self.slot_bytes))
+        except BaseException:
+            self._unlink()
+            budget.release(self.ring_size * self.slot_bytes)
+            raise
+        self._free = deque(range(self.ring_size))
+        self._cond = threading.Condition()
+        self._pool = ProcessPoolExecutor(max_workers=self.max_workers,
+                                         mp_context=multiprocessing.get_context('spawn'))
+        self._closed = False
+
+
+    def blocks(self, image, resolution:str, region:tuple=None, factors:tuple=None):
+        """
+        Decode a region block by block along the shard grid
+
+        A view is only valid until the next block is requested, its slot
+        is then recycled, copy it to keep it.
+
+        Parameters:
+            image:      visor.Image
+            resolution: resolution level, see vsr.images()
+            region:     tuple of int or slice per dimension, None for all
+            factors:    block edges are kept on multiples of these from
+                        the region start, e.g. binning factors
+
+        Returns:
+            generator of (block, view), block as tuple of slices and view
+            a numpy.ndarray in shared memory
+        """
+        if self._closed:
+            raise ValueError('DecodePool is closed.')
+        arr = image.load(resolution)
+        source = _source(image, resolution)
+        region = normalize_region(region, arr.shape)
+        factors = factors or (1,) * arr.ndim
+        steps = tuple(math.lcm(c, f) for c, f in zip(arr.chunks, factors))
+        todo = deque(b for block in _blocks(region, arr.shards or arr.chunks, factors)
+                     for b in _split(block, arr.dtype.itemsize, self.slot_bytes, steps))
+        pending = deque()
+        try:
+            while todo or pending:
+                while todo:
+                    slot = self._take(wait=not pending)
+                    if slot is None:
+                        break
+                    block = todo.popleft()
+                    shape = tuple(b.stop - b.start for b in block)
+                    future = self._pool.submit(_decode, source, [(b.start, b.stop) for b in block],
+                                               self._slots[slot].name, shape, arr.dtype.str)
+                    pending.append((future, slot, block, shape))
+                future, slot, block, shape = pending.popleft()
+                try:
+                    future.result()
+                    view = numpy.ndarray(shape, dtype=arr.dtype, buffer=self._slots[slot].buf)
+                    self.n_blocks += 1
+                    self.n_bytes += view.nbytes
+                    yield block, view
+                finally:
+                    self._give(slot)
+        finally:
+            for future, slot, _, _ in pending:
+                if not future.cancel():
+                    with contextlib.suppress(Exception):
+                        future.result()
+                self._give(slot)
+
+
+    def read(self, image, resolution:str, region:tuple=None, pipeline:Pipeline=None):
+        """
+        Read a region through the pool, see Pipeline.read
+
+        Parameters:
+            image:      visor.Image
+            resolution: resolution level, see vsr.images()
+            region:     tuple of int or slice per dimension, None for all,
+                        int dimensions are dropped like numpy indexing
+            pipeline:   visor.Pipeline applied to each block in the parent
+
+        Returns:
+            numpy.ndarray
+        """
+        pipeline = pipeline or Pipeline()
+        arr = image.load(resolution)
+        if region is not None and not isinstance(region, tuple):
+            region = (region,)
+        squeeze = tuple(i for i, r in enumerate(region or ()) if not isinstance(r, slice))
+        region = normalize_region(region, arr.shape)
+        f = pipeline.factors(arr.ndim)
+        for i in squeeze:
+            if f[i] != 1:
+                raise ValueError(f'Can not bin the indexed dimension {i}.')
+
+        out_shape = tuple((r.stop - r.start) // b for r, b in zip(region, f))
+        out = numpy.empty(out_shape, dtype=pipeline.output_dtype(arr.dtype))
+        if all(n > 0 for n in out_shape):
+            for block, view in self.blocks(image, resolution, region, factors=f):
+                data = pipeline.apply(view, block)
+                dst = tuple(slice((b.start - r.start) // k, (b.start - r.start) // k + n)
+                            for b, r, k, n in zip(block, region, f, data.shape))
+                out[dst] = data
+                del data, view
+        return out.squeeze(axis=squeeze) if squeeze else out
+
+
+    def _take(self, wait:bool):
+        """
+        Private method to take a free slot, None if none is free and not wait
+        """
+        with self._cond:
+            if wait:
+                self._cond.wait_for(lambda: self._free)
+            return self._free.popleft() if self._free else None
+
+
+    def _give(self, slot:int):
+        with self._cond:
+            self._free.append(slot)
+            self._cond.notify()
+
+
+    def _unlink(self):
+        """
+        Private method to free the ring, views still held by callers keep
+        their memory mapped until they are released
+        """
+        for shm in self._slots:
+            with contextlib.suppress(BufferError):
+                shm.close()
+            with contextlib.suppress(FileNotFoundError):
+                shm.unlink()
+        self._slots = []
+
+
+    def close(self):
+        """
+        Stop the workers and free the ring
+        """
+        if self._closed:
+            return
+        self._closed = True
+        self._pool.shutdown()
+        self._unlink()
+        budget.release(self.ring_size * self.slot_bytes)
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+    def __del__(self):
+        if hasattr(self, '_closed'):
+            self.close()
+
+
+def _source(image, resolution:str):
+    """
+    Private function to describe an array for worker processes
+    """
+    url = image.storage.url
+    if url.startswith('memory://'):
+        raise ValueError(f'Storage {url} is not shared with worker processes.')
+    image_dir, name = image.key.split('/')
+    return (url, image_dir.split('_', 1)[1].rsplit('_', 1)[0], name.removesuffix('.zarr'), str(resolution))
+
+
+def _split(block:tuple, itemsize:int, slot_bytes:int, steps:tuple):
+    """
+    Private function to split a block into pieces fitting in a slot, cut
+    at multiples of steps (chunk shape and binning factors)
+
+    Returns:
+        list of tuples of slices
+    """
+    extents = [b.stop - b.start for b in block]
+    nbytes = math.prod(extents) * itemsize
+    if nbytes <= slot_bytes:
+        return [block]
+    for d, (b, s) in enumerate(zip(block, steps)):
+        n = extents[d]
+        if n <= s:
+            continue
+        layer = nbytes // n
+        k = max(1, slot_bytes // (layer * s)) * s
+        pieces = [block[:d] + (slice(a, min(a + k, b.stop)),) + block[d+1:]
+                  for a in range(b.start, b.stop, k)]
+        return [p for piece in pieces for p in _split(piece, itemsize, slot_bytes, steps)]
+    raise ValueError(f'Block {block} of {nbytes} bytes does not fit in slots of {slot_bytes} bytes.')
@@ -0,0 +1,64 @@
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+import os
+import json
+
+# Bound on concurrent metadata reads, same default as ThreadPoolExecutor
+MAX_WORKERS = min(32, (os.cpu_count() or 1) + 4)
+
+
+def scan_dirs(path:str|Path, prefix:str='', suffix:str=''):
+    """
+    List sub-directory names with a single os.scandir pass
+
+    The file type comes from the directory entry itself (d_type), so no
+    extra stat call is issued per entry on filesystems that report it.
+
+    Parameters:
+        path:   directory to scan
+        prefix: keep names starting with prefix
+        suffix: keep names ending with suffix
+
+    Returns:
+        List of names, in directory order, empty if path does not exist
+    """
+    try:
+        with os.scandir(path) as it:
+            return [e.name for e in it
+                    if e.name.startswith(prefix) and e.name.endswith(suffix)
+                    and e.is_dir()]
+    except (FileNotFoundError, NotADirectoryError):
+        return []
+
+
+def read_json(path:str|Path):
+    """
+    Read a JSON file
+
+    Parameters:
+        path: path to the JSON file
+
+    Returns:
+        JSON like object
+    """
+    with open(path) as f:
+        return json.load(f)
+
+
+def read_jsons(paths:list, max_workers:int=None):
+    """
+    Read many small JSON files concurrently through a bounded thread pool
+
+    Parameters:
+        paths:       list of paths to JSON files
+        max_workers: maximum number of concurrent reads
+
+    Returns:
+        List of JSON like objects, in the order of paths
+    """
+    paths = list(paths)
+    if len(paths) < 2:
+        return [read_json(p) for p in paths]
+    max_workers = min(max_workers or MAX_WORKERS, len(paths))
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        return list(pool.map(read_json, paths))
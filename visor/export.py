@@ -0,0 +1,209 @@
+from pathlib import Path, PurePosixPath
+from concurrent.futures import ThreadPoolExecutor
+from xml.sax.saxutils import quoteattr
+import os
+import struct
+import threading
+import numpy
+from .memory import budget
+from .shard import normalize_region
+
+FORMATS = ('ome-tiff', 'raw')
+
+# TIFF SampleFormat by numpy kind
+_SAMPLE_FORMAT = {'u': 1, 'i': 2, 'f': 3}
+
+
+def export_image(img, path:str|Path, format:str='ome-tiff',
+                 stack:int=0, channel:int=0, resolution:str='0', region:tuple=None,
+                 bigtiff:bool=None, slab_size:int=None, read_ahead:int=2,
+                 max_workers:int=None):
+    """
+    Export a stack and channel of an image as OME-TIFF or raw, slab by slab
+
+    The output layout is computed up front, so z-slabs are read and
+    written at their final offsets in parallel, and at most read_ahead
+    slabs are held in memory regardless of the volume size.
+
+    Parameters:
+        img:         visor.Image
+        path:        output file path
+        format:      'ome-tiff' (uncompressed, one page per z) or 'raw'
+                     (little endian, z,y,x order, no header)
+        stack:       visor_stack index
+        channel:     channel index
+        resolution:  resolution level, see vsr.images()
+        region:      tuple of int or slice for (z, y, x), None for all
+        bigtiff:     write BigTIFF, default when larger than 4 GB
+        slab_size:   number of z-frames per slab, default shard size along z
+        read_ahead:  maximum number of slabs in flight
+        max_workers: number of threads, default read_ahead
+
+    Returns:
+        dict with shape, dtype and byte offset of pixel data in the file
+    """
+    if format not in FORMATS:
+        raise ValueError(f'Invalid format {format}. Must be one of {FORMATS}')
+    arr = img.load(resolution)
+    if region is not None and not isinstance(region, tuple):
+        region = (region,)
+    zr, yr, xr = normalize_region(region, arr.shape[2:])
+    shape = (zr.stop - zr.start, yr.stop - yr.start, xr.stop - xr.start)
+    dtype = arr.dtype.newbyteorder('<')
+    page_bytes = shape[1] * shape[2] * dtype.itemsize
+    slab_size = slab_size or (arr.shards or arr.chunks)[2]
+
+    path = Path(path)
+    if 'raw' == format:
+        header, data_offset = b'', 0
+    else:
+        description = _ome_xml(img, arr, resolution, stack, channel, shape, dtype)
+        if bigtiff is None:
+            bigtiff = len(description) + shape[0] * (page_bytes + 512) > 2**32 - 2**16
+        header, data_offset = _tiff_header(shape, dtype, description, bigtiff)
+
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o666)
+    try:
+        os.ftruncate(fd, data_offset + shape[0] * page_bytes)
+        _pwrite(fd, header, 0)
+
+        def export_slab(z0):
+            z1 = min(z0 + slab_size, shape[0])
+            slab = arr[stack:stack+1, channel:channel+1,
+                       zr.start+z0:zr.start+z1, yr, xr]
+            slab = numpy.ascontiguousarray(slab, dtype=dtype)
+            _pwrite(fd, memoryview(slab).cast('B'), data_offset + z0 * page_bytes)
+
+        # bounded in flight slabs keep memory to read_ahead slabs,
+        # within the memory budget
+        slots = threading.BoundedSemaphore(read_ahead)
+        def submit(pool, z0):
+            nbytes = (min(z0 + slab_size, shape[0]) - z0) * page_bytes
+            slots.acquire()
+            budget.acquire(nbytes)
+            def done(_):
+                budget.release(nbytes)
+                slots.release()
+            f = pool.submit(export_slab, z0)
+            f.add_done_callback(done)
+            return f
+
+        with ThreadPoolExecutor(max_workers=max_workers or read_ahead) as pool:
+            futures = [submit(pool, z0) for z0 in range(0, shape[0], slab_size)]
+            for f in futures:
+                f.result()
+    finally:
+        os.close(fd)
+
+    return {'shape': shape, 'dtype': dtype.str, 'offset': data_offset}
+
+
+def _pwrite(fd:int, data, offset:int):
+    """
+    Private function to write all of data at offset
+    """
+    data = memoryview(data)
+    while len(data):
+        n = os.pwrite(fd, data, offset)
+        data = data[n:]
+        offset += n
+
+
+def _tiff_header(shape:tuple, dtype:numpy.dtype, description:str, bigtiff:bool):
+    """
+    Private function to build the TIFF header and all IFDs of an
+    uncompressed little endian (Big)TIFF, one strip per page, with pixel
+    data of all pages following contiguously
+
+    Returns:
+        tuple of (header bytes, offset of pixel data)
+    """
+    n_z, n_y, n_x = shape
+    page_bytes = n_y * n_x * dtype.itemsize
+    if dtype.kind not in _SAMPLE_FORMAT:
+        raise ValueError(f'Data type {dtype} is not supported by TIFF.')
+    desc = description.encode('utf-8') + b'\0'
+
+    if bigtiff:
+        head_size, entry_fmt, count_fmt, off_fmt, off_type = 16, '<HHQQ', '<Q', '<Q', 16
+    else:
+        head_size, entry_fmt, count_fmt, off_fmt, off_type = 8, '<HHII', '<H', '<I', 4
+    entry_size = struct.calcsize(entry_fmt)
+    count_size = struct.calcsize(count_fmt)
+    off_size = struct.calcsize(off_fmt)
+
+    def entries(page, data_offset=0):
+        # (tag, type, count, value) sorted by tag, SHORT=3, LONG=4, ASCII=2
+        e = [(256, 4, 1, n_x), (257, 4, 1, n_y), (258, 3, 1, dtype.itemsize * 8),
+             (259, 3, 1, 1), (262, 3, 1, 1)]
+        if 0 == page:
+            e.append((270, 2, len(desc), head_size))
+        e += [(273, off_type, 1, data_offset + page * page_bytes), (277, 3, 1, 1),
+              (278, 4, 1, n_y), (279, off_type, 1, page_bytes),
+              (339, 3, 1, _SAMPLE_FORMAT[dtype.kind])]
+        return e
+
+    def ifd_size(page):
+        return count_size + len(entries(page)) * entry_size + off_size
+
+    ifd_offset = head_size + len(desc) + len(desc) % 2
+    ifd_offsets = []
+    for page in range(n_z):
+        ifd_offsets.append(ifd_offset)
+        ifd_offset += ifd_size(page)
+    data_offset = ifd_offset + (-ifd_offset) % 16
+
+    if bigtiff:
+        out = [b'II', struct.pack('<HHHQ', 43, 8, 0, ifd_offsets[0] if n_z else 0)]
+    else:
+        out = [b'II', struct.pack('<HI', 42, ifd_offsets[0] if n_z else 0)]
+    out.append(desc + b'\0' * (len(desc) % 2))
+    for page in range(n_z):
+        e = entries(page, data_offset)
+        out.append(struct.pack(count_fmt, len(e)))
+        for tag, typ, count, value in e:
+            out.append(struct.pack(entry_fmt, tag, typ, count, value))
+        next_ifd = ifd_offsets[page + 1] if page + 1 < n_z else 0
+        out.append(struct.pack(off_fmt, next_ifd))
+    out.append(b'\0' * (data_offset - ifd_offset))
+    header = b''.join(out)
+    return header, data_offset
+
+
+def _ome_xml(img, arr, resolution:str, stack:int, channel:int,
+             shape:tuple, dtype:numpy.dtype):
+    """
+    Private function to build OME-XML describing the exported volume
+
+    Returns:
+        str
+    """
+    size = {}
+    try:
+        ms = img.attrs['ome']['multiscales'][0]
+        scale = ms.get('coordinateTransformations', [{}])[0].get('scale', [1.0] * 5)
+        for d in ms['datasets']:
+            if d['path'] == str(resolution):
+                scale = [a * b for a, b in zip(scale, d['coordinateTransformations'][0]['scale'])]
+        size = {'Z': scale[2], 'Y': scale[3], 'X': scale[4]}
+        name = ms.get('name', PurePosixPath(img.key).stem)
+    except (KeyError, IndexError):
+        name = PurePosixPath(img.key).stem
+    try:
+        ch_name = img.attrs['visor']['channels'][channel]['wavelength']
+    except (KeyError, IndexError):
+        ch_name = str(channel)
+    # physical sizes are in micrometer, the OME default unit
+    physical = ''.join(f' PhysicalSize{a}="{size[a]}"' for a in ('X', 'Y', 'Z') if a in size)
+    pixel_type = {'float32': 'float', 'float64': 'double'}.get(dtype.name, dtype.name)
+    return (
+        '<?xml version="1.0" encoding="UTF-8"?>'
+        '<OME xmlns="http://www.openmicroscopy.org/Schemas/OME/2016-06">'
+        f'<Image ID="Image:0" Name={quoteattr(f"{name}_{stack}_{channel}")}>'
+        f'<Pixels ID="Pixels:0" DimensionOrder="XYZCT" Type="{pixel_type}"'
+        f' SizeX="{shape[2]}" SizeY="{shape[1]}" SizeZ="{shape[0]}" SizeC="1" SizeT="1"'
+        f' BigEndian="false"{physical}>'
+        f'<Channel ID="Channel:0:0" Name={quoteattr(ch_name)} SamplesPerPixel="1"/>'
+        f'<TiffData IFD="0" PlaneCount="{shape[0]}"/>'
+        '</Pixels></Image></OME>'
+    )
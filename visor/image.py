@@ -1,41 +1,77 @@
 from pathlib import Path
+import contextlib
+import json
 import zarr
 import zarrs
 zarr.config.set({"codec_pipeline.path": "zarrs.ZarrsCodecPipeline"})
 from zarr.codecs import BytesCodec
 import numpy
+from .access import RecordedArray, RecordedPipelineArray, log_path, unwrap
+from .appender import Appender
+from .blocks import BlockIterator, BlockWriter
+from .checksum import record_shards, record_image, verify_image
+from .export import export_image
+from .pipeline import Pipeline, PipelineArray
+from .sampling import sample_points
+from .lock import FileLock, lock_all, lock_dir
+from .shard import normalize_region, shards_in_region, shard_key
+from .storage import Storage, open_storage
+from .consolidate import consolidate_image, sync_image
 
 class Image:
 
-    def __init__(self, vsr_path:str|Path,
+    def __init__(self, vsr_path:str|Path|Storage,
                  image_type:str, image_name:str, create=False):
         """
         Constructor of Image
 
         Parameters:
-            vsr_path:   path to the .vsr file
+            vsr_path:   path or url to the .vsr file, or its Storage,
+                        see visor.storage.open_storage
             image_type: image type, see vsr.info()['image_types']
             image_name: image name, see vsr.images()
             create:     boolean
         """
-        vsr_path = Path(vsr_path)
+        storage = open_storage(vsr_path)
         # Validate vsr path
-        if vsr_path.suffix != '.vsr':
-            raise ValueError(f'The path {vsr_path} is not valid, must contain .vsr extension.')
-        if not vsr_path.exists() or not vsr_path.is_dir():
-            raise NotADirectoryError(f'The path {vsr_path} is not a directory.')
-        
-        image_path = vsr_path/f'visor_{image_type}_images'/f'{image_name}.zarr'
+        if not storage.name.endswith('.vsr'):
+            raise ValueError(f'The path {storage.path()} is not valid, must contain .vsr extension.')
+        if not storage.is_dir():
+            raise NotADirectoryError(f'The path {storage.path()} is not a directory.')
+
+        key = f'visor_{image_type}_images/{image_name}.zarr'
         if create:
-            image_path.mkdir(parents=True, exist_ok=True)
-        if not image_path.exists() or not image_path.is_dir():
-            raise NotADirectoryError(f'The path {image_path} is not a directory.')
+            storage.mkdir(key)
+        elif not storage.is_dir(key):
+            raise NotADirectoryError(f'The path {storage.path(key)} is not a directory.')
 
-        self.path   = image_path
-        self.zgroup = zarr.open_group(image_path)
+        self.storage = storage
+        self.key    = key
+        self.path   = storage.path(key)
+        self.zgroup = self._open_group()
         self.attrs  = self.zgroup.attrs.asdict()
 
 
+    def _open_group(self):
+        return zarr.open_group(self.storage.zarr_store(self.key),
+                               mode='r' if self.storage.read_only else 'a')
+
+
+    def _local(self, feature:str):
+        """
+        Private method to get the local path of the image for features
+        relying on filesystem locks and files, raise ValueError on other
+        storage, see Storage.local_only_error()
+
+        Returns:
+            Path
+        """
+        path = self.storage.local_path(self.key)
+        if path is None:
+            raise self.storage.local_only_error(feature)
+        return path
+
+
     def label_to_index(self, filter_type:str, filter_label:str):
         """
         Get index from label of filter stack/channel
@@ -65,29 +101,36 @@ class Image:
             raise ValueError(f'Invalid filter {filter_type}. Must be stack or channel')
 
 
-    def load(self, resolution:str):
+    def load(self, resolution:str, pipeline:Pipeline=None):
         """
         Load array by resolution
 
         Parameters:
             resolution: resolution level, see vsr.images()
+            pipeline:   visor.Pipeline applied to each block while reading
 
         Returns:
-            zarr.Array
+            visor.image.ImageArray, a zarr.Array journaling checksums of
+            shards written through it, or visor.pipeline.PipelineArray if
+            pipeline is given, both logging reads while recording
         """
-
-        return self.zgroup[str(resolution)]
+        arr = self.zgroup[str(resolution)]
+        if pipeline is None:
+            return ImageArray(arr, self, resolution)
+        if log_path() is not None:
+            return RecordedPipelineArray(arr, pipeline, self, resolution)
+        return PipelineArray(arr, pipeline)
 
 
     def save(
-            self, arr:numpy.ndarray, resolution:str, dtype:str,
+            self, arr:numpy.ndarray|None, resolution:str, dtype:str,
             shape:tuple, shard_size:tuple, chunk_size:tuple,
             compressors:BytesCodec):
         """
         Create a zarr array
 
         Parameters:
-            arr:         the array to save
+            arr:         the array to save, None to only create the array
             resolution:  resolution level, see vsr.images()
             dtype:       zarr array dtype
             shape:       zarr array shape
@@ -96,15 +139,15 @@ class Image:
             compressors: zarr array compressors
 
         Returns:
-            zarr.Array
+            visor.image.ImageArray
         """
 
-        array_path = self.path/str(resolution)
+        array_key = f'{self.key}/{resolution}'
 
-        if array_path.is_dir():
-            raise FileExistsError(f'The array {array_path} already exist.')
+        if self.storage.is_dir(array_key):
+            raise FileExistsError(f'The array {self.storage.path(array_key)} already exist.')
         zarr.create_array(
-            store=self.path,
+            store=self.storage.zarr_store(self.key),
             name=str(resolution),
             dtype=dtype,
             shape=shape,
@@ -112,15 +155,373 @@ class Image:
             chunks=chunk_size,
             compressors=compressors,
         )
+        sync_image(self.storage, self.key)
+        self.zgroup = self._open_group()
+        if arr is not None:
+            self.write(arr, resolution)
+
+        return self.load(resolution)
+
+
+    def write(self, arr:numpy.ndarray, resolution:str,
+              region:tuple=None, lock:bool=False):
+        """
+        Write array data into a region of an existing zarr array
+
+        Concurrent writers must not write into the same shard, either plan
+        disjoint shards with visor.shard.assign_shards, or set lock to
+        serialize writes to shards they share. On local storage, written
+        shards are hashed right after writing and journaled for verify().
+
+        Parameters:
+            arr:        the array to write, with all dimensions of the region
+            resolution: resolution level, see vsr.images()
+            region:     tuple of int or slice per dimension, None for all
+            lock:       lock the shards touched by region while writing
+        """
+        zarr_arr = unwrap(self.load(resolution))
+        region = normalize_region(region, zarr_arr.shape)
+        shards = shards_in_region(zarr_arr, region)
+        local = self.storage.local_path(self.key)
+        with lock_all(self._shard_lock_paths(resolution, shards) if lock else []):
+            zarr_arr[region] = arr
+            if local is not None:
+                record_shards(local, resolution, [shard_key(s) for s in shards])
+
+
+    def open_appender(self, resolution:str, stack:int|str, channel:int|str,
+                      start:int=0, lock:bool=False):
+        """
+        Open an appender to write z-frames of a stack and channel as they
+        arrive, growing the z extent of the array on the fly
+
+        The array must exist, create it with save(None, ...) and a shape
+        with 0 frames along z, e.g. (n_stacks, n_channels, 0, y, x).
+
+        Parameters:
+            resolution: resolution level, see vsr.images()
+            stack:      visor_stack index or label
+            channel:    channel index or label (wavelength)
+            start:      z index of the first frame, aligned to shards
+            lock:       lock shards while writing, required when shards
+                        span several stacks or channels being appended
+
+        Returns:
+            visor.appender.Appender
+        """
+        self._local('Appending')
+        if isinstance(stack, str):
+            stack = self.label_to_index('stack', stack)
+        if isinstance(channel, str):
+            channel = self.label_to_index('channel', channel)
+        return Appender(self, resolution, stack, channel, start=start, lock=lock)
+
+
+    def iter_blocks(self, resolution:str, block_shape:tuple=None, halo:int|tuple=0,
+                    stack:int|str=0, channel:int|str=0, boundary:str|None='reflect',
+                    prefetch:int=4, cache_chunks:int=256, max_workers:int=None):
+        """
+        Iterate shard-aligned (z,y,x) core blocks of a stack and channel,
+        each with a halo of neighbouring voxels, e.g. for filters
+
+        Halos are served from recently decoded chunks of neighbouring
+        blocks, and the next blocks are prefetched in parallel. Write
+        results back with open_block_writer(), which drops the halo.
+
+        Parameters:
+            resolution:   resolution level, see vsr.images()
+            block_shape:  (z,y,x) core shape, multiple of the shard shape,
+                          None for the shard shape
+            halo:         voxels added on each side, int or (z,y,x)
+            stack:        visor_stack index or label
+            channel:      channel index or label (wavelength)
+            boundary:     fill of the halo outside the array, 'reflect',
+                          'edge' or 'constant' (0), None to clip it
+            prefetch:     number of blocks assembled ahead
+            cache_chunks: maximum number of cached chunks
+            max_workers:  number of threads
+
+        Returns:
+            visor.blocks.BlockIterator of visor.blocks.Block
+        """
+        if isinstance(stack, str):
+            stack = self.label_to_index('stack', stack)
+        if isinstance(channel, str):
+            channel = self.label_to_index('channel', channel)
+        return BlockIterator(self.load(resolution), block_shape, halo, stack, channel,
+                             boundary=boundary, prefetch=prefetch, cache_chunks=cache_chunks,
+                             max_workers=max_workers)
+
+
+    def open_block_writer(self, resolution:str, max_pending:int=4, max_workers:int=None):
+        """
+        Open a writer of blocks from iter_blocks() of another image, the
+        halo is dropped and cores are written on background threads
+
+        The array must exist with the (z,y,x) shape of the source, create
+        it with save(None, ...).
+
+        Parameters:
+            resolution:  resolution level, see vsr.images()
+            max_pending: maximum number of blocks waiting to be written
+            max_workers: number of threads
+
+        Returns:
+            visor.blocks.BlockWriter
+        """
+        return BlockWriter(self, resolution, max_pending=max_pending, max_workers=max_workers)
+
+
+    def sample_points(self, coords:numpy.ndarray, resolution:str,
+                      stacks:list=None, channels:list=None, interp:str='nearest'):
+        """
+        Sample intensities at many voxel coordinates, decoding each needed
+        chunk once
+
+        Parameters:
+            coords:     (n, 3) z,y,x voxel coordinates at the resolution
+            resolution: resolution level, see vsr.images()
+            stacks:     visor_stack indices or labels, None for all
+            channels:   channel indices or labels, None for all
+            interp:     'nearest' or 'linear'
+
+        Returns:
+            numpy.ndarray (n, len(stacks), len(channels)) in the order of
+            coords, 0 for points outside the array
+        """
+        arr = self.load(resolution)
+        stacks = range(arr.shape[0]) if stacks is None else \
+            [self.label_to_index('stack', s) if isinstance(s, str) else s for s in stacks]
+        channels = range(arr.shape[1]) if channels is None else \
+            [self.label_to_index('channel', c) if isinstance(c, str) else c for c in channels]
+        return sample_points(arr, coords, list(stacks), list(channels), interp=interp)
+
+
+    def export(self, path:str|Path, format:str='ome-tiff',
+               stack:int|str=0, channel:int|str=0, resolution:str='0',
+               region:tuple=None, bigtiff:bool=None, read_ahead:int=2):
+        """
+        Export a stack and channel to OME-TIFF or raw, streaming z-slabs
+        with bounded memory
+
+        Parameters:
+            path:       output file path
+            format:     'ome-tiff' or 'raw' (little endian, z,y,x, no header)
+            stack:      visor_stack index or label
+            channel:    channel index or label (wavelength)
+            resolution: resolution level, see vsr.images()
+            region:     tuple of int or slice for (z, y, x), None for all
+            bigtiff:    write BigTIFF, default when larger than 4 GB
+            read_ahead: maximum number of z-slabs in flight
+
+        Returns:
+            dict with shape, dtype and byte offset of pixel data in the file
+        """
+        if isinstance(stack, str):
+            stack = self.label_to_index('stack', stack)
+        if isinstance(channel, str):
+            channel = self.label_to_index('channel', channel)
+        return export_image(self, path, format=format, stack=stack, channel=channel,
+                            resolution=resolution, region=region, bigtiff=bigtiff,
+                            read_ahead=read_ahead)
 
-        return self.zgroup[str(resolution)]
+
+    def verify(self, incremental:bool=False, processes:bool=False):
+        """
+        Verify shard files against their recorded checksums, without
+        decoding them
+
+        Parameters:
+            incremental: only re-hash shards changed since last verification
+            processes:   hash on a process pool instead of a thread pool
+
+        Returns:
+            dict with 'ok', 'recorded', 'skipped' counts and lists of
+            'missing', 'corrupt' and 'extra' shards as '{resolution}/{key}',
+            'recorded' counts shards written since the last hashing
+        """
+        return verify_image(self._local('Verifying'), incremental=incremental, processes=processes)
+
+
+    def record_checksums(self, resolution:str=None):
+        """
+        Record checksums of all shard files on disk, e.g. for images
+        written before checksums were recorded
+
+        Parameters:
+            resolution: resolution level, None for all
+        """
+        record_image(self._local('Recording checksums'), [str(resolution)] if resolution is not None else None)
+
+
+    def _shard_lock_paths(self, resolution:str, shards:list):
+        """
+        Private method to get lock file paths of shards
+
+        Parameters:
+            resolution: resolution level
+            shards:     list of shard indices
+
+        Returns:
+            list of Path
+        """
+        locks = lock_dir(self._local('Locking shards'))/str(resolution)
+        return [locks/('.'.join(str(i) for i in s) + '.lock') for s in shards]
 
     
     def update_attrs(self, attrs:dict):
         """
-        Update zarr.json attributes
+        Update zarr.json attributes, top-level keys in attrs replace those
+        on disk, other keys are kept
 
         Parameters:
             attrs: new attributes
-        """  
-        self.zgroup.attrs.update(attrs)
+        """
+        self._rewrite_attrs(lambda old: {**old, **attrs})
+
+
+    def merge_attrs(self, attrs:dict):
+        """
+        Merge attributes into zarr.json attributes, so concurrent writers
+        of different parts do not lose each other's updates. Nested dicts
+        are merged, lists of dicts with an 'index' key (e.g. visor_stacks,
+        channels) are merged by index, other values replaced.
+
+        Parameters:
+            attrs: attributes to merge
+        """
+        self._rewrite_attrs(lambda old: _merge_attrs(old, attrs))
+
+
+    def _rewrite_attrs(self, update):
+        """
+        Private method to rewrite zarr.json attributes from those currently
+        on disk under a file lock. Storage other than local has no file
+        lock, the last writer wins.
+
+        Parameters:
+            update: function of the current attributes to the new ones
+        """
+        meta_key = f'{self.key}/zarr.json'
+        local = self.storage.local_path(self.key)
+        with FileLock(lock_dir(local)/'zarr.json.lock') if local else contextlib.nullcontext():
+            meta = self.storage.read_json(meta_key)
+            meta['attributes'] = update(meta.get('attributes', {}))
+            self.storage.put(meta_key, json.dumps(meta, indent=2).encode())
+        sync_image(self.storage, self.key)
+        self.zgroup = self._open_group()
+        self.attrs  = self.zgroup.attrs.asdict()
+
+
+    def consolidate(self):
+        """
+        Write metadata of all arrays into the group zarr.json, so opening
+        the image and its arrays costs a single read. It is kept in sync
+        by save(), update_attrs() and appenders.
+        """
+        consolidate_image(self.storage, self.key)
+        self.zgroup = self._open_group()
+
+
+class ImageArray(RecordedArray):
+
+    def __init__(self, arr, image:Image, resolution:str):
+        """
+        Constructor of ImageArray, a zarr.Array from Image.load whose
+        written shards are hashed and journaled on local storage like
+        those of Image.write, see visor.checksum.record_shards
+
+        Parameters:
+            arr:        zarr.Array
+            image:      visor.Image
+            resolution: resolution level
+        """
+        super().__init__(arr, image, resolution)
+
+
+    def _record(self, region):
+        local = self.image.storage.local_path(self.image.key)
+        if local is not None:
+            record_shards(local, self.resolution, [shard_key(s) for s in shards_in_region(self, region)])
+
+
+    def set_basic_selection(self, selection, value, **kwargs):
+        super().set_basic_selection(selection, value, **kwargs)
+        self._record(_bounds(selection, self.shape))
+
+
+    def set_orthogonal_selection(self, selection, value, **kwargs):
+        super().set_orthogonal_selection(selection, value, **kwargs)
+        self._record(_bounds(selection, self.shape))
+
+
+    def set_coordinate_selection(self, selection, value, **kwargs):
+        super().set_coordinate_selection(selection, value, **kwargs)
+        self._record(_bounds(selection, self.shape))
+
+
+    def set_mask_selection(self, mask, value, **kwargs):
+        super().set_mask_selection(mask, value, **kwargs)
+        self._record(_bounds(tuple(numpy.nonzero(mask)), self.shape))
+
+
+    def set_block_selection(self, selection, value, **kwargs):
+        super().set_block_selection(selection, value, **kwargs)
+        grid = tuple(-(-n // c) for n, c in zip(self.shape, self.chunks))
+        blocks = _bounds(selection, grid)
+        self._record(None if blocks is None else
+                     tuple(slice(b.start * c, min(b.stop * c, n))
+                           for b, c, n in zip(blocks, self.chunks, self.shape)))
+
+
+def _bounds(selection, shape:tuple):
+    """
+    Private function to get the region bounding a selection of ints,
+    slices or index arrays per dimension, None (all) for other selections
+    """
+    if not isinstance(selection, tuple):
+        selection = (selection,)
+    if Ellipsis in selection:
+        i = selection.index(Ellipsis)
+        selection = selection[:i] + (slice(None),) * (len(shape) - len(selection) + 1) + selection[i+1:]
+    region = []
+    for s, n in zip(selection, shape):
+        if isinstance(s, slice):
+            index = numpy.arange(*s.indices(n))
+        else:
+            index = numpy.asarray(s)
+            if index.dtype == bool:
+                index = numpy.flatnonzero(index)
+            if not numpy.issubdtype(index.dtype, numpy.integer):
+                return None
+            index = numpy.where(index < 0, index + n, index)
+        if 0 == index.size:
+            return (slice(0, 0),) * len(shape)
+        region.append(slice(int(index.min()), int(index.max()) + 1))
+    return tuple(region)
+
+
+def _merge_attrs(base, new):
+    """
+    Private function to merge new attributes into base attributes
+
+    Parameters:
+        base: current attributes
+        new:  attributes to merge
+
+    Returns:
+        merged attributes
+    """
+    if isinstance(base, dict) and isinstance(new, dict):
+        merged = dict(base)
+        for k, v in new.items():
+            merged[k] = _merge_attrs(base[k], v) if k in base else v
+        return merged
+    if isinstance(base, list) and isinstance(new, list) and \
+            all(isinstance(i, dict) and 'index' in i for i in base + new):
+        merged = {i['index']: i for i in base}
+        for i in new:
+            merged[i['index']] = _merge_attrs(merged[i['index']], i) \
+                if i['index'] in merged else i
+        return sorted(merged.values(), key=lambda i: i['index'])
+    return new
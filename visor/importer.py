@@ -0,0 +1,355 @@
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import argparse
+import json
+import threading
+import time
+import numpy
+from zarr.codecs import BloscCodec
+from .image import Image
+from .lock import sidecar, write_atomic
+from .memory import budget
+
+class RawSource:
+
+    def __init__(self, path:str|Path, dtype:str, frame_shape:tuple, offset:int=0):
+        """
+        Constructor of RawSource, a memory-mapped dump of raw frames
+
+        Parameters:
+            path:        path to the raw file
+            dtype:       pixel dtype
+            frame_shape: (y, x) of each frame
+            offset:      header size in bytes
+        """
+        self.path = Path(path)
+        self.dtype = numpy.dtype(dtype)
+        frame_bytes = self.dtype.itemsize * int(numpy.prod(frame_shape))
+        n_frames = (self.path.stat().st_size - offset) // frame_bytes
+        shape = (max(n_frames, 0),) + tuple(frame_shape)
+        # empty files can not be memory-mapped
+        self._mm = numpy.memmap(self.path, dtype=self.dtype, mode='r', offset=offset, shape=shape) \
+            if n_frames > 0 else numpy.empty(shape, dtype=self.dtype)
+        self.shape = self._mm.shape
+
+
+    def read(self, z0:int, z1:int):
+        """
+        Read frames z0 to z1
+
+        Returns:
+            numpy.ndarray (z,y,x)
+        """
+        return numpy.array(self._mm[z0:z1])
+
+
+    def close(self):
+        self._mm = None
+
+
+class TiffSource:
+
+    def __init__(self, path:str|Path):
+        """
+        Constructor of TiffSource, a multi-page TIFF stack, requires tifffile
+
+        Parameters:
+            path: path to the TIFF file
+        """
+        try:
+            import tifffile
+        except ImportError:
+            raise ImportError('Reading TIFF requires tifffile, install it with: pip install visor-py[tiff]')
+        self.path = Path(path)
+        self._tif = tifffile.TiffFile(self.path)
+        page = self._tif.pages[0]
+        self.dtype = page.dtype
+        self.shape = (len(self._tif.pages),) + tuple(page.shape)
+        self._lock = threading.Lock()
+
+
+    def read(self, z0:int, z1:int):
+        """
+        Read pages z0 to z1
+
+        Returns:
+            numpy.ndarray (z,y,x)
+        """
+        with self._lock:
+            arr = self._tif.asarray(key=range(z0, z1))
+        return arr.reshape((z1 - z0,) + self.shape[1:])
+
+
+    def close(self):
+        self._tif.close()
+
+
+def open_source(path:str|Path, dtype:str=None, frame_shape:tuple=None, offset:int=0):
+    """
+    Open a source of frames, TIFF by extension, raw otherwise
+
+    Parameters:
+        path:        path to the source file
+        dtype:       pixel dtype, raw only
+        frame_shape: (y, x) of each frame, raw only
+        offset:      header size in bytes, raw only
+
+    Returns:
+        RawSource or TiffSource
+    """
+    path = Path(path)
+    if path.suffix.lower() in ('.tif', '.tiff'):
+        return TiffSource(path)
+    if dtype is None or frame_shape is None:
+        raise ValueError(f'Reading raw frames from {path} requires dtype and frame_shape.')
+    return RawSource(path, dtype, frame_shape, offset)
+
+
+def import_image(vsr_path:str|Path, image_name:str, sources:list,
+                 stacks:list, channels:list, image_type:str='raw', resolution:str='0',
+                 dtype:str=None, frame_shape:tuple=None, offset:int=0,
+                 voxel_size:tuple=(1.0, 1.0, 1.0), positions:list=None,
+                 shard_size:tuple=None, chunk_size:tuple=None, compressors=None,
+                 max_workers:int=None, resume:bool=True, progress=None):
+    """
+    Import TIFF stacks or raw frame dumps into a sharded VSR image
+
+    Frames are read in shard-aligned blocks along z, then compressed and
+    written through the zarrs pipeline on a thread pool. Finished blocks
+    are checkpointed in .image.zarr.visor/import/{resolution}.json beside
+    the image, so an interrupted import continues where it stopped.
+
+    Parameters:
+        vsr_path:    path to the .vsr file
+        image_name:  image name, e.g. slice_1_10x
+        sources:     paths to source files, sources[stack][channel]
+        stacks:      visor_stack labels, e.g. ['stack_1', 'stack_2']
+        channels:    channel wavelengths, or channel metadata dicts
+        image_type:  image type
+        resolution:  resolution level
+        dtype:       pixel dtype of raw sources
+        frame_shape: (y, x) of raw sources
+        offset:      header size in bytes of raw sources
+        voxel_size:  (z, y, x) voxel size in micrometer
+        positions:   visor_stack positions, one per stack
+        shard_size:  zarr array shard_size, default (1,1,64,y,x) clipped to
+                     the frames and rounded up to multiples of chunk_size
+        chunk_size:  zarr array chunk_size, default (1,1,16,256,256) clipped
+                     to the frames, or to divisors of a given shard_size
+        compressors: zarr array compressors, default Blosc zstd clevel 5
+        max_workers: number of threads
+        resume:      skip blocks finished by a previous import
+        progress:    callable(stats) called after each block
+
+    Returns:
+        dict of throughput statistics
+    """
+    if len(sources) != len(stacks) or any(len(s) != len(channels) for s in sources):
+        raise ValueError('Sources must be a list of stacks, each a list of channels.')
+    if not stacks or not channels:
+        raise ValueError('No sources to import, stacks and channels must not be empty.')
+
+    srcs = [[open_source(p, dtype=dtype, frame_shape=frame_shape, offset=offset)
+             for p in s] for s in sources]
+    try:
+        first = srcs[0][0]
+        for s in (s for st in srcs for s in st):
+            if s.shape[1:] != first.shape[1:] or s.dtype != first.dtype:
+                raise ValueError(f'Source {s.path} does not match {first.path} in frame shape or dtype.')
+        n_z = max(s.shape[0] for st in srcs for s in st)
+        if 0 == n_z or 0 in first.shape[1:]:
+            raise ValueError(f'Sources have no frames to import, got frame shape {first.shape[1:]} and {n_z} frames.')
+        shape = (len(stacks), len(channels), n_z) + first.shape[1:]
+        shard_size, chunk_size = _layout(shape, shard_size, chunk_size)
+        if compressors is None:
+            compressors = BloscCodec(cname="zstd", clevel=5)
+
+        img = Image(vsr_path, image_type=image_type, image_name=image_name, create=True)
+        if (img.path/str(resolution)).is_dir():
+            if not resume:
+                raise FileExistsError(f'The array {img.path/str(resolution)} already exist.')
+            arr = img.load(resolution)
+            if arr.shape != shape or arr.dtype != first.dtype:
+                raise ValueError(f'The array {img.path/str(resolution)} does not match sources, can not resume.')
+        else:
+            img.save(None, resolution=resolution, dtype=str(first.dtype), shape=shape,
+                     shard_size=shard_size, chunk_size=chunk_size, compressors=compressors)
+        img.update_attrs(_attrs(image_name, stacks, channels, resolution, voxel_size, positions))
+        arr = img.load(resolution)
+
+        # blocks spanning several stacks/channels share shards
+        shard_z = arr.shards[2]
+        lock = arr.shards[0] > 1 or arr.shards[1] > 1
+        done_file = sidecar(img.path)/'import'/f'{resolution}.json'
+        done = set()
+        if resume and done_file.exists():
+            with open(done_file) as f:
+                done = set(json.load(f))
+        blocks = [(st, ch, z0) for st in range(len(stacks)) for ch in range(len(channels))
+                  for z0 in range(0, srcs[st][ch].shape[0], shard_z)]
+
+        def write_block(block):
+            st, ch, z0 = block
+            src = srcs[st][ch]
+            z1 = min(z0 + shard_z, src.shape[0])
+            nbytes = (z1 - z0) * int(numpy.prod(src.shape[1:])) * src.dtype.itemsize
+            with budget.reserve(nbytes):
+                data = src.read(z0, z1)
+                img.write(data[None, None], resolution,
+                          region=(st, ch, slice(z0, z1)), lock=lock)
+            return data.nbytes
+
+        stats = {'n_blocks': len(blocks), 'n_skipped': 0, 'n_written': 0,
+                 'n_bytes': 0, 'seconds': 0.0, 'mb_per_s': 0.0}
+        todo = [b for b in blocks if _block_key(b) not in done]
+        stats['n_skipped'] = len(blocks) - len(todo)
+        done_file.parent.mkdir(parents=True, exist_ok=True)
+        t0 = time.time()
+        with ThreadPoolExecutor(max_workers=max_workers) as pool:
+            futures = {pool.submit(write_block, b): b for b in todo}
+            for f in as_completed(futures):
+                stats['n_bytes'] += f.result()
+                stats['n_written'] += 1
+                done.add(_block_key(futures[f]))
+                write_atomic(done_file, json.dumps(sorted(done)))
+                stats['seconds'] = time.time() - t0
+                stats['mb_per_s'] = stats['n_bytes'] / 2**20 / max(stats['seconds'], 1e-9)
+                if progress:
+                    progress(stats)
+        stats['seconds'] = time.time() - t0
+        stats['mb_per_s'] = stats['n_bytes'] / 2**20 / max(stats['seconds'], 1e-9)
+        return stats
+    finally:
+        for s in (s for st in srcs for s in st):
+            s.close()
+
+
+def _layout(shape:tuple, shard_size:tuple, chunk_size:tuple):
+    """
+    Private function to fill in default shard and chunk sizes, with
+    chunks always dividing shards
+    """
+    if chunk_size is None:
+        default = (1, 1, 16, 256, 256)
+        if shard_size is None:
+            chunk_size = tuple(min(c, n) for c, n in zip(default, shape))
+        else:
+            chunk_size = tuple(next(d for d in range(min(c, s), 0, -1) if 0 == s % d)
+                               for c, s in zip(default, shard_size))
+    if shard_size is None:
+        default = (1, 1, 64) + tuple(shape[3:])
+        shard_size = tuple(-(-min(s, n) // c) * c for s, n, c in zip(default, shape, chunk_size))
+    return tuple(shard_size), tuple(chunk_size)
+
+
+def _block_key(block:tuple):
+    return '.'.join(str(i) for i in block)
+
+
+def _attrs(image_name:str, stacks:list, channels:list, resolution:str,
+           voxel_size:tuple, positions:list):
+    """
+    Private function to build image attributes, see
+    https://visor-tech.github.io/visor-data-schema/
+
+    Returns:
+        dict
+    """
+    visor_stacks = []
+    for i, label in enumerate(stacks):
+        s = {'index': i, 'label': label}
+        if positions:
+            s['position'] = list(positions[i])
+        visor_stacks.append(s)
+    visor_channels = []
+    for i, c in enumerate(channels):
+        c = dict(c) if isinstance(c, dict) else {'wavelength': str(c)}
+        c['index'] = i
+        visor_channels.append(c)
+    return {
+        'ome': {
+            'version': '0.5',
+            'multiscales': [{
+                'name': image_name,
+                'axes': [
+                    {'name': 'vs', 'type': 'visor_stack'},
+                    {'name': 'ch', 'type': 'channel'},
+                    {'name': 'z', 'type': 'space', 'unit': 'micrometer'},
+                    {'name': 'y', 'type': 'space', 'unit': 'micrometer'},
+                    {'name': 'x', 'type': 'space', 'unit': 'micrometer'},
+                ],
+                'datasets': [{
+                    'path': str(resolution),
+                    'coordinateTransformations': [
+                        {'type': 'scale', 'scale': [1.0, 1.0, 1.0, 1.0, 1.0]}
+                    ],
+                }],
+                'coordinateTransformations': [
+                    {'type': 'scale', 'scale': [1.0, 1.0] + [float(v) for v in voxel_size]}
+                ],
+            }],
+        },
+        'visor': {
+            'visor_stacks': visor_stacks,
+            'channels': visor_channels,
+        },
+    }
+
+
+def main(argv:list=None):
+    """
+    Console entry point, run visor-import -h for usage
+    """
+    parser = argparse.ArgumentParser(
+        prog='visor-import',
+        description='Import TIFF stacks or raw frame dumps into a VSR image.')
+    parser.add_argument('vsr_path', help='path to the .vsr file')
+    parser.add_argument('image_name', help='image name, e.g. slice_1_10x')
+    parser.add_argument('--stacks', nargs='+', required=True, help='visor_stack labels')
+    parser.add_argument('--channels', nargs='+', required=True, help='channel wavelengths')
+    parser.add_argument('--files', nargs='+', required=True,
+                        help='source files, ordered by stack then channel')
+    parser.add_argument('--image-type', default='raw')
+    parser.add_argument('--resolution', default='0')
+    parser.add_argument('--dtype', help='pixel dtype of raw files')
+    parser.add_argument('--frame-shape', nargs=2, type=int, metavar=('Y', 'X'),
+                        help='frame shape of raw files')
+    parser.add_argument('--offset', type=int, default=0, help='header bytes of raw files')
+    parser.add_argument('--voxel-size', nargs=3, type=float, default=[1.0, 1.0, 1.0],
+                        metavar=('Z', 'Y', 'X'), help='voxel size in micrometer')
+    parser.add_argument('--shard-size', nargs=5, type=int)
+    parser.add_argument('--chunk-size', nargs=5, type=int)
+    parser.add_argument('--clevel', type=int, default=5, help='Blosc zstd level')
+    parser.add_argument('--workers', type=int, help='number of threads')
+    parser.add_argument('--no-resume', action='store_true',
+                        help='fail if the array exists instead of resuming')
+    args = parser.parse_args(argv)
+
+    n_st, n_ch = len(args.stacks), len(args.channels)
+    if len(args.files) != n_st * n_ch:
+        parser.error(f'Expect {n_st * n_ch} files for {n_st} stacks and {n_ch} channels.')
+    sources = [args.files[i*n_ch:(i+1)*n_ch] for i in range(n_st)]
+
+    def progress(stats):
+        n = stats['n_written'] + stats['n_skipped']
+        print(f"\r{n}/{stats['n_blocks']} blocks, {stats['mb_per_s']:.1f} MB/s",
+              end='', flush=True)
+
+    stats = import_image(
+        args.vsr_path, args.image_name, sources,
+        stacks=args.stacks, channels=args.channels,
+        image_type=args.image_type, resolution=args.resolution,
+        dtype=args.dtype, frame_shape=args.frame_shape, offset=args.offset,
+        voxel_size=args.voxel_size,
+        shard_size=tuple(args.shard_size) if args.shard_size else None,
+        chunk_size=tuple(args.chunk_size) if args.chunk_size else None,
+        compressors=BloscCodec(cname="zstd", clevel=args.clevel),
+        max_workers=args.workers, resume=not args.no_resume, progress=progress,
+    )
+    print('')
+    print(f"Imported {stats['n_bytes']/2**20:.1f} MB in {stats['seconds']:.1f}s "
+          f"({stats['mb_per_s']:.1f} MB/s), {stats['n_skipped']} blocks skipped.")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,419 @@
+from pathlib import Path
+import argparse
+import importlib
+import json
+import os
+import socket
+import threading
+import time
+from .image import Image
+from .lock import FileLock, write_atomic
+from .shard import normalize_region, shard_key, shard_region, shards_in_region
+from .storage import Storage
+
+# Task states, a task without state file is pending
+STATES = ('pending', 'leased', 'done', 'failed')
+
+
+def create_job(job_dir:str|Path, vsr_path:str|Path, image_name:str, resolution:str,
+               operation, image_type:str='raw', region:tuple=None,
+               shards_per_task:int=1, params:dict=None,
+               lease_seconds:float=300.0, max_attempts:int=3):
+    """
+    Partition an operation on an image array into a manifest of tasks
+    over shard-aligned regions, for workers on any node to claim
+
+    The operation is called once per shard of a task as
+        operation(image, resolution, region, **params)
+    with region a tuple of 5 slices (vs,ch,z,y,x) within one shard, so
+    writes into arrays sharded like the source never share a shard
+    between workers. It must be importable by the workers.
+
+    Parameters:
+        job_dir:         directory of the job on storage shared by workers
+        vsr_path:        path to the .vsr file, as seen by workers
+        image_name:      image name, see vsr.images()
+        resolution:      resolution level, see vsr.images()
+        operation:       'module:function', or a module level function
+        image_type:      image type
+        region:          tuple of int or slice (vs,ch,z,y,x), None for all,
+                         e.g. (1, 0) for stack 1 and channel 0
+        shards_per_task: number of consecutive shards in a task
+        params:          keyword arguments of operation, JSON serializable
+        lease_seconds:   seconds a claimed task is held without heartbeat
+        max_attempts:    attempts of a task before it is failed
+
+    Returns:
+        visor.jobs.Job
+    """
+    if shards_per_task < 1:
+        raise ValueError(f'Shards per task must be positive, got {shards_per_task}.')
+    if callable(operation):
+        operation = f'{operation.__module__}:{operation.__qualname__}'
+    _resolve(operation)
+    job_dir = Path(job_dir)
+    if (job_dir/'manifest.json').exists():
+        raise FileExistsError(f'The job {job_dir} already exist.')
+
+    vsr_path = vsr_path.url if isinstance(vsr_path, Storage) else str(vsr_path)
+    arr = Image(vsr_path, image_type=image_type, image_name=image_name).load(resolution)
+    region = normalize_region(region, arr.shape)
+    shards = shards_in_region(arr, region)
+    tasks = []
+    for i in range(0, len(shards), shards_per_task):
+        tasks.append({
+            'id':     len(tasks),
+            'shards': [[[max(a.start, r.start), min(a.stop, r.stop)]
+                        for a, r in zip(shard_region(arr, s), region)]
+                       for s in shards[i:i+shards_per_task]],
+            'keys':   [shard_key(s) for s in shards[i:i+shards_per_task]],
+        })
+    manifest = {
+        'vsr_path':      vsr_path,
+        'image_type':    image_type,
+        'image_name':    image_name,
+        'resolution':    str(resolution),
+        'operation':     operation,
+        'params':        params or {},
+        'lease_seconds': lease_seconds,
+        'max_attempts':  max_attempts,
+        'created':       time.time(),
+        'tasks':         tasks,
+    }
+    (job_dir/'tasks').mkdir(parents=True, exist_ok=True)
+    write_atomic(job_dir/'manifest.json', json.dumps(manifest, indent=2))
+    return Job(job_dir)
+
+
+class Job:
+
+    def __init__(self, job_dir:str|Path):
+        """
+        Constructor of Job, a manifest of tasks and a file-based lease
+        queue on storage shared by workers, see create_job()
+
+        The state of each task is kept in tasks/{id}.json: its lease
+        (worker and expiry time), attempts, error and checkpointed shards.
+        State changes are made under a file lock on the job directory, so
+        they are as reliable as flock on the shared filesystem. Expiry
+        times compare wall clocks, so nodes must have synchronized clocks.
+        A worker renews its leases while working, a task whose lease
+        expired, e.g. of a crashed worker, is claimed again and resumes
+        after its checkpointed shards.
+
+        Parameters:
+            job_dir: directory of the job
+        """
+        self.path = Path(job_dir)
+        manifest_file = self.path/'manifest.json'
+        if not manifest_file.exists():
+            raise FileNotFoundError(f'The job manifest {manifest_file} does not exist.')
+        with open(manifest_file) as f:
+            self.manifest = json.load(f)
+        self.tasks = self.manifest['tasks']
+
+
+    def _lock(self):
+        """
+        Private method to get a new lock of the queue, one per with block,
+        so threads of a worker (e.g. its heartbeat) never share a lock file
+        descriptor
+        """
+        return FileLock(self.path/'.locks'/'queue.lock')
+
+
+    def _state_file(self, task_id:int):
+        return self.path/'tasks'/f'{task_id}.json'
+
+
+    def _read_state(self, task_id:int):
+        try:
+            with open(self._state_file(task_id)) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {'state': 'pending', 'attempts': 0, 'shards': []}
+
+
+    def _write_state(self, task_id:int, state:dict):
+        write_atomic(self._state_file(task_id), json.dumps(state))
+
+
+    def state(self, task_id:int):
+        """
+        Get state of a task
+
+        Returns:
+            dict with 'state', see visor.jobs.STATES, 'attempts',
+            checkpointed 'shards', and 'worker', 'expires', 'error' if any
+        """
+        state = self._read_state(task_id)
+        if 'leased' == state['state'] and state['expires'] < time.time():
+            state['state'] = 'pending'
+        return state
+
+
+    def claim(self, worker:str):
+        """
+        Claim the first pending task, or a task whose lease expired
+
+        Parameters:
+            worker: worker id
+
+        Returns:
+            (task, state), or None if no task can be claimed now
+        """
+        with self._lock():
+            now = time.time()
+            for task in self.tasks:
+                state = self._read_state(task['id'])
+                if 'done' == state['state'] or 'failed' == state['state']:
+                    continue
+                if 'leased' == state['state'] and state['expires'] >= now:
+                    continue
+                if state['attempts'] >= self.manifest['max_attempts']:
+                    state.update(state='failed', error=state.get('error') or 'Lease expired.')
+                    self._write_state(task['id'], state)
+                    continue
+                state.update(state='leased', worker=worker, attempts=state['attempts'] + 1,
+                             expires=now + self.manifest['lease_seconds'])
+                self._write_state(task['id'], state)
+                return task, state
+        return None
+
+
+    def _update(self, task_id:int, worker:str, **changes):
+        """
+        Private method to change the state of a task leased by worker
+
+        Returns:
+            True if worker still holds the lease
+        """
+        with self._lock():
+            state = self._read_state(task_id)
+            if 'leased' != state['state'] or state['worker'] != worker:
+                return False
+            if 'shards' in changes:
+                changes['shards'] = sorted(set(state['shards']) | set(changes['shards']))
+            state.update(changes)
+            self._write_state(task_id, state)
+            return True
+
+
+    def renew(self, task_id:int, worker:str):
+        """
+        Extend the lease of a task
+
+        Returns:
+            True if worker still holds the lease
+        """
+        return self._update(task_id, worker, expires=time.time() + self.manifest['lease_seconds'])
+
+
+    def checkpoint(self, task_id:int, worker:str, key:str):
+        """
+        Record a shard of a task as done
+
+        Parameters:
+            task_id: task id
+            worker:  worker id
+            key:     shard key, see visor.shard.shard_key
+
+        Returns:
+            True if worker still holds the lease
+        """
+        return self._update(task_id, worker, shards=[key],
+                            expires=time.time() + self.manifest['lease_seconds'])
+
+
+    def complete(self, task_id:int, worker:str):
+        """
+        Mark a task done
+
+        Returns:
+            True if worker still holds the lease
+        """
+        return self._update(task_id, worker, state='done', expires=None)
+
+
+    def fail(self, task_id:int, worker:str, error:str):
+        """
+        Give up a task after an error, it is claimed again until
+        max_attempts is reached, then failed
+
+        Returns:
+            True if worker still holds the lease
+        """
+        with self._lock():
+            state = self._read_state(task_id)
+            if 'leased' != state['state'] or state['worker'] != worker:
+                return False
+            failed = state['attempts'] >= self.manifest['max_attempts']
+            state.update(state='failed' if failed else 'pending', expires=None, error=error)
+            self._write_state(task_id, state)
+            return True
+
+
+    def reset(self, failed_only:bool=True):
+        """
+        Make failed tasks pending again with their checkpoints kept, or
+        all unfinished tasks if failed_only is False
+        """
+        with self._lock():
+            for task in self.tasks:
+                state = self._read_state(task['id'])
+                if 'failed' == state['state'] or (not failed_only and 'done' != state['state']):
+                    state.update(state='pending', attempts=0, expires=None, error=None)
+                    self._write_state(task['id'], state)
+
+
+    def status(self):
+        """
+        Get progress of the job
+
+        Returns:
+            dict with number of tasks per state, number of shards and
+            checkpointed shards, and errors of failed tasks by task id
+        """
+        status = {s: 0 for s in STATES}
+        status.update(n_tasks=len(self.tasks), n_shards=0, n_shards_done=0, errors={})
+        for task in self.tasks:
+            state = self.state(task['id'])
+            status[state['state']] += 1
+            status['n_shards'] += len(task['keys'])
+            status['n_shards_done'] += len(task['keys']) if 'done' == state['state'] \
+                else len(state['shards'])
+            if 'failed' == state['state']:
+                status['errors'][task['id']] = state.get('error')
+        return status
+
+
+    def finished(self):
+        """
+        Check whether every task is done or failed
+        """
+        return all(self.state(t['id'])['state'] in ('done', 'failed') for t in self.tasks)
+
+
+def run_worker(job_dir:str|Path, worker:str=None, max_tasks:int=None,
+               wait:bool=True, poll:float=1.0):
+    """
+    Claim and run tasks of a job until none is left, e.g. one per node
+    or process, started as many times as needed
+
+    Shards of a task already checkpointed are skipped, the lease is
+    renewed in the background while the operation runs, and a task whose
+    lease was taken over by another worker is abandoned.
+
+    Parameters:
+        job_dir:   directory of the job
+        worker:    worker id, default {hostname}-{pid}
+        max_tasks: stop after this many tasks
+        wait:      wait for tasks leased by other workers, to take them
+                   over if their lease expires, until the job is finished
+        poll:      seconds between claims while waiting
+
+    Returns:
+        dict with number of tasks done, failed and lost, and shards
+        processed and skipped
+    """
+    job = Job(job_dir)
+    worker = worker or f'{socket.gethostname()}-{os.getpid()}'
+    m = job.manifest
+    operation = _resolve(m['operation'])
+    image = Image(m['vsr_path'], image_type=m['image_type'], image_name=m['image_name'])
+    stats = {'n_done': 0, 'n_failed': 0, 'n_lost': 0, 'n_shards': 0, 'n_skipped': 0}
+
+    while max_tasks is None or stats['n_done'] + stats['n_failed'] + stats['n_lost'] < max_tasks:
+        claimed = job.claim(worker)
+        if claimed is None:
+            if not wait or job.finished():
+                break
+            time.sleep(poll)
+            continue
+        task, state = claimed
+        lost = threading.Event()
+        stop = threading.Event()
+
+        def heartbeat():
+            while not stop.wait(m['lease_seconds'] / 3):
+                if not job.renew(task['id'], worker):
+                    lost.set()
+                    return
+
+        beat = threading.Thread(target=heartbeat, daemon=True)
+        beat.start()
+        try:
+            for key, bounds in zip(task['keys'], task['shards']):
+                if key in state['shards']:
+                    stats['n_skipped'] += 1
+                    continue
+                if lost.is_set():
+                    break
+                operation(image, m['resolution'], tuple(slice(a, b) for a, b in bounds), **m['params'])
+                stats['n_shards'] += 1
+                if not job.checkpoint(task['id'], worker, key):
+                    lost.set()
+                    break
+        except Exception as e:
+            # no renewal may race the failure
+            stop.set()
+            beat.join()
+            job.fail(task['id'], worker, f'{type(e).__name__}: {e}')
+            stats['n_failed'] += 1
+            continue
+        finally:
+            stop.set()
+            beat.join()
+        if not lost.is_set() and job.complete(task['id'], worker):
+            stats['n_done'] += 1
+        else:
+            stats['n_lost'] += 1
+    return stats
+
+
+def _resolve(operation:str):
+    """
+    Private function to import an operation from 'module:function'
+    """
+    module, _, name = operation.partition(':')
+    if not name:
+        raise ValueError(f'Invalid operation {operation}. Must be module:function')
+    obj = importlib.import_module(module)
+    for attr in name.split('.'):
+        obj = getattr(obj, attr)
+    return obj
+
+
+def main(argv:list=None):
+    """
+    Console entry point, run visor-job -h for usage
+    """
+    parser = argparse.ArgumentParser(
+        prog='visor-job',
+        description='Run or inspect a VSR job created with visor.jobs.create_job.')
+    sub = parser.add_subparsers(dest='command', required=True)
+    run = sub.add_parser('run', help='claim and run tasks until none is left')
+    run.add_argument('job_dir', help='directory of the job')
+    run.add_argument('--worker', help='worker id, default hostname-pid')
+    run.add_argument('--max-tasks', type=int, help='stop after this many tasks')
+    run.add_argument('--no-wait', action='store_true',
+                     help='exit when no task can be claimed instead of waiting for leases')
+    status = sub.add_parser('status', help='print progress of the job')
+    status.add_argument('job_dir', help='directory of the job')
+    reset = sub.add_parser('reset', help='make failed tasks pending again')
+    reset.add_argument('job_dir', help='directory of the job')
+    args = parser.parse_args(argv)
+
+    if 'run' == args.command:
+        stats = run_worker(args.job_dir, worker=args.worker, max_tasks=args.max_tasks,
+                           wait=not args.no_wait)
+        print(f"{stats['n_done']} tasks done, {stats['n_failed']} failed, {stats['n_lost']} lost, "
+              f"{stats['n_shards']} shards processed, {stats['n_skipped']} skipped.")
+    elif 'status' == args.command:
+        print(json.dumps(Job(args.job_dir).status(), indent=2))
+    else:
+        Job(args.job_dir).reset()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,228 @@
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+import itertools
+import numpy
+import zarr
+from zarr.codecs import BloscCodec
+from .image import Image
+from .memory import budget
+from .consolidate import sync_image
+from .shard import shard_grid, shard_region
+from .storage import Storage
+
+# Labels are runs of few distinct integers with constant high bytes,
+# byte shuffle groups those before zstd
+LABEL_COMPRESSORS = BloscCodec(cname='zstd', clevel=5, shuffle='shuffle')
+
+# Columns of a label index row: id, voxel count, bbox start and stop
+# (vs,ch,z,y,x), sum of voxel coordinates for the centroid
+INDEX_COLUMNS = 17
+INDEX_CHUNK = 2**16
+# Sub-group of the index arrays, one per resolution level, kept out of the
+# arrays of the multiscale group
+INDEX_GROUP = 'label_index'
+
+
+class LabelImage(Image):
+
+    def __init__(self, vsr_path:str|Path|Storage, image_name:str,
+                 image_type:str='label', create=False):
+        """
+        Constructor of LabelImage, a segmentation stored as an image group
+        of integer labels (0 is background, ids below 2**63), with a
+        per-label index of bounding box, voxel count and centroid, so a
+        label is fetched from the shards of its bounding box only
+
+        Parameters:
+            vsr_path:   path or url to the .vsr file, or its Storage
+            image_name: image name, see vsr.images()
+            image_type: image type, default visor_label_images
+            create:     boolean
+        """
+        super().__init__(vsr_path, image_type=image_type, image_name=image_name, create=create)
+        self._index = {}
+
+
+    def save(
+            self, arr:numpy.ndarray|None, resolution:str, dtype:str,
+            shape:tuple, shard_size:tuple, chunk_size:tuple,
+            compressors:BloscCodec=LABEL_COMPRESSORS):
+        """
+        Create a label array, see Image.save, with label-friendly
+        compression by default, the index is built when arr is given
+
+        Returns:
+            zarr.Array
+        """
+        if numpy.dtype(dtype).kind not in 'ui':
+            raise ValueError(f'Invalid label dtype {dtype}. Must be integer.')
+        zarr_arr = super().save(arr, resolution, dtype, shape, shard_size, chunk_size, compressors)
+        if arr is not None:
+            self.build_index(resolution)
+        return zarr_arr
+
+
+    def build_index(self, resolution:str, max_workers:int=None):
+        """
+        Build the label index of an array in one streaming pass, shards
+        are decoded and summarized in parallel and the partial summaries
+        merged, rebuild it after writing labels
+
+        Parameters:
+            resolution:  resolution level
+            max_workers: number of threads
+
+        Returns:
+            number of labels
+        """
+        arr = self.load(resolution)
+        if arr.ndim != 5:
+            raise ValueError(f'Label index requires a 5-dimensional array, got {arr.ndim}.')
+        regions = [shard_region(arr, i) for i in itertools.product(*map(range, shard_grid(arr)))]
+
+        def summarize(region):
+            with budget.reserve(4 * arr.dtype.itemsize * numpy.prod([r.stop - r.start for r in region])):
+                return _summarize(arr[region], [r.start for r in region])
+
+        with ThreadPoolExecutor(max_workers=max_workers) as pool:
+            table = _merge([t for t in pool.map(summarize, regions) if len(t)])
+
+        name = _index_name(resolution)
+        zarr.open_group(self.storage.zarr_store(self.key), path=INDEX_GROUP, mode='a')
+        zarr.create_array(
+            store=self.storage.zarr_store(self.key),
+            name=name,
+            dtype='int64',
+            shape=table.shape,
+            chunks=(max(1, min(len(table), INDEX_CHUNK)), INDEX_COLUMNS),
+            compressors=LABEL_COMPRESSORS,
+            overwrite=True,
+        )
+        sync_image(self.storage, self.key)
+        self.zgroup = self._open_group()
+        if len(table):
+            self.write(table, name)
+        self._index[str(resolution)] = table
+        return len(table)
+
+
+    def index(self, resolution:str='0'):
+        """
+        Load the label index, cached after the first load
+
+        Returns:
+            numpy.ndarray (n, 17) int64 sorted by id, columns id, count,
+            bbox start (5), bbox stop (5), coordinate sums (5)
+        """
+        resolution = str(resolution)
+        if resolution not in self._index:
+            name = _index_name(resolution)
+            if name not in self.zgroup:
+                raise FileNotFoundError(f'Label index of {self.path}/{resolution} is not built, see build_index().')
+            self._index[resolution] = self.load(name)[:]
+        return self._index[resolution]
+
+
+    def labels(self, resolution:str='0'):
+        """
+        Get label ids
+
+        Returns:
+            numpy.ndarray
+        """
+        return self.index(resolution)[:, 0]
+
+
+    def label_info(self, label:int, resolution:str='0'):
+        """
+        Get index entry of a label
+
+        Returns:
+            dict with count, bbox as tuple of slices (vs,ch,z,y,x) and
+            centroid (vs,ch,z,y,x)
+        """
+        row = self._row(label, resolution)
+        return {
+            'count':    int(row[1]),
+            'bbox':     tuple(slice(int(a), int(b)) for a, b in zip(row[2:7], row[7:12])),
+            'centroid': row[12:17] / row[1],
+        }
+
+
+    def get_label(self, label:int, resolution:str='0'):
+        """
+        Fetch the voxels of a label, only shards overlapping its bounding
+        box are decoded
+
+        Parameters:
+            label:      label id
+            resolution: resolution level
+
+        Returns:
+            (bbox, mask), bbox as tuple of slices (vs,ch,z,y,x) and a
+            boolean mask of the label within the bbox
+        """
+        bbox = self.label_info(label, resolution)['bbox']
+        return bbox, self.load(resolution)[bbox] == label
+
+
+    def _row(self, label:int, resolution:str):
+        """
+        Private method to look up the index row of a label by binary search
+        """
+        table = self.index(resolution)
+        i = numpy.searchsorted(table[:, 0], label)
+        if i == len(table) or table[i, 0] != label:
+            raise KeyError(f'Label {label} does not exist in {self.path}/{resolution}.')
+        return table[i]
+
+
+def _index_name(resolution:str):
+    return f'{INDEX_GROUP}/{resolution}'
+
+
+def _summarize(block:numpy.ndarray, origin:list):
+    """
+    Private function to summarize labels of a block
+
+    Returns:
+        numpy.ndarray (n, 17) int64, one row per label in the block
+    """
+    flat = block.ravel()
+    pos = numpy.flatnonzero(flat)
+    if 0 == len(pos):
+        return numpy.empty((0, INDEX_COLUMNS), dtype=numpy.int64)
+    order = numpy.argsort(flat[pos], kind='stable')
+    pos = pos[order]
+    ids = flat[pos]
+    starts = numpy.flatnonzero(numpy.r_[True, ids[1:] != ids[:-1]])
+    out = numpy.empty((len(starts), INDEX_COLUMNS), dtype=numpy.int64)
+    out[:, 0] = ids[starts]
+    out[:, 1] = numpy.diff(numpy.r_[starts, len(ids)])
+    for d, c in enumerate(numpy.unravel_index(pos, block.shape)):
+        c = c.astype(numpy.int64) + origin[d]
+        out[:, 2 + d] = numpy.minimum.reduceat(c, starts)
+        out[:, 7 + d] = numpy.maximum.reduceat(c, starts) + 1
+        out[:, 12 + d] = numpy.add.reduceat(c, starts)
+    return out
+
+
+def _merge(tables:list):
+    """
+    Private function to merge block summaries of the same labels
+
+    Returns:
+        numpy.ndarray (n, 17) int64 sorted by id
+    """
+    if not tables:
+        return numpy.empty((0, INDEX_COLUMNS), dtype=numpy.int64)
+    t = numpy.concatenate(tables)
+    t = t[numpy.argsort(t[:, 0], kind='stable')]
+    starts = numpy.flatnonzero(numpy.r_[True, t[1:, 0] != t[:-1, 0]])
+    out = numpy.empty((len(starts), INDEX_COLUMNS), dtype=numpy.int64)
+    out[:, 0] = t[starts, 0]
+    out[:, 1] = numpy.add.reduceat(t[:, 1], starts)
+    out[:, 2:7] = numpy.minimum.reduceat(t[:, 2:7], starts, axis=0)
+    out[:, 7:12] = numpy.maximum.reduceat(t[:, 7:12], starts, axis=0)
+    out[:, 12:17] = numpy.add.reduceat(t[:, 12:17], starts, axis=0)
+    return out
@@ -0,0 +1,154 @@
+from pathlib import Path
+import contextlib
+import fcntl
+import os
+import threading
+import time
+
+class FileLock:
+
+    def __init__(self, lock_path:str|Path, timeout:float=None, poll:float=0.01):
+        """
+        Constructor of FileLock, an exclusive advisory lock (flock) on a file
+
+        The lock is held per open file, so it excludes other processes as
+        well as other threads of the same process. It is only as reliable
+        as flock on the underlying filesystem.
+
+        Parameters:
+            lock_path: path to the lock file, created if not exist
+            timeout:   seconds to wait for the lock, None to wait forever
+            poll:      seconds between attempts when timeout is set
+        """
+        self.path = Path(lock_path)
+        self.timeout = timeout
+        self.poll = poll
+        self._fd = None
+
+
+    def acquire(self):
+        """
+        Acquire the lock, raise TimeoutError if not acquired in time
+        """
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o666)
+        try:
+            if self.timeout is None:
+                fcntl.flock(fd, fcntl.LOCK_EX)
+            else:
+                deadline = time.monotonic() + self.timeout
+                while True:
+                    try:
+                        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                        break
+                    except BlockingIOError:
+                        if time.monotonic() > deadline:
+                            raise TimeoutError(f'Timeout acquiring lock {self.path}.')
+                        time.sleep(self.poll)
+        except BaseException:
+            os.close(fd)
+            raise
+        self._fd = fd
+
+
+    def release(self):
+        """
+        Release the lock
+        """
+        if self._fd is not None:
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+            os.close(self._fd)
+            self._fd = None
+
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+
+    def __exit__(self, *exc):
+        self.release()
+
+
+@contextlib.contextmanager
+def lock_all(lock_paths:list, timeout:float=None):
+    """
+    Acquire several file locks, in sorted order to avoid deadlocks
+
+    Parameters:
+        lock_paths: list of paths to lock files
+        timeout:    seconds to wait for each lock, None to wait forever
+    """
+    with contextlib.ExitStack() as stack:
+        for p in sorted(set(Path(p) for p in lock_paths)):
+            stack.enter_context(FileLock(p, timeout=timeout))
+        yield
+
+
+def write_atomic(path:str|Path, data:str|bytes):
+    """
+    Write a file atomically: readers see either the old or the new content
+
+    Parameters:
+        path: path to the file
+        data: content to write
+    """
+    path = Path(path)
+    tmp_path = path.with_name(f'.{path.name}.{os.getpid()}.{threading.get_ident()}.tmp')
+    mode = 'wb' if isinstance(data, bytes) else 'w'
+    try:
+        with open(tmp_path, mode) as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+    finally:
+        if tmp_path.exists():
+            tmp_path.unlink()
+
+
+def sidecar(path:str|Path):
+    """
+    Get the directory holding visor's own files of a zarr group (locks,
+    import checkpoints). It sits beside the group, e.g.
+    slice_1.zarr -> .slice_1.zarr.visor, so zarr never lists its files.
+
+    Parameters:
+        path: path to the zarr group
+
+    Returns:
+        Path
+    """
+    path = Path(path)
+    return path.parent/f'.{path.name}.visor'
+
+
+def lock_dir(path:str|Path):
+    """
+    Get the directory of lock files of a path: the sidecar of a zarr
+    group, see sidecar(), or .locks inside other directories
+
+    Parameters:
+        path: path to a directory
+
+    Returns:
+        Path
+    """
+    path = Path(path)
+    return sidecar(path)/'locks' if '.zarr' == path.suffix else path/'.locks'
+
+
+def storage_lock(storage, key:str, name:str):
+    """
+    Lock a file of a storage, e.g. a metadata file rewritten by several
+    writers, on local storage. Other storage has no file lock and the
+    last writer wins.
+
+    Parameters:
+        storage: visor.storage.Storage
+        key:     key of the directory of the file
+        name:    file name
+
+    Returns:
+        FileLock, or a null context on other storage
+    """
+    local = storage.local_path(key)
+    return FileLock(lock_dir(local)/f'{name}.lock') if local else contextlib.nullcontext()
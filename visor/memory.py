@@ -0,0 +1,197 @@
+import contextlib
+import re
+import threading
+import time
+from donfig import Config
+
+# Configuration of visor, like zarr.config, e.g.
+#     visor.config.set({'memory.limit': '8GB'})
+# or environment variable VISOR_MEMORY__LIMIT=8GB
+config = Config('visor', defaults=[{
+    'memory': {
+        'limit':   None,  # bytes of decoded data in flight, int or str like '8GB', None for no limit
+        'timeout': None,  # seconds to wait for the budget, None to wait forever
+    },
+    'access': {
+        'log': None,      # local file to record selections to, see visor.access
+    },
+}])
+
+_UNITS = {'': 1, 'B': 1, 'KB': 10**3, 'MB': 10**6, 'GB': 10**9, 'TB': 10**12,
+          'KIB': 2**10, 'MIB': 2**20, 'GIB': 2**30, 'TIB': 2**40}
+
+
+def parse_bytes(value:int|str|None):
+    """
+    Parse a number of bytes
+
+    Parameters:
+        value: int, str like '512MB' or '8GiB', or None
+
+    Returns:
+        int or None
+    """
+    if value is None or isinstance(value, int):
+        return value
+    m = re.fullmatch(r'\s*([0-9.]+)\s*([a-zA-Z]*)\s*', str(value))
+    if m is None or m.group(2).upper() not in _UNITS:
+        raise ValueError(f'Invalid number of bytes {value}.')
+    return int(float(m.group(1)) * _UNITS[m.group(2).upper()])
+
+
+class MemoryBudget:
+
+    def __init__(self, limit:int|str=None):
+        """
+        Constructor of MemoryBudget, a process-wide bound of decoded data
+        in flight shared by readers, writers, caches and prefetchers
+
+        Bulk operations acquire the bytes of a block before decoding or
+        buffering it and release them when done. acquire() blocks while
+        the budget is full, caches use try_acquire() and evict (spill)
+        instead of waiting. A single request larger than the limit is
+        admitted when nothing else is in flight, so it never deadlocks.
+
+        Parameters:
+            limit: bytes, None to follow visor.config 'memory.limit'
+        """
+        self._limit = parse_bytes(limit)
+        self._cond = threading.Condition()
+        self.used = 0
+        self.peak = 0
+        self.waiting = 0
+        self.n_acquired = 0
+        self.n_waits = 0
+        self.n_refused = 0
+        self.wait_seconds = 0.0
+
+
+    @property
+    def limit(self):
+        if self._limit is not None:
+            return self._limit
+        return parse_bytes(config.get('memory.limit', None))
+
+
+    def _fits(self, nbytes:int):
+        limit = self.limit
+        return limit is None or 0 == self.used or self.used + nbytes <= limit
+
+
+    def _take(self, nbytes:int):
+        self.used += nbytes
+        self.peak = max(self.peak, self.used)
+        self.n_acquired += 1
+
+
+    def acquire(self, nbytes:int, timeout:float=None):
+        """
+        Acquire bytes, block until they fit in the budget
+
+        Parameters:
+            nbytes:  number of bytes
+            timeout: seconds to wait, default visor.config 'memory.timeout',
+                     raise TimeoutError when exceeded
+        """
+        nbytes = int(nbytes)
+        if timeout is None:
+            timeout = config.get('memory.timeout', None)
+        with self._cond:
+            if not self._fits(nbytes):
+                self.n_waits += 1
+                self.waiting += 1
+                t0 = time.monotonic()
+                try:
+                    if not self._cond.wait_for(lambda: self._fits(nbytes), timeout):
+                        raise TimeoutError(f'Timeout acquiring {nbytes} bytes of memory budget '
+                                           f'({self.used} of {self.limit} in use).')
+                finally:
+                    self.waiting -= 1
+                    self.wait_seconds += time.monotonic() - t0
+            self._take(nbytes)
+
+
+    def try_acquire(self, nbytes:int):
+        """
+        Acquire bytes if they fit in the budget now, without waiting
+
+        Returns:
+            True if acquired
+        """
+        nbytes = int(nbytes)
+        with self._cond:
+            limit = self.limit
+            if limit is not None and self.used + nbytes > limit:
+                self.n_refused += 1
+                return False
+            self._take(nbytes)
+            return True
+
+
+    def release(self, nbytes:int):
+        """
+        Release bytes acquired before
+        """
+        with self._cond:
+            self.used = max(0, self.used - int(nbytes))
+            self._cond.notify_all()
+
+
+    @contextlib.contextmanager
+    def reserve(self, nbytes:int, timeout:float=None):
+        """
+        Hold bytes of the budget in a with block
+        """
+        self.acquire(nbytes, timeout)
+        try:
+            yield
+        finally:
+            self.release(nbytes)
+
+
+    def stats(self):
+        """
+        Get live usage counters
+
+        Returns:
+            dict of limit, used, peak and available bytes, number of
+            waiting threads, acquisitions, waits and refused (spilled)
+            cache insertions, and total seconds waited
+        """
+        with self._cond:
+            limit = self.limit
+            return {
+                'limit':        limit,
+                'used':         self.used,
+                'peak':         self.peak,
+                'available':    None if limit is None else max(0, limit - self.used),
+                'waiting':      self.waiting,
+                'n_acquired':   self.n_acquired,
+                'n_waits':      self.n_waits,
+                'n_refused':    self.n_refused,
+                'wait_seconds': self.wait_seconds,
+            }
+
+
+    def reset_stats(self):
+        """
+        Reset peak and counters, e.g. between benchmark runs
+        """
+        with self._cond:
+            self.peak = self.used
+            self.n_acquired = self.n_waits = self.n_refused = 0
+            self.wait_seconds = 0.0
+
+
+# Process-wide budget used by all visor readers, writers and caches
+budget = MemoryBudget()
+
+
+def memory_usage():
+    """
+    Get live usage counters of the process-wide memory budget
+
+    Returns:
+        dict, see MemoryBudget.stats()
+    """
+    return budget.stats()
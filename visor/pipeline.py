@@ -0,0 +1,343 @@
+from concurrent.futures import ThreadPoolExecutor
+import math
+import numpy
+from .memory import budget
+from .shard import normalize_region
+
+class Pipeline:
+
+    def __init__(self, steps:tuple=()):
+        """
+        Constructor of Pipeline, a composable per-block intensity transform
+        applied while reading, e.g.
+
+            p = Pipeline().flatfield(field).window(100, 4000, out_max=255).astype('uint8').bin((1,2,2))
+
+        Each method returns a new Pipeline with the step appended.
+        Consecutive pointwise steps (astype, window, lut, map) on 8/16-bit
+        integer data are fused into a single lookup table, so each decoded
+        block is transformed in one vectorized pass.
+
+        Parameters:
+            steps: tuple of steps
+        """
+        self.steps = tuple(steps)
+        self._cache = {}
+
+
+    def astype(self, dtype:str):
+        """
+        Convert dtype, integer targets are rounded and clipped to their range
+        """
+        return Pipeline(self.steps + (_Pointwise(_astype(numpy.dtype(dtype))),))
+
+
+    def window(self, low:float, high:float, out_max:float=1.0):
+        """
+        Window/level, map [low, high] linearly to [0, out_max] and clip
+        """
+        scale = out_max / (high - low)
+        def f(x):
+            return numpy.clip((x.astype(numpy.float32) - low) * scale, 0, out_max)
+        return Pipeline(self.steps + (_Pointwise(f),))
+
+
+    def lut(self, table:numpy.ndarray):
+        """
+        Look up table, indexed by integer intensity, convert float data
+        with astype() first
+        """
+        table = numpy.asarray(table)
+        def f(x):
+            if x.dtype.kind not in 'ui':
+                raise TypeError(f'Look up tables need integer data, got {x.dtype}, add astype() before lut().')
+            return table[x]
+        return Pipeline(self.steps + (_Pointwise(f),))
+
+
+    def map(self, func):
+        """
+        Custom pointwise function, func(numpy.ndarray) -> numpy.ndarray
+        """
+        return Pipeline(self.steps + (_Pointwise(func),))
+
+
+    def flatfield(self, field:numpy.ndarray, dark:float|numpy.ndarray=0):
+        """
+        Flat-field correction (x - dark) / field
+
+        Parameters:
+            field: (y, x) array of the full image plane at the read resolution
+            dark:  dark level, scalar or (y, x) array
+        """
+        return Pipeline(self.steps + (_FlatField(field, dark),))
+
+
+    def bin(self, factors:tuple, reduce:str='mean'):
+        """
+        Bin (z, y, x) by integer factors, incomplete bins at the end are dropped
+
+        Parameters:
+            factors: (z, y, x) bin factors
+            reduce:  'mean', 'sum', 'max' or 'min'
+        """
+        return Pipeline(self.steps + (_Bin(factors, reduce),))
+
+
+    def factors(self, ndim:int):
+        """
+        Get accumulated bin factors per dimension
+
+        Returns:
+            tuple of int
+        """
+        f = [1] * ndim
+        for s in self.steps:
+            if isinstance(s, _Bin):
+                for i, b in enumerate(s.factors, ndim - len(s.factors)):
+                    f[i] *= b
+        return tuple(f)
+
+
+    def output_dtype(self, dtype:numpy.dtype):
+        """
+        Get output dtype for input dtype
+
+        Returns:
+            numpy.dtype
+        """
+        probe = tuple(max(2, b) for b in self.factors(3))
+        return self.apply(numpy.zeros(probe, dtype=dtype), tuple(slice(0, n) for n in probe)).dtype
+
+
+    def apply(self, block:numpy.ndarray, region:tuple):
+        """
+        Apply the pipeline to a decoded block
+
+        Parameters:
+            block:  numpy.ndarray, bins must not cross its edges
+            region: absolute slices of the block in the array
+
+        Returns:
+            numpy.ndarray
+        """
+        for s in self._fused(block.dtype):
+            if isinstance(s, numpy.ndarray):
+                block = numpy.take(s, block)
+                continue
+            block = s.apply(block, region)
+            if isinstance(s, _Bin):
+                f = (1,) * (len(region) - len(s.factors)) + s.factors
+                region = tuple(slice(r.start // b, r.start // b + n)
+                               for r, b, n in zip(region, f, block.shape))
+        return block
+
+
+    def _fused(self, dtype:numpy.dtype):
+        """
+        Private method to fuse runs of pointwise steps into lookup tables
+        while the data is 8/16-bit unsigned integer
+
+        Returns:
+            list of steps or lookup tables
+        """
+        key = dtype = numpy.dtype(dtype)
+        if key in self._cache:
+            return self._cache[key]
+        probe = tuple(max(2, b) for b in self.factors(3))
+
+        fused, run = [], []
+        for s in self.steps + (None,):
+            if isinstance(s, _Pointwise) and (run or (dtype.kind == 'u' and dtype.itemsize <= 2)):
+                run.append(s)
+                continue
+            if run:
+                table = numpy.arange(2 ** (8 * dtype.itemsize), dtype=dtype)
+                for r in run:
+                    table = r.apply(table, None)
+                fused.append(table)
+                dtype = table.dtype
+                run = []
+            if s is not None:
+                fused.append(s)
+                dtype = s.apply(numpy.zeros(probe, dtype=dtype),
+                                tuple(slice(0, n) for n in probe)).dtype
+        self._cache[key] = fused
+        return fused
+
+
+    def read(self, arr, region:tuple=None, max_workers:int=None):
+        """
+        Read a region of an array through the pipeline, block by block
+
+        Blocks follow the shard grid, they are decoded and transformed on
+        a thread pool and written into the output, so the full-precision
+        array is never materialized. Decoded blocks are held against the
+        memory budget, see visor.memory.
+
+        Parameters:
+            arr:         zarr.Array
+            region:      tuple of int or slice per dimension, None for all,
+                         int dimensions are dropped like numpy indexing
+            max_workers: number of threads
+
+        Returns:
+            numpy.ndarray
+        """
+        if region is not None and not isinstance(region, tuple):
+            region = (region,)
+        squeeze = tuple(i for i, r in enumerate(region or ()) if not isinstance(r, slice))
+        region = normalize_region(region, arr.shape)
+        f = self.factors(arr.ndim)
+        for i in squeeze:
+            if f[i] != 1:
+                raise ValueError(f'Can not bin the indexed dimension {i}.')
+
+        out_shape = tuple((r.stop - r.start) // b for r, b in zip(region, f))
+        out = numpy.empty(out_shape, dtype=self.output_dtype(arr.dtype))
+        blocks = _blocks(region, arr.shards or arr.chunks, f)
+
+        def read_block(block):
+            with budget.reserve(math.prod(b.stop - b.start for b in block) * arr.dtype.itemsize):
+                data = self.apply(arr[block], block)
+                dst = tuple(slice((b.start - r.start) // k, (b.start - r.start) // k + n)
+                            for b, r, k, n in zip(block, region, f, data.shape))
+                out[dst] = data
+
+        if all(n > 0 for n in out_shape):
+            with ThreadPoolExecutor(max_workers=max_workers) as pool:
+                list(pool.map(read_block, blocks))
+        return out.squeeze(axis=squeeze) if squeeze else out
+
+
+class PipelineArray:
+
+    def __init__(self, arr, pipeline:Pipeline):
+        """
+        Constructor of PipelineArray, a zarr.Array read through a Pipeline
+
+        Parameters:
+            arr:      zarr.Array
+            pipeline: Pipeline
+        """
+        self.array = arr
+        self.pipeline = pipeline
+        f = pipeline.factors(arr.ndim)
+        self.shape = tuple(n // b for n, b in zip(arr.shape, f))
+        self.dtype = pipeline.output_dtype(arr.dtype)
+        self.ndim = arr.ndim
+
+
+    def __getitem__(self, region):
+        """
+        Read a region, given in coordinates of the output like shape, bins
+        start at the origin of the source array
+
+        Parameters:
+            region: tuple of int or slice (step 1) per dimension,
+                    int dimensions are dropped like numpy indexing
+
+        Returns:
+            numpy.ndarray
+        """
+        if not isinstance(region, tuple):
+            region = (region,)
+        squeeze = tuple(i for i, r in enumerate(region) if not isinstance(r, slice))
+        out = self.pipeline.read(self.array, self.source_region(region))
+        return out.squeeze(axis=squeeze) if squeeze else out
+
+
+    def source_region(self, region):
+        """
+        Get the region of the source array read for a region of the output
+
+        Parameters:
+            region: tuple of int or slice (step 1) per dimension
+
+        Returns:
+            tuple of slice
+        """
+        f = self.pipeline.factors(self.ndim)
+        return tuple(slice(r.start * b, r.stop * b)
+                     for r, b in zip(normalize_region(region, self.shape), f))
+
+
+class _Pointwise:
+
+    def __init__(self, func):
+        self.func = func
+
+    def apply(self, block, region):
+        return self.func(block)
+
+
+class _FlatField:
+
+    def __init__(self, field, dark):
+        self.field = numpy.asarray(field, dtype=numpy.float32)
+        self.dark = numpy.asarray(dark, dtype=numpy.float32)
+
+    def apply(self, block, region):
+        ys, xs = region[-2:]
+        dark = self.dark[ys, xs] if self.dark.ndim == 2 else self.dark
+        out = block.astype(numpy.float32)
+        out -= dark
+        out /= self.field[ys, xs]
+        return out
+
+
+class _Bin:
+
+    def __init__(self, factors, reduce):
+        self.factors = tuple(int(f) for f in factors)
+        if reduce not in ('mean', 'sum', 'max', 'min'):
+            raise ValueError(f'Invalid reduce {reduce}. Must be mean, sum, max or min')
+        self.reduce = reduce
+
+    def apply(self, block, region):
+        f = (1,) * (block.ndim - len(self.factors)) + self.factors
+        n = tuple(s // b for s, b in zip(block.shape, f))
+        block = block[tuple(slice(0, k * b) for k, b in zip(n, f))]
+        shape = [d for k, b in zip(n, f) for d in (k, b)]
+        axes = tuple(range(1, 2 * block.ndim, 2))
+        if 'mean' == self.reduce:
+            return block.reshape(shape).mean(axis=axes, dtype=numpy.float32)
+        return getattr(block.reshape(shape), self.reduce)(axis=axes)
+
+
+def _astype(dtype:numpy.dtype):
+    def f(x):
+        if dtype.kind in 'ui' and x.dtype.kind == 'f':
+            info = numpy.iinfo(dtype)
+            return numpy.clip(numpy.rint(x), info.min, info.max).astype(dtype)
+        if dtype.kind in 'ui' and x.dtype.kind in 'ui' and not numpy.can_cast(x.dtype, dtype):
+            # clip to the range both dtypes hold, integers out of the target range would wrap
+            info, src = numpy.iinfo(dtype), numpy.iinfo(x.dtype)
+            return numpy.clip(x, max(info.min, src.min), min(info.max, src.max)).astype(dtype)
+        return x.astype(dtype)
+    return f
+
+
+def _blocks(region:tuple, shards:tuple, factors:tuple):
+    """
+    Private function to split a region into blocks along the shard grid,
+    with edges moved down so that bins never cross them
+
+    Returns:
+        list of tuples of slices
+    """
+    edges = []
+    for r, s, f in zip(region, shards, factors):
+        e = {r.start, r.stop}
+        for b in range(math.ceil((r.start + 1) / s) * s, r.stop, s):
+            e.add(r.start + (b - r.start) // f * f)
+        edges.append(sorted(e))
+    return [tuple(slice(a, b) for a, b in block)
+            for block in _product([list(zip(e[:-1], e[1:])) for e in edges])]
+
+
+def _product(lists:list):
+    out = [()]
+    for l in lists:
+        out = [o + (i,) for o in out for i in l]
+    return out
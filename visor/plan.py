@@ -0,0 +1,262 @@
+import math
+import numpy
+from zarr.codecs import Crc32cCodec
+from .memory import budget
+from .shard import normalize_region, shard_key, shards_in_region
+from .util import level_scale
+
+AXES = ('vs', 'ch', 'z', 'y', 'x')
+
+# Suggest a coarser resolution when it fetches this many times fewer bytes
+COARSER_RATIO = 4
+# Suggest slabs when decoding this many times the requested bytes
+AMPLIFICATION = 2.0
+# Byte offset and length of an empty inner chunk in a shard index
+_EMPTY = 2**64 - 1
+
+
+def locality_ids(chunk_index:numpy.ndarray, chunk_shape:tuple, shard_shape:tuple, shape:tuple):
+    """
+    Get ids of chunks ordering them shard by shard, and by position in
+    the shard within a shard, so reads sorted by id stay local on disk
+
+    Parameters:
+        chunk_index: (n, d) chunk indices
+        chunk_shape: chunk shape
+        shard_shape: shard shape, multiple of chunk_shape
+        shape:       array shape
+
+    Returns:
+        numpy.ndarray (n,) int64
+    """
+    chunk_index = numpy.asarray(chunk_index, dtype=numpy.int64).reshape(-1, len(shape))
+    per_shard = numpy.array(shard_shape) // numpy.array(chunk_shape)
+    grid = tuple(-(-numpy.array(shape) // numpy.array(shard_shape)))
+    shard = numpy.ravel_multi_index(tuple((chunk_index // per_shard).T), grid)
+    inner = numpy.ravel_multi_index(tuple((chunk_index % per_shard).T), tuple(per_shard))
+    return shard * int(numpy.prod(per_shard)) + inner
+
+
+def index_size(arr):
+    """
+    Get bytes of the shard index of a sharded array, offset and length
+    per inner chunk plus the crc32c checksum if any
+
+    Parameters:
+        arr: sharded zarr.Array
+
+    Returns:
+        int
+    """
+    codec = arr.metadata.codecs[0]
+    n = math.prod(s // c for s, c in zip(arr.shards, arr.chunks))
+    return 16 * n + (4 if any(isinstance(c, Crc32cCodec) for c in codec.index_codecs) else 0)
+
+
+def shard_sizes(storage, array_key:str, arr, shards:list):
+    """
+    Get compressed sizes of the inner chunks of shards from their shard
+    index, the indices are read concurrently as byte ranges
+
+    Parameters:
+        storage:   visor.storage.Storage of the image
+        array_key: key of the array, e.g. visor_raw_images/slice_1.zarr/0
+        arr:       sharded zarr.Array
+        shards:    list of shard indices
+
+    Returns:
+        list of numpy.ndarray of the inner chunk grid of a shard, with
+        bytes per inner chunk and 0 for empty chunks, or None for shards
+        not on storage
+    """
+    codec = arr.metadata.codecs[0]
+    per_shard = tuple(s // c for s, c in zip(arr.shards, arr.chunks))
+    n = math.prod(per_shard)
+    size = index_size(arr)
+    at_end = 'end' == getattr(codec.index_location, 'value', codec.index_location)
+    requests = [(f'{array_key}/{shard_key(s)}', -size if at_end else 0, None if at_end else size)
+                for s in shards]
+    sizes = []
+    for data in storage.get_ranges(requests):
+        if data is None:
+            sizes.append(None)
+            continue
+        index = numpy.frombuffer(data, dtype='<u8', count=2 * n).reshape(per_shard + (2,))
+        sizes.append(numpy.where(index[..., 1] == _EMPTY, 0, index[..., 1]).astype(numpy.int64))
+    return sizes
+
+
+def plan_read(image, resolution:str, region:tuple=None, alternatives:bool=True):
+    """
+    Plan the read of a region from shard and chunk grids and shard indices,
+    without decoding any chunk
+
+    Parameters:
+        image:        visor.Image
+        resolution:   resolution level
+        region:       tuple of int or slice per dimension, None for all
+        alternatives: also plan the region at coarser resolutions
+
+    Returns:
+        dict with the region, requested, compressed (chunks and shard
+        indices) and decoded bytes, read amplification (decoded over
+        requested bytes), number of shards, chunks and storage requests,
+        'shards' touched in locality order with their chunks and bytes,
+        'split' into shard-aligned sub-regions in the same order,
+        'alternatives' at coarser resolutions and 'suggestions'
+    """
+    resolution = str(resolution)
+    arr = image.load(resolution)
+    region = normalize_region(region, arr.shape)
+    requested = math.prod(r.stop - r.start for r in region) * arr.dtype.itemsize
+    chunk_bytes = math.prod(arr.chunks) * arr.dtype.itemsize
+    shards = shards_in_region(arr, region)
+    plan = {
+        'resolution':       resolution,
+        'region':           region,
+        'shape':            tuple(r.stop - r.start for r in region),
+        'dtype':            str(arr.dtype),
+        'shard_shape':      tuple(arr.shards or arr.chunks),
+        'chunk_shape':      tuple(arr.chunks),
+        'requested_bytes':  requested,
+        'n_shards':         len(shards),
+        'n_chunks':         0,
+        'n_chunks_empty':   0,
+        'compressed_bytes': 0,
+        'index_bytes':      0,
+        'decoded_bytes':    0,
+        'n_requests':       0,
+        'shards':           [],
+        'split':            [],
+    }
+
+    sizes = shard_sizes(image.storage, f'{image.key}/{resolution}', arr, shards) \
+        if arr.shards else [None] * len(shards)
+    outer = arr.shards or arr.chunks
+    for s, sz in zip(shards, sizes):
+        # chunks of the shard touched by region, C order is storage order
+        sub = tuple(slice(max(r.start, i * o), min(r.stop, (i + 1) * o))
+                    for r, i, o in zip(region, s, outer))
+        ranges = [range((b.start - i * o) // c, (b.stop - 1 - i * o) // c + 1)
+                  for b, i, o, c in zip(sub, s, outer, arr.chunks)]
+        inner = numpy.stack(numpy.meshgrid(*ranges, indexing='ij'), axis=-1).reshape(-1, len(s))
+        entry = {'shard': s, 'key': shard_key(s), 'n_chunks': len(inner), 'compressed_bytes': 0}
+        if arr.shards is None:
+            # unsharded, each chunk is an object of unknown size
+            entry['compressed_bytes'] = None
+            plan['n_requests'] += 1
+            plan['decoded_bytes'] += chunk_bytes
+        elif sz is None:
+            plan['n_chunks_empty'] += len(inner)
+            entry['n_chunks'] = 0
+        else:
+            nbytes = sz[tuple(inner.T)]
+            present = int(numpy.count_nonzero(nbytes))
+            entry['compressed_bytes'] = int(nbytes.sum())
+            entry['n_chunks'] = present
+            plan['n_chunks_empty'] += len(inner) - present
+            plan['index_bytes'] += index_size(arr)
+            plan['n_requests'] += 1 + present
+            plan['decoded_bytes'] += present * chunk_bytes
+        plan['n_chunks'] += entry['n_chunks']
+        if entry['compressed_bytes'] is not None and plan['compressed_bytes'] is not None:
+            plan['compressed_bytes'] += entry['compressed_bytes']
+        else:
+            plan['compressed_bytes'] = None
+        plan['shards'].append(entry)
+        plan['split'].append(sub)
+    plan['amplification'] = plan['decoded_bytes'] / requested if requested else 0.0
+
+    plan['alternatives'] = _coarser(image, resolution, region) if alternatives else []
+    plan['suggestions'] = _suggest(plan)
+    return plan
+
+
+def _coarser(image, resolution:str, region:tuple):
+    """
+    Private function to plan the region at coarser resolution levels
+    """
+    datasets = image.attrs.get('ome', {}).get('multiscales', [{}])[0].get('datasets', [])
+    if not any(d['path'] == resolution for d in datasets):
+        return []
+    scale = level_scale(image, resolution)
+    out = []
+    for d in datasets:
+        level = level_scale(image, d['path'])
+        if d['path'] == resolution or not numpy.all(level >= scale) or numpy.all(level == scale):
+            continue
+        if d['path'] not in image.zgroup:
+            continue
+        f = scale / level
+        shape = image.load(d['path']).shape
+        sub = region[:2] + tuple(
+            slice(min(n - 1, int(math.floor(r.start * k))), max(min(n, int(math.ceil(r.stop * k))), 1))
+            for r, k, n in zip(region[2:], f, shape[2:]))
+        p = plan_read(image, d['path'], sub, alternatives=False)
+        out.append({k: p[k] for k in ('resolution', 'region', 'shape', 'compressed_bytes',
+                                      'decoded_bytes', 'n_requests')} | {'scale': tuple(level / scale)})
+    return sorted(out, key=lambda p: p['decoded_bytes'])
+
+
+def _suggest(plan:dict):
+    """
+    Private function to suggest cheaper reads of a plan
+    """
+    suggestions = []
+    if plan['amplification'] > AMPLIFICATION:
+        thin = [(a, n, c) for a, n, c in zip(AXES, plan['shape'], plan['chunk_shape'])
+                if n < c and c > 1]
+        for a, n, c in thin:
+            suggestions.append(
+                f'Region is {n} voxels along {a} but chunks are {c}, so {c / n:.1f}x the data is '
+                f'decoded: read slabs of {c} along {a} once and reuse them, e.g. with '
+                f'Image.iter_blocks, or batch neighbouring requests.')
+    for alt in plan['alternatives']:
+        if plan['compressed_bytes'] and alt['compressed_bytes'] is not None and \
+                alt['compressed_bytes'] * COARSER_RATIO <= plan['compressed_bytes']:
+            suggestions.append(
+                f"Resolution {alt['resolution']} covers the region with "
+                f"{plan['compressed_bytes'] / max(alt['compressed_bytes'], 1):.1f}x fewer bytes "
+                f"at {'x'.join(f'{s:g}' for s in alt['scale'])} coarser (z,y,x) voxels.")
+            break
+    limit = budget.limit
+    if limit is not None and plan['decoded_bytes'] > limit:
+        suggestions.append(
+            f"Decoded data of {plan['decoded_bytes']} bytes exceeds the memory budget of {limit} "
+            f"bytes: read it in the {len(plan['split'])} shard-aligned parts of plan['split'].")
+    return suggestions
+
+
+def explain(plan:dict):
+    """
+    Format a read plan for humans
+
+    Returns:
+        str
+    """
+    region = ', '.join(f'{a}={r.start}:{r.stop}' for a, r in zip(AXES, plan['region']))
+    lines = [
+        f"Read of resolution {plan['resolution']} [{region}], {plan['dtype']}",
+        f"  requested:     {_bytes(plan['requested_bytes'])} {plan['shape']}",
+        f"  shards:        {plan['n_shards']} of shape {plan['shard_shape']}",
+        f"  chunks:        {plan['n_chunks']} of shape {plan['chunk_shape']}, "
+        f"{plan['n_chunks_empty']} empty",
+        f"  fetched:       {_bytes(plan['compressed_bytes'])} compressed + "
+        f"{_bytes(plan['index_bytes'])} shard index in {plan['n_requests']} requests",
+        f"  decoded:       {_bytes(plan['decoded_bytes'])}",
+        f"  amplification: {plan['amplification']:.2f}x",
+    ]
+    for alt in plan['alternatives']:
+        lines.append(f"  resolution {alt['resolution']}: {_bytes(alt['compressed_bytes'])} "
+                     f"fetched, {_bytes(alt['decoded_bytes'])} decoded {alt['shape']}")
+    lines += [f'  suggestion: {s}' for s in plan['suggestions']]
+    return '\n'.join(lines)
+
+
+def _bytes(n:int|None):
+    if n is None:
+        return 'unknown'
+    for unit in ('B', 'KiB', 'MiB', 'GiB'):
+        if n < 1024 or 'GiB' == unit:
+            return f'{n:.0f} {unit}' if 'B' == unit else f'{n:.1f} {unit}'
+        n /= 1024
@@ -0,0 +1,230 @@
+from concurrent.futures import ThreadPoolExecutor
+import contextlib
+import hashlib
+import io
+import json
+import os
+import numpy
+from .checksum import list_shards
+from .lock import storage_lock
+from .plan import shard_sizes
+from .shard import shard_key
+
+# Preview file of a .vsr, all thumbnails in one compressed archive
+PREVIEWS = 'previews.npz'
+# Maximum edge in pixels of a thumbnail
+MAX_SIZE = 256
+# Key of the JSON index inside the archive
+_INDEX = 'index'
+
+
+def preview_level(image, max_size:int=MAX_SIZE):
+    """
+    Get the resolution level to build previews from, the finest level
+    fitting in max_size along y and x, or the coarsest level
+
+    Parameters:
+        image:    visor.Image
+        max_size: maximum edge in pixels of a thumbnail
+
+    Returns:
+        str
+    """
+    datasets = image.attrs.get('ome', {}).get('multiscales', [{}])[0].get('datasets', [])
+    levels = [d['path'] for d in datasets if d['path'] in image.zgroup] or \
+             sorted(image.zgroup.array_keys())
+    for level in levels:
+        if max(image.load(level).shape[-2:]) <= max_size:
+            return level
+    return levels[-1]
+
+
+def fingerprint(image, resolution:str):
+    """
+    Get a fingerprint of an array, changing whenever its metadata or any
+    of its shards change: shard size and mtime on local storage, the
+    shard indices (compressed chunk sizes) on other storage
+
+    Parameters:
+        image:      visor.Image
+        resolution: resolution level
+
+    Returns:
+        str
+    """
+    key = f'{image.key}/{resolution}'
+    h = hashlib.sha1(image.storage.get(f'{key}/zarr.json'))
+    h.update(json.dumps(image.attrs.get('visor', {}), sort_keys=True).encode())
+    local = image.storage.local_path(image.key)
+    if local is not None:
+        for k in list_shards(local, resolution):
+            st = os.stat(local/str(resolution)/k)
+            h.update(f'{k}:{st.st_size}:{st.st_mtime_ns};'.encode())
+    else:
+        arr = image.load(resolution)
+        shards = [tuple(int(i) for i in k.split('/')[-arr.ndim:])
+                  for k in image.storage.list(f'{key}/c')]
+        for s, sizes in zip(shards, shard_sizes(image.storage, key, arr, shards) if arr.shards else []):
+            h.update(shard_key(s).encode())
+            if sizes is not None:
+                h.update(sizes.tobytes())
+    return h.hexdigest()
+
+
+def make_preview(image, resolution:str=None, max_size:int=MAX_SIZE):
+    """
+    Make z maximum intensity projection thumbnails of every stack and
+    channel of an image, reading the level slab by slab along z and
+    max-pooling y and x down to max_size
+
+    Parameters:
+        image:      visor.Image
+        resolution: resolution level, default see preview_level
+        max_size:   maximum edge in pixels of a thumbnail
+
+    Returns:
+        dict with 'mip' numpy.ndarray (vs,ch,y,x), 'resolution', 'factor'
+        of the max-pooling, 'scale' (y,x) of thumbnail pixels in
+        micrometer, 'stacks' and 'channels' labels and 'fingerprint'
+    """
+    resolution = str(resolution or preview_level(image, max_size))
+    arr = image.load(resolution)
+    if arr.ndim != 5:
+        raise ValueError(f'Previews need (vs,ch,z,y,x) arrays, got shape {arr.shape}.')
+    factor = max(1, -(-max(arr.shape[-2:]) // max_size))
+    step = (arr.shards or arr.chunks)[2]
+    mip = numpy.full(arr.shape[:2] + arr.shape[-2:], _lowest(arr.dtype), dtype=arr.dtype)
+    for z in range(0, arr.shape[2], step):
+        numpy.maximum(mip, arr[:, :, z:z+step].max(axis=2), out=mip)
+    mip = _pool(mip, factor)
+
+    v_meta = image.attrs.get('visor', {})
+    return {
+        'mip':         mip,
+        'resolution':  resolution,
+        'factor':      factor,
+        'scale':       [s * factor for s in _scale(image, resolution)[-2:]],
+        'stacks':      [s['label'] for s in sorted(v_meta.get('visor_stacks', []), key=lambda s: s['index'])],
+        'channels':    [c['wavelength'] for c in sorted(v_meta.get('channels', []), key=lambda c: c['index'])],
+        'fingerprint': fingerprint(image, resolution),
+    }
+
+
+def _lowest(dtype:numpy.dtype):
+    """
+    Private function to get the lowest value of a dtype, the identity of max
+    """
+    dtype = numpy.dtype(dtype)
+    if 'b' == dtype.kind:
+        return False
+    if 'f' == dtype.kind:
+        return -numpy.inf
+    return numpy.iinfo(dtype).min
+
+
+def _pool(mip:numpy.ndarray, factor:int):
+    """
+    Private function to max-pool the last two dimensions by factor, edges
+    not divisible by factor are padded with the lowest value of the dtype
+    """
+    if 1 == factor:
+        return mip
+    pad = [(0, 0)] * (mip.ndim - 2) + [(0, -n % factor) for n in mip.shape[-2:]]
+    mip = numpy.pad(mip, pad, constant_values=_lowest(mip.dtype))
+    y, x = mip.shape[-2] // factor, mip.shape[-1] // factor
+    return mip.reshape(mip.shape[:-2] + (y, factor, x, factor)).max(axis=(-3, -1))
+
+
+def _scale(image, resolution:str):
+    """
+    Private function to get the voxel size of a level in micrometer
+    """
+    multiscale = image.attrs.get('ome', {}).get('multiscales', [{}])[0]
+    scale = numpy.ones(5)
+    for t in multiscale.get('coordinateTransformations', []):
+        if 'scale' == t['type']:
+            scale = scale * t['scale']
+    for d in multiscale.get('datasets', []):
+        if d['path'] == resolution:
+            for t in d['coordinateTransformations']:
+                if 'scale' == t['type']:
+                    scale = scale * t['scale']
+    return scale.tolist()
+
+
+def load_previews(storage):
+    """
+    Load the preview file of a .vsr in a single read
+
+    Parameters:
+        storage: storage of the .vsr
+
+    Returns:
+        dict of 'type/name' to preview, see make_preview, empty if there
+        is no preview file
+    """
+    if not storage.is_file(PREVIEWS):
+        return {}
+    with numpy.load(io.BytesIO(storage.get(PREVIEWS))) as npz:
+        index = json.loads(npz[_INDEX].tobytes())
+        return {k: v | {'mip': npz[k]} for k, v in index.items()}
+
+
+def save_previews(storage, previews:dict):
+    """
+    Write all previews of a .vsr into its preview file
+    """
+    index = {k: {n: v for n, v in p.items() if 'mip' != n} for k, p in previews.items()}
+    buf = io.BytesIO()
+    numpy.savez_compressed(buf, **{_INDEX: numpy.frombuffer(json.dumps(index).encode(), dtype='u1')},
+                           **{k: p['mip'] for k, p in previews.items()})
+    storage.put(PREVIEWS, buf.getvalue())
+
+
+def update_previews(storage, image_types:list=None, max_size:int=MAX_SIZE, max_workers:int=None):
+    """
+    Bring the preview file of a .vsr up to date in one pass: previews of
+    new or changed images are made in parallel, those of removed images
+    dropped, unchanged ones kept. The file is only rewritten when
+    anything changed, read-only storage gets the previews without writing.
+
+    Parameters:
+        storage:     storage of the .vsr
+        image_types: image types to preview, default all
+        max_size:    maximum edge in pixels of a thumbnail
+        max_workers: number of threads
+
+    Returns:
+        dict of 'type/name' to preview, see make_preview
+    """
+    from .image import Image
+    with contextlib.nullcontext() if storage.read_only else storage_lock(storage, '', PREVIEWS):
+        previews = load_previews(storage)
+        keys = []
+        for d in storage.scan_dirs('', 'visor_', '_images'):
+            t = d.split('_', 1)[1].rsplit('_', 1)[0]
+            if image_types is None or t in image_types:
+                keys += [f"{t}/{n.removesuffix('.zarr')}" for n in storage.scan_dirs(d, suffix='.zarr')]
+
+        def refresh(k):
+            t, name = k.split('/')
+            image = Image(storage, image_type=t, image_name=name)
+            old = previews.get(k)
+            if old is not None and old.get('max_size') == max_size and \
+                    old['resolution'] in image.zgroup and \
+                    old['resolution'] == preview_level(image, max_size) and \
+                    old['fingerprint'] == fingerprint(image, old['resolution']):
+                return old
+            return make_preview(image, max_size=max_size) | {'max_size': max_size}
+
+        with ThreadPoolExecutor(max_workers=max_workers) as ex:
+            fresh = dict(zip(keys, ex.map(refresh, keys)))
+        kept = {k: p for k, p in previews.items()
+                if image_types is not None and k.split('/')[0] not in image_types}
+        updated = kept | fresh
+        changed = updated.keys() != previews.keys() or \
+            any(updated[k] is not previews[k] for k in updated)
+        if changed and not storage.read_only:
+            save_previews(storage, updated)
+    return updated
+
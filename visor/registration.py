@@ -0,0 +1,251 @@
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+import datetime
+import json
+import multiprocessing
+import numpy
+from .image import Image
+from .transform import Transform
+from .util import level_scale
+from .storage import Storage
+
+
+def phase_correlation(a:numpy.ndarray, b:numpy.ndarray):
+    """
+    Estimate the translation between two equally shaped arrays by FFT
+    phase correlation, with sub-voxel refinement of the peak
+
+    Both arrays are mean-subtracted and Hann-windowed, so b(x) = a(x + r)
+    gives shift r.
+
+    Parameters:
+        a: numpy.ndarray
+        b: numpy.ndarray of the same shape
+
+    Returns:
+        (shift, peak), shift per dimension in voxels, peak height of the
+        normalized correlation in [0, 1] as a confidence
+    """
+    if a.shape != b.shape:
+        raise ValueError(f'Shapes {a.shape} and {b.shape} do not match.')
+    window = 1.0
+    for i, n in enumerate(a.shape):
+        w = numpy.hanning(n + 2)[1:-1] if n > 1 else numpy.ones(1)
+        window = window * w.reshape((-1,) + (1,) * (a.ndim - i - 1))
+    fa = numpy.fft.rfftn((a - a.mean()) * window)
+    fb = numpy.fft.rfftn((b - b.mean()) * window)
+    cross = fa * numpy.conj(fb)
+    cross /= numpy.maximum(numpy.abs(cross), 1e-12)
+    corr = numpy.fft.irfftn(cross, s=a.shape, axes=range(a.ndim))
+
+    peak = numpy.unravel_index(numpy.argmax(corr), corr.shape)
+    shift = numpy.zeros(a.ndim)
+    for d, (p, n) in enumerate(zip(peak, a.shape)):
+        # parabola through the peak and its neighbours, with wrap-around
+        if n > 2:
+            idx = list(peak)
+            values = []
+            for o in (-1, 0, 1):
+                idx[d] = (p + o) % n
+                values.append(corr[tuple(idx)])
+            denom = values[0] - 2 * values[1] + values[2]
+            shift[d] = p + (0.5 * (values[0] - values[2]) / denom if denom < 0 else 0.0)
+        else:
+            shift[d] = p
+        if shift[d] > n / 2:
+            shift[d] -= n
+    return shift, float(corr[peak])
+
+
+def overlap(shape:tuple, offset:numpy.ndarray):
+    """
+    Get overlapping regions of two stacks of the same shape, where voxel
+    p of the second stack is at p + offset in the first
+
+    Parameters:
+        shape:  (z, y, x) shape of the stacks
+        offset: (z, y, x) integer offset
+
+    Returns:
+        (region of first, region of second) as tuples of slices,
+        raise ValueError if they do not overlap
+    """
+    ra, rb = [], []
+    for n, d in zip(shape, offset):
+        lo, hi = max(0, int(d)), min(n, n + int(d))
+        if hi <= lo:
+            raise ValueError(f'Stacks do not overlap at offset {tuple(offset)}.')
+        ra.append(slice(lo, hi))
+        rb.append(slice(lo - int(d), hi - int(d)))
+    return tuple(ra), tuple(rb)
+
+
+def register_pair(img:Image, stacks:tuple, channel:int, levels:list, nominal:numpy.ndarray):
+    """
+    Register two stacks coarse to fine, reading only their overlap
+
+    At each level, from coarse to fine, the overlap given by the current
+    offset is read from both stacks and phase-correlated, and the residual
+    shift refines the offset for the next level.
+
+    Parameters:
+        img:     visor.Image
+        stacks:  (first, second) visor_stack indices
+        channel: channel index
+        levels:  resolution levels, coarse to fine
+        nominal: (z, y, x) offset of the second stack in the first, in
+                 voxels at level 0, from stack positions
+
+    Returns:
+        dict with (z, y, x) 'offset' in voxels at level 0 and 'peak' of
+        the finest level
+    """
+    a, b = stacks
+    offset, peak, scale_prev = numpy.asarray(nominal, dtype=numpy.float64), 0.0, None
+    offset = offset / level_scale(img, levels[0])
+    for level in levels:
+        scale = level_scale(img, level)
+        if scale_prev is not None:
+            offset = offset * scale_prev / scale
+        arr = img.load(level)
+        base = numpy.rint(offset).astype(int)
+        ra, rb = overlap(arr.shape[2:], base)
+        crop_a = arr[(a, channel) + ra].astype(numpy.float32)
+        crop_b = arr[(b, channel) + rb].astype(numpy.float32)
+        shift, peak = phase_correlation(crop_a, crop_b)
+        offset = base + shift
+        scale_prev = scale
+    return {'offset': offset * scale_prev, 'peak': peak}
+
+
+def _register_pair_job(job:dict):
+    """
+    Private function to register a pair in a worker process
+    """
+    img = Image(job['vsr_path'], image_type=job['image_type'], image_name=job['image_name'])
+    return register_pair(img, job['stacks'], job['channel'], job['levels'], job['nominal'])
+
+
+def register_stacks(vsr_path:str|Path|Storage, image_name:str, channel:str,
+                    recon_version:str, image_type:str='raw', space:str='ortho',
+                    levels:list=None, position_unit:float=1000.0,
+                    processes:bool=True, max_workers:int=None, overwrite:bool=False):
+    """
+    Register neighbouring visor_stacks of an image by phase correlation of
+    their overlaps and save an affine raw_to_{space} transform per stack
+    and channel
+
+    Nominal offsets come from the 'position' (x, y) attrs of the stacks.
+    Pairs are registered coarse to fine in parallel, then chained from the
+    first stack. Each transform maps raw voxel indices (x,y,z) at level 0
+    to micrometers, so the stacks are stitched in {space}.
+
+    Parameters:
+        vsr_path:      path or url to the .vsr file
+        image_name:    image name, see vsr.images()
+        channel:       channel label (wavelength) to register on
+        recon_version: reconstruction version to save transforms into
+        image_type:    image type
+        space:         target space of the transforms
+        levels:        resolution levels coarse to fine, default all
+        position_unit: micrometers per unit of stack positions
+        processes:     register pairs on a process pool, threads otherwise
+        max_workers:   number of processes or threads
+        overwrite:     replace existing transforms
+
+    Returns:
+        dict with 'pairs', list of stacks, nominal and registered offsets
+        (z,y,x voxels at level 0) and peak, and 'translations', (x,y,z)
+        micrometers per stack index
+    """
+    img = Image(vsr_path, image_type=image_type, image_name=image_name)
+    ch = img.label_to_index('channel', channel)
+    datasets = img.attrs['ome']['multiscales'][0]['datasets']
+    if levels is None:
+        levels = [d['path'] for d in datasets][::-1]
+    levels = [str(l) for l in levels]
+    ms = img.attrs['ome']['multiscales'][0]
+    voxel = numpy.asarray(ms['coordinateTransformations'][0]['scale'][2:]) * \
+        numpy.asarray(datasets[0]['coordinateTransformations'][0]['scale'][2:])
+
+    stacks = sorted(img.attrs['visor']['visor_stacks'], key=lambda s: s['index'])
+    if len(stacks) < 2:
+        raise ValueError(f'Registration requires at least 2 visor_stacks, got {len(stacks)}.')
+    pos = {s['index']: numpy.asarray(s['position'], dtype=numpy.float64) * position_unit
+           for s in stacks}
+    jobs = []
+    for s1, s2 in zip(stacks[:-1], stacks[1:]):
+        dx, dy = pos[s2['index']] - pos[s1['index']]
+        jobs.append({'vsr_path': vsr_path if processes else img.storage,
+                     'image_type': image_type, 'image_name': image_name,
+                     'stacks': (s1['index'], s2['index']), 'channel': ch, 'levels': levels,
+                     'nominal': numpy.array([0.0, dy, dx]) / voxel})
+
+    if processes:
+        ctx = multiprocessing.get_context('spawn')
+        with ProcessPoolExecutor(max_workers=max_workers, mp_context=ctx) as pool:
+            results = list(pool.map(_register_pair_job, jobs))
+    else:
+        with ThreadPoolExecutor(max_workers=max_workers) as pool:
+            results = list(pool.map(_register_pair_job, jobs))
+
+    # chain pair offsets from the first stack, positions in micrometers (z,y,x)
+    first = stacks[0]['index']
+    origin = {first: numpy.array([0.0, pos[first][1], pos[first][0]])}
+    pairs = []
+    for job, r in zip(jobs, results):
+        s1, s2 = job['stacks']
+        origin[s2] = origin[s1] + r['offset'] * voxel
+        pairs.append({'stacks': job['stacks'], 'nominal': job['nominal'],
+                      'offset': r['offset'], 'peak': r['peak']})
+
+    xfm = Transform(img.storage, recon_version=recon_version, slice_name=image_name, create=True) \
+        if not img.storage.is_dir(f'visor_recon_transforms/{recon_version}/{image_name}') \
+        else Transform(img.storage, recon_version=recon_version, slice_name=image_name)
+    t_name = f'raw_to_{space}'
+    matrix = numpy.diag(voxel[::-1]).ravel().tolist()
+    for st, o in origin.items():
+        for c in range(len(img.attrs['visor']['channels'])):
+            key = f'{xfm.key}/{t_name}/{st}/{c}/affine.tfm'
+            if overwrite and img.storage.is_file(key):
+                img.storage.delete(key)
+            xfm.save('raw', space, 'affine', 'tfm', [st, c] + matrix + o[::-1].tolist())
+
+    trans = _transforms_meta(xfm)
+    if t_name not in [t['name'] for t in trans]:
+        xfm.update_meta(trans=trans + [{'name': t_name, 'type': 'affine', 'format': 'tfm'}])
+    recon = _recon_meta(xfm, image_name, space, t_name)
+    if recon is not None:
+        xfm.update_meta(recon=recon)
+    return {'pairs': pairs, 'translations': {st: o[::-1] for st, o in origin.items()}}
+
+
+def _transforms_meta(xfm:Transform):
+    """
+    Private function to read the transform list of a slice
+    """
+    meta = xfm.storage.read_json(f'{xfm.key}/transforms.json')
+    return meta if isinstance(meta, list) else []
+
+
+def _recon_meta(xfm:Transform, slice_name:str, space:str, t_name:str):
+    """
+    Private function to add a slice transform to recon.json of the recon
+    version, created if the version is new
+
+    Returns:
+        dict of the updated recon.json, None if unchanged
+    """
+    key = f"{xfm.key.rpartition('/')[0]}/recon.json"
+    recon = xfm.storage.read_json(key) if xfm.storage.is_file(key) else \
+        {'create_time': datetime.datetime.now(datetime.timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ'),
+         'spaces': [], 'slices': []}
+    old = json.dumps(recon, sort_keys=True)
+    recon['spaces'] += [s for s in ('raw', space) if s not in recon['spaces']]
+    entry = next((e for e in recon['slices'] if e['name'] == slice_name), None)
+    if entry is None:
+        entry = {'name': slice_name, 'transforms': []}
+        recon['slices'].append(entry)
+    if t_name not in entry['transforms']:
+        entry['transforms'].append(t_name)
+    return recon if json.dumps(recon, sort_keys=True) != old else None
@@ -1,11 +1,17 @@
 from pathlib import Path
+import time
+from .access import log_selection, unwrap
 from .image import Image
+from .decode import DecodePool
+from .pipeline import Pipeline
+from .plan import plan_read, explain
 
 class ROI:
 
     def __init__(self, image_path:str|Path,
         resolution:str|int,
-        ranges:tuple[slice|int, ...]):
+        ranges:tuple[slice|int, ...],
+        pipeline:Pipeline=None):
         """
         Constructor of ROI
 
@@ -13,6 +19,7 @@ class ROI:
             image_path: path of image
             resolution: resolution level
             ranges:     tuple of roi ranges (int or slice) in each dimension
+            pipeline:   visor.Pipeline applied to each block while loading
         """
         img_path = Path(image_path)
         self.img = Image(
@@ -22,13 +29,53 @@ class ROI:
         )
         self.resolution = resolution
         self.ranges = ranges
+        self.pipeline = pipeline
 
 
-    def load(self):
+    def load(self, pool:DecodePool=None):
         """
         Load ROI array
 
+        Parameters:
+            pool: visor.decode.DecodePool to decode in worker processes,
+                  default threads
+
         Returns:
             numpy.ndarray
         """
-        return self.img.load(self.resolution)[self.ranges]
\ No newline at end of file
+        pipeline = self.pipeline or Pipeline()
+        arr = unwrap(self.img.load(self.resolution))
+        t0 = time.perf_counter()
+        if pool is not None:
+            out = pool.read(self.img, self.resolution, self.ranges, pipeline=pipeline)
+        elif self.pipeline is None:
+            # any basic indexing, e.g. steps and Ellipsis
+            out = arr[self.ranges]
+        else:
+            out = pipeline.read(arr, self.ranges)
+        log_selection(self.img, self.resolution, arr, self.ranges,
+                      time.perf_counter() - t0, pipeline.factors(arr.ndim))
+        return out
+
+
+    def plan(self):
+        """
+        Plan the read of the ROI without decoding, from the shard and
+        chunk grids and the shard indices on storage
+
+        Returns:
+            dict, see visor.plan.plan_read
+        """
+        return plan_read(self.img, self.resolution, self.ranges)
+
+
+    def explain(self):
+        """
+        Describe the cost of loading the ROI: shards and chunks touched,
+        compressed bytes to fetch, decoded bytes, read amplification, and
+        suggestions of a cheaper resolution or split
+
+        Returns:
+            str
+        """
+        return explain(self.plan())
@@ -0,0 +1,149 @@
+import itertools
+import math
+
+def normalize_region(region, shape:tuple):
+    """
+    Normalize a region to a tuple of slices with absolute bounds
+
+    Parameters:
+        region: tuple of int or slice (step 1) per dimension, None for all
+        shape:  shape of the array
+
+    Returns:
+        tuple of slices, one per dimension, dimensions are preserved
+    """
+    if region is None:
+        region = ()
+    if not isinstance(region, tuple):
+        region = (region,)
+    if len(region) > len(shape):
+        raise ValueError(f'Region {region} has more dimensions than shape {shape}.')
+    region = region + (slice(None),) * (len(shape) - len(region))
+
+    slices = []
+    for r, n in zip(region, shape):
+        if isinstance(r, slice):
+            start, stop, step = r.indices(n)
+            if 1 != step:
+                raise ValueError(f'Region {region} must have step 1.')
+            slices.append(slice(start, max(start, stop)))
+        else:
+            i = int(r) + n if int(r) < 0 else int(r)
+            if not 0 <= i < n:
+                raise IndexError(f'Index {r} is out of bounds for size {n}.')
+            slices.append(slice(i, i+1))
+    return tuple(slices)
+
+
+def shard_grid(arr):
+    """
+    Get number of shards per dimension
+
+    Parameters:
+        arr: zarr.Array
+
+    Returns:
+        tuple of int
+    """
+    shards = arr.shards or arr.chunks
+    return tuple(math.ceil(n / s) for n, s in zip(arr.shape, shards))
+
+
+def shard_region(arr, index:tuple):
+    """
+    Get region covered by a shard
+
+    Parameters:
+        arr:   zarr.Array
+        index: shard index per dimension
+
+    Returns:
+        tuple of slices, clipped to array shape
+    """
+    shards = arr.shards or arr.chunks
+    return tuple(slice(i * s, min((i + 1) * s, n))
+                 for i, s, n in zip(index, shards, arr.shape))
+
+
+def shard_key(index:tuple):
+    """
+    Get store key of a shard, relative to the array
+
+    Parameters:
+        index: shard index per dimension
+
+    Returns:
+        str, e.g. 'c/0/1/0/0/0'
+    """
+    return '/'.join(['c'] + [str(i) for i in index])
+
+
+def shards_in_region(arr, region=None):
+    """
+    List shards intersecting a region
+
+    Parameters:
+        arr:    zarr.Array
+        region: tuple of int or slice per dimension, None for all
+
+    Returns:
+        list of shard indices, in C order
+    """
+    region = normalize_region(region, arr.shape)
+    shards = arr.shards or arr.chunks
+    if any(r.start == r.stop for r in region):
+        return []
+    ranges = [range(r.start // s, (r.stop - 1) // s + 1) for r, s in zip(region, shards)]
+    return list(itertools.product(*ranges))
+
+
+def is_shard_aligned(arr, region=None):
+    """
+    Check whether a region covers whole shards only
+
+    Parameters:
+        arr:    zarr.Array
+        region: tuple of int or slice per dimension, None for all
+
+    Returns:
+        bool
+    """
+    region = normalize_region(region, arr.shape)
+    shards = arr.shards or arr.chunks
+    return all(r.start % s == 0 and (r.stop % s == 0 or r.stop == n)
+               for r, s, n in zip(region, shards, arr.shape))
+
+
+def assign_shards(arr, n_writers:int, region=None, axis:int=None):
+    """
+    Plan disjoint shard ownership for concurrent writers
+
+    Parameters:
+        arr:       zarr.Array
+        n_writers: number of writers
+        region:    region to write, None for the whole array
+        axis:      if given, shards with the same index along axis
+                   (e.g. 0 for visor_stack) always go to the same writer
+
+    Returns:
+        list of n_writers lists of shard indices, in C order
+    """
+    if n_writers < 1:
+        raise ValueError(f'Number of writers must be positive, got {n_writers}.')
+    shards = shards_in_region(arr, region)
+    plan = [[] for _ in range(n_writers)]
+    if axis is not None:
+        # round-robin over distinct indices along axis
+        keys = sorted({s[axis] for s in shards})
+        owner = {k: i % n_writers for i, k in enumerate(keys)}
+        for s in shards:
+            plan[owner[s[axis]]].append(s)
+    else:
+        # contiguous runs in C order keep each writer's shards local
+        q, r = divmod(len(shards), n_writers)
+        start = 0
+        for i in range(n_writers):
+            stop = start + q + (1 if i < r else 0)
+            plan[i] = shards[start:stop]
+            start = stop
+    return plan
@@ -0,0 +1,835 @@
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+import asyncio
+import contextlib
+import json
+import os
+import queue
+import tempfile
+import threading
+import weakref
+import zipfile
+import zarr
+from zarr.abc.store import Store, RangeByteRequest, OffsetByteRequest, SuffixByteRequest
+from .discovery import MAX_WORKERS, scan_dirs, read_jsons
+from .lock import write_atomic
+
+
+def open_storage(url:str|Path, **options):
+    """
+    Open the storage of a .vsr by path or url
+
+        /data/VISOR001.vsr             local directory
+        memory://VISOR001.vsr          in-memory, shared within the process by name
+        zip:///data/VISOR001.vsr.zip   zip archive of a .vsr directory, read-only
+        s3://bucket/path/VISOR001.vsr  S3-compatible object store, requires boto3
+
+    Parameters:
+        url:     path, url or Storage
+        options: keyword arguments of the backend, e.g. pool_size, or
+                 endpoint_url for s3
+
+    Returns:
+        Storage
+    """
+    if isinstance(url, Storage):
+        return url
+    url = str(url)
+    scheme, sep, rest = url.partition('://')
+    if not sep:
+        return LocalStorage(url)
+    if 'memory' == scheme:
+        return MemoryStorage(rest)
+    if 'zip' == scheme:
+        return ZipStorage(rest)
+    if 's3' == scheme:
+        bucket, _, root = rest.partition('/')
+        pool_size = options.pop('pool_size', 16)
+        return ObjectStorage(root, lambda: S3Client(bucket, **options),
+                             pool_size=pool_size, url=url)
+    raise ValueError(f'Invalid storage url {url}. Must be a path or memory://, zip:// or s3:// url.')
+
+
+def _join(*parts):
+    return '/'.join(p.strip('/') for p in parts if p and p.strip('/'))
+
+
+class Storage:
+    """
+    Base class of storage backends, holding the files of one .vsr under
+    '/'-separated keys relative to its root, '' for the root itself
+
+    Subclasses implement get, get_range, put, delete, list_dir and
+    zarr_store, the rest is derived.
+    """
+    url = ''
+    read_only = False
+
+
+    @property
+    def name(self):
+        """
+        Name of the root, e.g. VISOR001.vsr
+        """
+        return self.url.rstrip('/').rsplit('/', 1)[-1]
+
+
+    def path(self, key:str=''):
+        """
+        Path (local) or url of a key, for messages and sub-paths
+        """
+        return f'{self.url}/{key}' if key else self.url
+
+
+    def local_path(self, key:str=''):
+        """
+        Get local filesystem path of a key
+
+        Returns:
+            Path, or None if the storage is not local
+        """
+        return None
+
+
+    def get(self, key:str):
+        """
+        Read an object, raise FileNotFoundError if not exist
+
+        Returns:
+            bytes
+        """
+        raise NotImplementedError
+
+
+    def get_range(self, key:str, start:int, stop:int=None):
+        """
+        Read a byte range of an object, negative start and stop None
+        for a suffix, like bytes slicing
+
+        Returns:
+            bytes
+        """
+        raise NotImplementedError
+
+
+    def put(self, key:str, data:bytes):
+        raise NotImplementedError
+
+
+    def delete(self, key:str):
+        raise NotImplementedError
+
+
+    def list_dir(self, key:str=''):
+        """
+        List direct children of a key
+
+        Returns:
+            (list of sub-directory names, list of object names)
+        """
+        raise NotImplementedError
+
+
+    def list(self, key:str=''):
+        """
+        List all object keys under a key, recursively
+        """
+        dirs, files = self.list_dir(key)
+        keys = [_join(key, f) for f in files]
+        for d in dirs:
+            keys += self.list(_join(key, d))
+        return keys
+
+
+    def exists(self, key:str):
+        return self.is_file(key) or self.is_dir(key)
+
+
+    def is_file(self, key:str):
+        parent, _, name = key.rpartition('/')
+        return name in self.list_dir(parent)[1]
+
+
+    def is_dir(self, key:str=''):
+        dirs, files = self.list_dir(key)
+        return bool(dirs or files)
+
+
+    def mkdir(self, key:str):
+        """
+        Create a directory, directories of key-value backends exist
+        implicitly while they hold objects
+        """
+        pass
+
+
+    def get_many(self, keys:list, max_workers:int=None):
+        """
+        Read many small objects concurrently
+
+        Returns:
+            list of bytes, in the order of keys
+        """
+        keys = list(keys)
+        if len(keys) < 2:
+            return [self.get(k) for k in keys]
+        with ThreadPoolExecutor(max_workers=min(max_workers or MAX_WORKERS, len(keys))) as pool:
+            return list(pool.map(self.get, keys))
+
+
+    def get_ranges(self, requests:list, max_workers:int=None):
+        """
+        Read many byte ranges concurrently, e.g. shard indices and inner chunks
+
+        Parameters:
+            requests: list of (key, start, stop)
+
+        Returns:
+            list of bytes, or None for missing objects, in the order of requests
+        """
+        def get(r):
+            try:
+                return self.get_range(*r)
+            except FileNotFoundError:
+                return None
+        requests = list(requests)
+        if len(requests) < 2:
+            return [get(r) for r in requests]
+        with ThreadPoolExecutor(max_workers=min(max_workers or MAX_WORKERS, len(requests))) as pool:
+            return list(pool.map(get, requests))
+
+
+    def scan_dirs(self, key:str='', prefix:str='', suffix:str=''):
+        """
+        List sub-directory names, see visor.discovery.scan_dirs
+        """
+        try:
+            dirs = self.list_dir(key)[0]
+        except (FileNotFoundError, NotADirectoryError):
+            return []
+        return [d for d in dirs if d.startswith(prefix) and d.endswith(suffix)]
+
+
+    def read_json(self, key:str):
+        return json.loads(self.get(key))
+
+
+    def read_jsons(self, keys:list):
+        """
+        Read many JSON objects in one batch, see visor.discovery.read_jsons
+        """
+        return [json.loads(b) for b in self.get_many(keys)]
+
+
+    def write_json(self, key:str, obj, indent:int=None):
+        self.put(key, json.dumps(obj, indent=indent).encode())
+
+
+    def zarr_store(self, key:str=''):
+        """
+        Get a zarr store rooted at key
+        """
+        return StorageStore(self, key)
+
+
+    def read_only_error(self):
+        return PermissionError(f'Storage {self.url} is read-only.')
+
+
+    def local_only_error(self, feature:str):
+        """
+        Error of features relying on filesystem locks and files, e.g.
+        checksums and appending, on storage other than local
+
+        Returns:
+            ValueError
+        """
+        return ValueError(f'{feature} requires local storage, got {self.url}. '
+                          f'Copy the .vsr to a local directory first.')
+
+
+class LocalStorage(Storage):
+
+    def __init__(self, root:str|Path):
+        """
+        Constructor of LocalStorage, a directory on a POSIX filesystem
+
+        Parameters:
+            root: path to the directory
+        """
+        self.root = Path(root)
+        self.url = str(self.root)
+
+
+    @property
+    def name(self):
+        return self.root.name
+
+
+    def path(self, key:str=''):
+        return self.root/key if key else self.root
+
+
+    def local_path(self, key:str=''):
+        return self.path(key)
+
+
+    def get(self, key:str):
+        with open(self.root/key, 'rb') as f:
+            return f.read()
+
+
+    def get_range(self, key:str, start:int, stop:int=None):
+        with open(self.root/key, 'rb') as f:
+            if start < 0:
+                f.seek(start, os.SEEK_END)
+            else:
+                f.seek(start)
+            return f.read() if stop is None else f.read(stop - f.tell())
+
+
+    def put(self, key:str, data:bytes):
+        (self.root/key).parent.mkdir(parents=True, exist_ok=True)
+        write_atomic(self.root/key, data)
+
+
+    def delete(self, key:str):
+        os.remove(self.root/key)
+
+
+    def list_dir(self, key:str=''):
+        dirs, files = [], []
+        with os.scandir(self.root/key) as it:
+            for e in it:
+                (dirs if e.is_dir() else files).append(e.name)
+        return dirs, files
+
+
+    def is_file(self, key:str):
+        return (self.root/key).is_file()
+
+
+    def is_dir(self, key:str=''):
+        return (self.root/key).is_dir()
+
+
+    def mkdir(self, key:str):
+        (self.root/key).mkdir(parents=True, exist_ok=True)
+
+
+    def scan_dirs(self, key:str='', prefix:str='', suffix:str=''):
+        return scan_dirs(self.root/key, prefix, suffix)
+
+
+    def read_jsons(self, keys:list):
+        return read_jsons([self.root/k for k in keys])
+
+
+    def zarr_store(self, key:str=''):
+        return zarr.storage.LocalStore(self.path(key))
+
+
+# MemoryStorage objects by name, shared within the process
+_MEMORY = {}
+_MEMORY_LOCK = threading.Lock()
+
+
+class MemoryStorage(Storage):
+
+    def __init__(self, name:str):
+        """
+        Constructor of MemoryStorage, objects in a dict, storages of the
+        same name share their objects within the process, e.g. for tests
+        and scratch results
+
+        Parameters:
+            name: name of the root, e.g. VISOR001.vsr
+        """
+        self.url = f'memory://{name}'
+        with _MEMORY_LOCK:
+            self.objects = _MEMORY.setdefault(name, {})
+        self._lock = threading.Lock()
+
+
+    def get(self, key:str):
+        try:
+            return self.objects[key]
+        except KeyError:
+            raise FileNotFoundError(f'The object {self.path(key)} does not exist.')
+
+
+    def get_range(self, key:str, start:int, stop:int=None):
+        return self.get(key)[start:stop]
+
+
+    def put(self, key:str, data:bytes):
+        with self._lock:
+            self.objects[key] = bytes(data)
+
+
+    def delete(self, key:str):
+        with self._lock:
+            self.objects.pop(key, None)
+
+
+    def list_dir(self, key:str=''):
+        return _children(list(self.objects), key)
+
+
+    def is_file(self, key:str):
+        return key in self.objects
+
+
+    @staticmethod
+    def drop(name:str):
+        """
+        Drop all objects of a named memory storage
+        """
+        with _MEMORY_LOCK:
+            _MEMORY.pop(name, None)
+
+
+def _children(keys:list, key:str):
+    """
+    Private function to split keys under key into direct sub-directories
+    and objects
+    """
+    prefix = f'{key.strip("/")}/' if key.strip('/') else ''
+    dirs, files = set(), []
+    for k in keys:
+        if k.startswith(prefix):
+            head, sep, _ = k[len(prefix):].partition('/')
+            if sep:
+                dirs.add(head)
+            else:
+                files.append(head)
+    return sorted(dirs), sorted(files)
+
+
+class ZipStorage(Storage):
+
+    def __init__(self, zip_path:str|Path):
+        """
+        Constructor of ZipStorage, a read-only zip archive of a .vsr
+        directory, see pack_zip(). Members are stored uncompressed, so
+        shard indices and inner chunks are read by byte ranges.
+
+        Parameters:
+            zip_path: path to the zip file, e.g. VISOR001.vsr.zip
+        """
+        self.zip_path = Path(zip_path)
+        self.url = f'zip://{self.zip_path}'
+        self.read_only = True
+        self._zip = zipfile.ZipFile(self.zip_path)
+        self._names = [n for n in self._zip.namelist() if not n.endswith('/')]
+        self._handles = threading.local()
+        # handles of all threads, closed with the storage or when collected
+        self._opened = [self._zip]
+        self._opened_lock = threading.Lock()
+        self._finalizer = weakref.finalize(self, _close_all, self._opened, self._opened_lock)
+
+
+    @property
+    def name(self):
+        return self.zip_path.name.removesuffix('.zip')
+
+
+    def get(self, key:str):
+        return self.get_range(key, 0)
+
+
+    def get_range(self, key:str, start:int, stop:int=None):
+        try:
+            info = self._zip.getinfo(key)
+        except KeyError:
+            raise FileNotFoundError(f'The object {self.path(key)} does not exist.')
+        start, stop, _ = slice(start, stop).indices(info.file_size)
+        with self._thread_zip().open(info) as f:
+            f.seek(start)
+            return f.read(max(0, stop - start))
+
+
+    def _thread_zip(self):
+        """
+        Private method to get the zip file handle of the calling thread,
+        so concurrent reads do not share a file position nor wait on
+        each other
+        """
+        handle = getattr(self._handles, 'zip', None)
+        if handle is None:
+            handle = self._handles.zip = zipfile.ZipFile(self.zip_path)
+            with self._opened_lock:
+                self._opened.append(handle)
+        return handle
+
+
+    def close(self):
+        """
+        Close the zip file handles of all threads
+        """
+        self._finalizer()
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+    def put(self, key:str, data:bytes):
+        raise self.read_only_error()
+
+
+    def delete(self, key:str):
+        raise self.read_only_error()
+
+
+    def list_dir(self, key:str=''):
+        return _children(self._names, key)
+
+
+    def is_file(self, key:str):
+        return key in self._names
+
+
+def _close_all(handles:list, lock:threading.Lock):
+    with lock:
+        for h in handles:
+            h.close()
+        handles.clear()
+
+
+def pack_zip(vsr_path:str|Path, zip_path:str|Path):
+    """
+    Pack a local .vsr directory into a zip archive readable by ZipStorage,
+    without compression since shards are compressed already
+
+    Parameters:
+        vsr_path: path to the .vsr directory
+        zip_path: path to the zip file
+    """
+    vsr_path = Path(vsr_path)
+    with zipfile.ZipFile(zip_path, 'w', compression=zipfile.ZIP_STORED, allowZip64=True) as z:
+        for root, dirs, files in os.walk(vsr_path):
+            dirs[:] = sorted(d for d in dirs if not d.startswith('.'))
+            for f in sorted(files):
+                p = Path(root)/f
+                z.write(p, p.relative_to(vsr_path).as_posix())
+
+
+class ObjectStorage(Storage):
+
+    def __init__(self, root:str, client_factory, pool_size:int=16, url:str=None):
+        """
+        Constructor of ObjectStorage, a .vsr in an S3-compatible object
+        store, accessed through a pool of clients
+
+        A client borrowed from the pool serves one request at a time,
+        clients are created on demand up to pool_size and reused, so
+        concurrent range requests and batched metadata reads share
+        connections.
+
+        Parameters:
+            root:           key prefix of the .vsr in the bucket
+            client_factory: callable returning a client, e.g. S3Client
+                            or LocalObjectClient
+            pool_size:      maximum number of clients
+            url:            url for messages, default object://{root}
+        """
+        self.root = root.strip('/')
+        self.url = url or f'object://{self.root}'
+        self.pool_size = pool_size
+        self._factory = client_factory
+        self._idle = queue.LifoQueue()
+        self._slots = threading.BoundedSemaphore(pool_size)
+        self._lock = threading.Lock()
+        self.n_clients = 0
+
+
+    @contextlib.contextmanager
+    def client(self):
+        """
+        Borrow a client from the pool, wait while all are in use
+        """
+        self._slots.acquire()
+        try:
+            try:
+                c = self._idle.get_nowait()
+            except queue.Empty:
+                c = self._factory()
+                with self._lock:
+                    self.n_clients += 1
+            try:
+                yield c
+            finally:
+                self._idle.put(c)
+        finally:
+            self._slots.release()
+
+
+    def get(self, key:str):
+        return self.get_range(key, 0)
+
+
+    def get_range(self, key:str, start:int, stop:int=None):
+        with self.client() as c:
+            data = c.get_object(_join(self.root, key), start, stop)
+        if data is None:
+            raise FileNotFoundError(f'The object {self.path(key)} does not exist.')
+        return data
+
+
+    def get_many(self, keys:list, max_workers:int=None):
+        return super().get_many(keys, max_workers or self.pool_size)
+
+
+    def get_ranges(self, requests:list, max_workers:int=None):
+        return super().get_ranges(requests, max_workers or self.pool_size)
+
+
+    def put(self, key:str, data:bytes):
+        with self.client() as c:
+            c.put_object(_join(self.root, key), bytes(data))
+
+
+    def delete(self, key:str):
+        with self.client() as c:
+            c.delete_object(_join(self.root, key))
+
+
+    def list_dir(self, key:str=''):
+        prefix = _join(self.root, key)
+        with self.client() as c:
+            dirs, files = c.list_objects(f'{prefix}/' if prefix else '')
+        return dirs, files
+
+
+    def is_file(self, key:str):
+        with self.client() as c:
+            return c.head_object(_join(self.root, key)) is not None
+
+
+class LocalObjectClient:
+
+    def __init__(self, root:str|Path):
+        """
+        Constructor of LocalObjectClient, a local stand-in for an object
+        store client keeping each object in a file under root, for tests
+        and development without a bucket
+
+        Parameters:
+            root: directory holding the objects
+        """
+        self.root = Path(root)
+        self.n_requests = 0
+
+
+    def get_object(self, key:str, start:int=0, stop:int=None):
+        """
+        Get an object or a byte range, None if not exist
+        """
+        self.n_requests += 1
+        try:
+            return LocalStorage(self.root).get_range(key, start, stop)
+        except (FileNotFoundError, IsADirectoryError):
+            return None
+
+
+    def head_object(self, key:str):
+        """
+        Get size of an object, None if not exist
+        """
+        self.n_requests += 1
+        p = self.root/key
+        return p.stat().st_size if p.is_file() else None
+
+
+    def put_object(self, key:str, data:bytes):
+        self.n_requests += 1
+        LocalStorage(self.root).put(key, data)
+
+
+    def delete_object(self, key:str):
+        self.n_requests += 1
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(self.root/key)
+
+
+    def list_objects(self, prefix:str):
+        """
+        List common prefixes and objects directly under prefix, like
+        ListObjectsV2 with delimiter '/'
+
+        Returns:
+            (list of sub-prefix names, list of object names)
+        """
+        self.n_requests += 1
+        try:
+            dirs, files = LocalStorage(self.root).list_dir(prefix)
+        except (FileNotFoundError, NotADirectoryError):
+            return [], []
+        return sorted(dirs), sorted(files)
+
+
+class S3Client:
+
+    def __init__(self, bucket:str, **kwargs):
+        """
+        Constructor of S3Client, an object store client on boto3, one
+        connection per client
+
+        Parameters:
+            bucket: bucket name
+            kwargs: arguments of boto3.client('s3'), e.g. endpoint_url
+        """
+        try:
+            import boto3
+        except ImportError:
+            raise ImportError('Accessing S3 requires boto3, install it with: pip install visor-py[s3]')
+        self.bucket = bucket
+        self._s3 = boto3.client('s3', **kwargs)
+
+
+    def get_object(self, key:str, start:int=0, stop:int=None):
+        if start < 0:
+            byte_range = f'bytes={start}'
+        elif start > 0 or stop is not None:
+            byte_range = f'bytes={start}-' + ('' if stop is None else str(stop - 1))
+        else:
+            byte_range = None
+        kwargs = {'Range': byte_range} if byte_range else {}
+        try:
+            return self._s3.get_object(Bucket=self.bucket, Key=key, **kwargs)['Body'].read()
+        except self._s3.exceptions.NoSuchKey:
+            return None
+
+
+    def head_object(self, key:str):
+        try:
+            return self._s3.head_object(Bucket=self.bucket, Key=key)['ContentLength']
+        except self._s3.exceptions.ClientError:
+            return None
+
+
+    def put_object(self, key:str, data:bytes):
+        self._s3.put_object(Bucket=self.bucket, Key=key, Body=data)
+
+
+    def delete_object(self, key:str):
+        self._s3.delete_object(Bucket=self.bucket, Key=key)
+
+
+    def list_objects(self, prefix:str):
+        dirs, files = [], []
+        pages = self._s3.get_paginator('list_objects_v2').paginate(
+            Bucket=self.bucket, Prefix=prefix, Delimiter='/')
+        for page in pages:
+            dirs += [p['Prefix'][len(prefix):].rstrip('/') for p in page.get('CommonPrefixes', [])]
+            files += [o['Key'][len(prefix):] for o in page.get('Contents', [])]
+        return dirs, files
+
+
+class StorageStore(Store):
+    """
+    zarr store over a visor Storage, partial reads of shards are issued
+    as concurrent range requests through the storage
+    """
+    supports_writes = True
+    supports_deletes = True
+    supports_listing = True
+
+
+    def __init__(self, storage:Storage, prefix:str='', read_only:bool=None):
+        super().__init__(read_only=storage.read_only if read_only is None else read_only)
+        self.storage = storage
+        self.prefix = prefix.strip('/')
+
+
+    def with_read_only(self, read_only:bool=False):
+        return type(self)(self.storage, self.prefix, read_only=read_only)
+
+
+    def __eq__(self, other):
+        return isinstance(other, StorageStore) and self.storage is other.storage \
+            and self.prefix == other.prefix and self.read_only == other.read_only
+
+
+    def __str__(self):
+        return self.storage.path(self.prefix)
+
+
+    def _range(self, key:str, byte_range):
+        key = _join(self.prefix, key)
+        if byte_range is None:
+            return key, 0, None
+        if isinstance(byte_range, RangeByteRequest):
+            return key, byte_range.start, byte_range.end
+        if isinstance(byte_range, OffsetByteRequest):
+            return key, byte_range.offset, None
+        if isinstance(byte_range, SuffixByteRequest):
+            return key, -byte_range.suffix, None
+        raise TypeError(f'Invalid byte range {byte_range}.')
+
+
+    async def get(self, key, prototype=None, byte_range=None):
+        if prototype is None:
+            prototype = zarr.core.buffer.default_buffer_prototype()
+        data = (await asyncio.to_thread(self.storage.get_ranges, [self._range(key, byte_range)]))[0]
+        return None if data is None else prototype.buffer.from_bytes(data)
+
+
+    async def get_partial_values(self, prototype, key_ranges):
+        requests = [self._range(k, r) for k, r in key_ranges]
+        data = await asyncio.to_thread(self.storage.get_ranges, requests)
+        return [None if d is None else prototype.buffer.from_bytes(d) for d in data]
+
+
+    async def exists(self, key):
+        return await asyncio.to_thread(self.storage.is_file, _join(self.prefix, key))
+
+
+    async def set(self, key, value):
+        self._check_writable()
+        await asyncio.to_thread(self.storage.put, _join(self.prefix, key), value.to_bytes())
+
+
+    async def delete(self, key):
+        self._check_writable()
+        await asyncio.to_thread(self.storage.delete, _join(self.prefix, key))
+
+
+    async def list(self):
+        for k in await asyncio.to_thread(self.storage.list, self.prefix):
+            yield k[len(self.prefix):].lstrip('/')
+
+
+    async def list_prefix(self, prefix):
+        async for k in self.list():
+            if k.startswith(prefix):
+                yield k
+
+
+    async def list_dir(self, prefix):
+        dirs, files = await asyncio.to_thread(self.storage.list_dir, _join(self.prefix, prefix))
+        for name in dirs + files:
+            yield name
+
+
+@contextlib.contextmanager
+def local_copy(data:bytes, suffix:str=''):
+    """
+    Write bytes into a temporary file for readers that require a path,
+    e.g. SimpleITK
+
+    Returns:
+        path of the temporary file, removed on exit
+    """
+    fd, path = tempfile.mkstemp(suffix=suffix)
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        yield path
+    finally:
+        os.remove(path)
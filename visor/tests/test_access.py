@@ -0,0 +1,106 @@
+# Run test at root directory with below:
+#   python -m unittest visor/tests/test_access.py
+
+from pathlib import Path
+import shutil
+import tempfile
+import unittest
+import numpy
+import zarr
+from zarr.codecs import BloscCodec
+import visor
+from visor.access import RecordedArray, analyze, explain, read_log, record
+
+
+class TestBase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_path = Path(tempfile.mkdtemp())
+        self.vsr_path = self.tmp_path/'VISOR001.vsr'
+        self.log = self.tmp_path/'logs'/'access.log'
+        shutil.copytree(Path(__file__).parent/'data'/'VISOR001.vsr', self.vsr_path)
+        self.arr = numpy.random.default_rng(0).integers(0, 1000, (1, 1, 16, 16, 16), dtype='uint16')
+        self.img = visor.Image(self.vsr_path, image_type='raw', image_name='slice_3', create=True)
+        self.img.save(self.arr, '0', dtype='uint16', shape=self.arr.shape, shard_size=(1, 1, 8, 8, 8),
+                      chunk_size=(1, 1, 4, 4, 4), compressors=BloscCodec(cname='zstd', clevel=5))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_path)
+
+
+class TestRecord(TestBase):
+
+    def test_off(self):
+        self.assertIsInstance(self.img.load('0'), zarr.Array)
+        self.img.load('0')[0, 0, :4]
+        self.assertFalse(self.log.exists())
+
+    def test_record(self):
+        with record(self.log):
+            arr = self.img.load('0')
+            self.assertIsInstance(arr, RecordedArray)
+            self.assertIsInstance(arr, zarr.Array)
+            numpy.testing.assert_array_equal(arr[0, 0, 2:6, ..., :4], self.arr[0, 0, 2:6, :, :4])
+            arr.get_basic_selection((0, 0, 0))
+            self.img.load('0', pipeline=visor.Pipeline().bin((1, 2, 2)))[0, 0, :4]
+            roi = visor.ROI(self.img.path, '0', (0, 0, slice(0, 8), slice(0, 8)),
+                            pipeline=visor.Pipeline().bin((1, 2, 2)))
+            self.assertEqual(roi.load().shape, (8, 4, 8))
+        self.img.load('0')[:]
+
+        arrays, selections = read_log(self.log)
+        self.assertEqual(len(arrays), 1)
+        meta = list(arrays.values())[0]
+        self.assertEqual((meta['key'], meta['res']), ('visor_raw_images/slice_3.zarr', '0'))
+        self.assertEqual(meta['shards'], [1, 1, 8, 8, 8])
+        self.assertEqual([s['s'] for s in selections], [
+            [[0, 1], [0, 1], [2, 6], [0, 16], [0, 4]],
+            [[0, 1], [0, 1], [0, 1], [0, 16], [0, 16]],
+            [[0, 1], [0, 1], [0, 4], [0, 16], [0, 16]],
+            [[0, 1], [0, 1], [0, 8], [0, 8], [0, 16]],
+        ])
+        self.assertEqual([s.get('b') for s in selections], [None, None, [1, 1, 1, 2, 2], [1, 1, 1, 2, 2]])
+        self.assertTrue(all(s['ms'] >= 0 for s in selections))
+        # arrays are described once per log
+        self.assertEqual(sum(1 for line in open(self.log) if '"url"' in line), 1)
+
+
+class TestAnalyze(TestBase):
+
+    def test_analyze(self):
+        with record(self.log):
+            arr = self.img.load('0')
+            for _ in range(5):
+                arr[0, 0, 0, 0:8, 0:8]
+            arr[0, 0, 8:16, 8:16, 8:16]
+        with open(self.log, 'a') as f:
+            f.write('{"a": "torn')
+        report = analyze(self.log.parent)
+        r = report['arrays'][0]
+        self.assertEqual(r['n_reads'], 6)
+        self.assertEqual(r['heatmap'].shape, (1, 1, 2, 2, 2))
+        self.assertEqual(r['heatmap'][0, 0, 0, 0, 0], 5)
+        self.assertEqual(r['heatmap'][0, 0, 1, 1, 1], 1)
+        self.assertEqual(r['heatmap'].sum(), 6)
+        self.assertEqual(r['hot_shards'][0], {'shard': (0, 0, 0, 0, 0), 'key': 'c/0/0/0/0/0', 'n_reads': 5})
+        self.assertEqual(len(r['hot_shards']), 2)
+        self.assertEqual(r['read_shape'], (1, 1, 1, 8, 8))
+        # single z planes decode 4 planes of chunks
+        self.assertAlmostEqual(r['amplification'], (5 * 4 * 64 + 512) / (5 * 64 + 512))
+        self.assertEqual(r['recommended']['chunk_shape'], (1, 1, 1, 8, 8))
+        self.assertTrue(any('thinner than chunks' in s for s in r['suggestions']))
+        self.assertIn('slice_3.zarr/0: 6 reads', explain(report))
+
+    def test_levels(self):
+        with record(self.log):
+            for _ in range(3):
+                self.img.load('0', pipeline=visor.Pipeline().bin((2, 2, 2)))[:]
+            self.img.load('0')[0, 0, 0]
+        levels = analyze(self.log)['levels']
+        suggestions = levels[f'{self.img.storage.url}/{self.img.key}']
+        self.assertEqual(len(suggestions), 1)
+        self.assertIn('3 of 4 reads bin resolution 0 by 2x2x2 (z,y,x)', suggestions[0])
+
+
+if __name__ == '__main__':
+    unittest.main()
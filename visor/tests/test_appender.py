@@ -0,0 +1,111 @@
+# Run test at root directory with below:
+#   python -m unittest visor/tests/test_appender.py
+
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+import unittest
+import shutil
+import visor
+from visor.lock import sidecar
+import numpy
+from zarr.codecs import BloscCodec
+
+class TestBase(unittest.TestCase):
+
+    def setUp(self):
+        self.vsr_path = Path(__file__).parent/'data'/'VISOR001.vsr'
+        self.image_type = 'raw'
+        self.image_name = 'slice_1_10x'
+        self.another_image_name = 'slice_2_10x'
+        self.another_image_path = self.vsr_path/f'visor_{self.image_type}_images'/f'{self.another_image_name}.zarr'
+
+        img_base = visor.Image(
+            self.vsr_path,
+            image_type=self.image_type,
+            image_name=self.image_name,
+        )
+        self.img = visor.Image(
+            self.vsr_path,
+            image_type=self.image_type,
+            image_name=self.another_image_name,
+            create=True,
+        )
+        self.img.update_attrs(img_base.attrs)
+        self.dtype = 'uint16'
+
+    def tearDown(self):
+        if self.another_image_path.exists():
+            shutil.rmtree(self.another_image_path)
+        shutil.rmtree(sidecar(self.another_image_path), ignore_errors=True)
+
+    def create(self, shard_size):
+        self.img.save(
+            None,
+            resolution='0',
+            dtype=self.dtype,
+            shape=(2,2,0,4,4),
+            shard_size=shard_size,
+            chunk_size=(1,1,2,2,2),
+            compressors=BloscCodec(cname="zstd", clevel=5),
+        )
+
+
+class TestAppender(TestBase):
+
+    def test_append_frames_and_slabs(self):
+        self.create(shard_size=(1,1,4,4,4))
+        frames = numpy.random.randint(1, 255, size=(11,4,4), dtype=self.dtype)
+        with self.img.open_appender('0', stack='stack_2', channel='561') as app:
+            app.append(frames[0])
+            app.append(frames[1:6])
+            self.assertEqual(self.img.load('0').shape[2] % 4, 0)
+            app.append(frames[6:])
+            self.assertEqual(app.z, 11)
+
+        arr = self.img.load('0')
+        self.assertEqual(arr.shape, (2,2,11,4,4))
+        numpy.testing.assert_array_equal(arr[1:2,1:2], frames[None,None])
+        self.assertEqual(arr[0:1].sum(), 0)
+
+    def test_flush_partial_shard(self):
+        self.create(shard_size=(1,1,4,4,4))
+        frames = numpy.random.randint(1, 255, size=(6,4,4), dtype=self.dtype)
+        app = self.img.open_appender('0', stack=0, channel=0)
+        app.append(frames[:2])
+        app.flush()
+        self.assertEqual(self.img.load('0').shape[2], 2)
+        app.append(frames[2:])
+        app.close()
+        numpy.testing.assert_array_equal(self.img.load('0')[0:1,0:1], frames[None,None])
+
+    def test_append_concurrently_to_shared_shards(self):
+        # shards span all stacks and channels
+        self.create(shard_size=(2,2,4,4,4))
+        frames = numpy.random.randint(1, 255, size=(2,2,9,4,4), dtype=self.dtype)
+        n_frames = {(0,0): 9, (0,1): 5, (1,0): 8, (1,1): 3}
+
+        def acquire(key):
+            st, ch = key
+            with self.img.open_appender('0', stack=st, channel=ch, lock=True) as app:
+                for z in range(n_frames[key]):
+                    app.append(frames[st,ch,z])
+
+        with ThreadPoolExecutor(max_workers=4) as pool:
+            list(pool.map(acquire, n_frames))
+
+        arr = self.img.load('0')
+        self.assertEqual(arr.shape, (2,2,9,4,4))
+        for (st, ch), n in n_frames.items():
+            numpy.testing.assert_array_equal(arr[st:st+1,ch:ch+1,:n], frames[None,None,st,ch,:n])
+
+    def test_append_wrong_shape(self):
+        self.create(shard_size=(1,1,4,4,4))
+        with self.img.open_appender('0', stack=0, channel=0) as app:
+            with self.assertRaises(ValueError):
+                app.append(numpy.zeros((3,3), dtype=self.dtype))
+        with self.assertRaises(ValueError):
+            app.append(numpy.zeros((4,4), dtype=self.dtype))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,82 @@
+# Run test at root directory with below:
+#   python -m unittest visor/tests/test_blocks.py
+
+from pathlib import Path
+import shutil
+import tempfile
+import unittest
+import numpy
+from zarr.codecs import BloscCodec
+import visor
+from visor.lock import lock_dir
+from visor.memory import budget
+
+class TestBase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_path = Path(tempfile.mkdtemp())
+        self.vsr_path = self.tmp_path/'VISOR001.vsr'
+        shutil.copytree(Path(__file__).parent/'data'/'VISOR001.vsr', self.vsr_path)
+        rng = numpy.random.default_rng(0)
+        self.arr = rng.integers(0, 1000, (1, 2, 10, 12, 12), dtype='uint16')
+        self.kwargs = dict(dtype='uint16', shape=self.arr.shape, shard_size=(1, 1, 4, 4, 4),
+                           chunk_size=(1, 1, 2, 2, 2), compressors=BloscCodec(cname='zstd', clevel=5))
+        self.img = visor.Image(self.vsr_path, image_type='raw', image_name='slice_3', create=True)
+        self.img.save(self.arr, '0', **self.kwargs)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_path)
+
+
+class TestIterBlocks(TestBase):
+
+    def test_halo(self):
+        src = numpy.pad(self.arr[0, 1], 2, mode='reflect')
+        blocks = self.img.iter_blocks('0', halo=2, channel=1)
+        self.assertEqual(len(blocks), 3 * 3 * 3)
+        n = 0
+        for b in blocks:
+            lo = [c.start for c in b.core]
+            hi = [c.stop + 4 for c in b.core]
+            numpy.testing.assert_array_equal(b.data, src[tuple(map(slice, lo, hi))])
+            numpy.testing.assert_array_equal(b.crop(), self.arr[(0, 1) + b.core])
+            n += 1
+        self.assertEqual(n, 27)
+        # every chunk decoded once, halos served from the cache
+        self.assertEqual(blocks.cache.n_decoded, 5 * 6 * 6)
+        self.assertGreater(blocks.cache.n_hits, 0)
+        self.assertEqual(budget.stats()['used'], 0)
+
+    def test_clip(self):
+        blocks = self.img.iter_blocks('0', block_shape=(8, 8, 8), halo=(1, 0, 3), boundary=None)
+        shapes = [b.data.shape for b in blocks]
+        self.assertEqual(shapes[0], (9, 8, 11))
+        self.assertEqual(shapes[-1], (3, 4, 7))
+        with self.assertRaises(ValueError):
+            self.img.iter_blocks('0', block_shape=(2, 4, 4))
+
+    def test_writer(self):
+        out = visor.Image(self.vsr_path, image_type='raw', image_name='slice_3_out', create=True)
+        out.save(None, '0', **self.kwargs)
+        with out.open_block_writer('0') as writer:
+            for ch in (0, 1):
+                for b in self.img.iter_blocks('0', halo=1, channel=ch, prefetch=2):
+                    writer.write(b, b.data * 2)
+        numpy.testing.assert_array_equal(out.load('0')[:], self.arr * 2)
+        with self.assertRaises(ValueError):
+            writer.write(b)
+
+    def test_writer_coarser_shards(self):
+        # cores of 4 voxels share the 8 voxel shards of the target, writes are locked
+        out = visor.Image(self.vsr_path, image_type='raw', image_name='slice_3_out', create=True)
+        out.save(None, '0', **(self.kwargs | {'shard_size': (1, 1, 8, 8, 8)}))
+        with out.open_block_writer('0', max_workers=8) as writer:
+            for ch in (0, 1):
+                for b in self.img.iter_blocks('0', channel=ch):
+                    writer.write(b, b.data + 1)
+        numpy.testing.assert_array_equal(out.load('0')[:], self.arr + 1)
+        self.assertTrue((lock_dir(out.path)/'0'/'0.1.0.0.0.lock').exists())
+
+
+if __name__ == '__main__':
+    unittest.main()
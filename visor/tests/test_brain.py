@@ -0,0 +1,72 @@
+# Run test at root directory with below:
+#   python -m unittest visor/tests/test_brain.py
+
+from pathlib import Path
+import unittest
+import shutil
+import tempfile
+import visor
+import numpy
+
+class TestBase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_path = Path(tempfile.mkdtemp())
+        self.vsr_path = self.tmp_path/'VISOR001.vsr'
+        shutil.copytree(Path(__file__).parent/'data'/'VISOR001.vsr', self.vsr_path)
+        self.recon_version = 'test_20250601'
+        self.slice_name = 'slice_1_10x'
+
+        # stack_2 sits next to stack_1 along x
+        xfm = visor.Transform(self.vsr_path, recon_version=self.recon_version,
+                              slice_name=self.slice_name, create=True)
+        for st, x0 in ((0, 0.0), (1, 4 * 1.03)):
+            xfm.save(from_space='raw', to_space='brain', t_type='affine', t_format='tfm',
+                     params=[st, 0, 1.03, 0, 0, 0, 1.03, 0, 0, 0, 3.5, x0, 0, 0])
+        xfm.update_meta(
+            recon={'spaces': ['raw', 'brain'],
+                   'slices': [{'name': self.slice_name, 'transforms': ['raw_to_brain']}]},
+            trans=[{'name': 'raw_to_brain', 'type': 'affine', 'format': 'tfm'}],
+        )
+        self.vsr = visor.VSR(self.vsr_path)
+        self.arr = visor.Image(self.vsr_path, image_type='raw',
+                               image_name=self.slice_name).load('0')[:]
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_path)
+
+
+class TestBrainVolume(TestBase):
+
+    def test_assemble(self):
+        vol = self.vsr.brain_volume(self.recon_version, channel='488', resolution='0')
+        self.assertEqual(vol.shape, (4, 4, 8))
+        self.assertEqual(vol.dtype, self.arr.dtype)
+        numpy.testing.assert_allclose(vol.voxel_size, [3.5, 1.03, 1.03])
+        numpy.testing.assert_array_equal(vol[:, :, :], numpy.concatenate(
+            [self.arr[0, 0], self.arr[1, 0]], axis=2))
+
+    def test_blocks_and_cache(self):
+        vol = visor.brain.BrainVolume(self.vsr, self.recon_version, channel='488',
+                                      resolution='0', block_shape=(3, 3, 3), cache_blocks=4)
+        ref = numpy.concatenate([self.arr[0, 0], self.arr[1, 0]], axis=2)
+        numpy.testing.assert_array_equal(vol[1:4, 2, 3:7], ref[1:4, 2, 3:7])
+        self.assertLessEqual(len(vol._cache), 4)
+        numpy.testing.assert_array_equal(vol[:, :, :], ref)
+
+    def test_linear_mean(self):
+        vol = visor.brain.BrainVolume(self.vsr, self.recon_version, channel='488',
+                                      resolution='0', interp='linear', blend='mean')
+        self.assertEqual(vol.dtype, numpy.float32)
+        numpy.testing.assert_allclose(vol[:, :, :4], self.arr[0, 0], rtol=1e-5)
+
+    def test_no_transform(self):
+        with self.assertRaises(FileNotFoundError):
+            self.vsr.brain_volume(self.recon_version, channel='561', resolution='0')
+        with self.assertRaises(FileNotFoundError):
+            self.vsr.brain_volume(self.recon_version, channel='488', resolution='0',
+                                  space='ortho')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,111 @@
+# Run test at root directory with below:
+#   python -m unittest visor/tests/test_checksum.py
+
+from pathlib import Path
+import os
+import unittest
+import shutil
+import tempfile
+import visor
+import numpy
+from zarr.codecs import BloscCodec
+from visor.checksum import load_manifest, manifest_path, hash_file, GROUP, JOURNAL
+
+class TestBase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_path = Path(tempfile.mkdtemp())
+        self.vsr_path = self.tmp_path/'VISOR001.vsr'
+        shutil.copytree(Path(__file__).parent/'data'/'VISOR001.vsr', self.vsr_path)
+        self.img = visor.Image(self.vsr_path, image_type='raw',
+                               image_name='slice_2_10x', create=True)
+        self.img.save(
+            numpy.random.randint(1, 255, size=(2,2,4,4,4), dtype='uint16'),
+            resolution='0',
+            dtype='uint16',
+            shape=(2,2,4,4,4),
+            shard_size=(1,1,4,4,4),
+            chunk_size=(1,1,2,2,2),
+            compressors=BloscCodec(cname="zstd", clevel=5),
+        )
+        self.shard = self.img.path/'0'/'c'/'1'/'0'/'0'/'0'/'0'
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_path)
+
+
+class TestChecksum(TestBase):
+
+    def test_recorded_at_write(self):
+        manifest = load_manifest(self.img.path)
+        self.assertEqual(len(manifest['0']), 4)
+        self.assertIn('c/1/0/0/0/0', manifest['0'])
+        self.assertEqual(manifest['0']['c/1/0/0/0/0']['hash'], hash_file(self.shard))
+        # the manifest is a sub-group of the image, copied along with it
+        self.assertTrue(manifest_path(self.img.path, JOURNAL).exists())
+        self.assertTrue((self.img.path/GROUP/'zarr.json').is_file())
+        self.assertEqual(list(self.img.zgroup.array_keys()), ['0'])
+        copy = self.tmp_path/'copy.zarr'
+        shutil.copytree(self.img.path, copy)
+        self.assertEqual(load_manifest(copy), manifest)
+
+    def test_recorded_through_load(self):
+        arr = self.img.load('0')
+        arr[1, 0, :2] = 0
+        arr.oindex[0, [1], :, [3]] = 0
+        self.assertEqual(self.img.verify(), {'ok': 4, 'skipped': 0, 'missing': [], 'corrupt': [], 'extra': []})
+
+    def test_verify_ok(self):
+        report = self.img.verify()
+        self.assertEqual(report, {'ok': 4, 'skipped': 0, 'missing': [], 'corrupt': [], 'extra': []})
+        # verification compacts the journal
+        self.assertTrue(manifest_path(self.img.path).exists())
+        self.assertEqual(manifest_path(self.img.path, JOURNAL).stat().st_size, 0)
+
+    def test_verify_corrupt_missing_extra(self):
+        # corruption after writing, e.g. in transit, is caught on the first verification
+        data = bytearray(self.shard.read_bytes())
+        data[0] ^= 0xff
+        self.shard.write_bytes(bytes(data))
+        (self.img.path/'0'/'c'/'0'/'0'/'0'/'0'/'0').unlink()
+        (self.img.path/'0'/'c'/'0'/'0'/'0'/'0'/'1').write_bytes(b'x')
+
+        report = self.img.verify(processes=True)
+        self.assertEqual(report['ok'], 2)
+        self.assertEqual(report['corrupt'], ['0/c/1/0/0/0/0'])
+        self.assertEqual(report['missing'], ['0/c/0/0/0/0/0'])
+        self.assertEqual(report['extra'], ['0/c/0/0/0/0/1'])
+
+    def test_verify_incremental(self):
+        self.img.verify()
+        report = self.img.verify(incremental=True)
+        self.assertEqual((report['ok'], report['skipped']), (0, 4))
+
+        # shards written through visor are hashed with their stats at write time
+        self.img.write(numpy.ones((1,1,4,4,4), dtype='uint16'), '0', region=(0,0))
+        report = self.img.verify(incremental=True)
+        self.assertEqual((report['ok'], report['skipped']), (0, 4))
+        self.assertEqual(self.img.verify()['ok'], 4)
+
+        # a shard touched outside of visor is re-hashed
+        os.utime(self.shard, ns=(0, 0))
+        report = self.img.verify(incremental=True)
+        self.assertEqual((report['ok'], report['skipped']), (1, 3))
+        report = self.img.verify(incremental=True)
+        self.assertEqual((report['ok'], report['skipped']), (0, 4))
+
+    def test_vsr_verify(self):
+        # images written before checksums were recorded report extra shards
+        reports = visor.VSR(self.vsr_path).verify()
+        self.assertEqual(reports['raw']['slice_2_10x']['ok'], 4)
+        self.assertEqual(len(reports['raw']['slice_1_10x']['extra']), 4)
+        self.assertEqual(len(reports['compr']['xxx_slice_1_10x_20241201']['extra']), 4)
+
+        visor.Image(self.vsr_path, image_type='raw', image_name='slice_1_10x').record_checksums()
+        reports = visor.VSR(self.vsr_path).verify(incremental=True)
+        self.assertEqual(reports['raw']['slice_1_10x']['skipped'], 4)
+        self.assertEqual(reports['raw']['slice_1_10x']['extra'], [])
+
+
+if __name__ == '__main__':
+    unittest.main()
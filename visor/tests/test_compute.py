@@ -0,0 +1,93 @@
+# Run test at root directory with below:
+#   python -m unittest visor/tests/test_compute.py
+
+from pathlib import Path
+import unittest
+import shutil
+import visor
+from visor.checksum import load_manifest
+from visor.lock import lock_dir, sidecar
+import numpy
+from zarr.codecs import BloscCodec
+from visor.compute import lazy
+
+class TestBase(unittest.TestCase):
+
+    def setUp(self):
+        self.vsr_path = Path(__file__).parent/'data'/'VISOR001.vsr'
+        self.img = visor.Image(self.vsr_path, image_type='raw', image_name='slice_1_10x')
+        self.zarr_arr = self.img.load('0')
+        self.arr = self.zarr_arr[:]
+        self.another_image_path = self.vsr_path/'visor_raw_images'/'slice_2_10x.zarr'
+
+    def tearDown(self):
+        if self.another_image_path.exists():
+            shutil.rmtree(self.another_image_path)
+        shutil.rmtree(sidecar(self.another_image_path), ignore_errors=True)
+
+
+class TestCompute(TestBase):
+
+    def test_reductions(self):
+        la = lazy(self.zarr_arr)
+        self.assertEqual(la.shape, (2, 2, 4, 4, 4))
+        self.assertEqual(la.sum(), self.arr.sum())
+        self.assertEqual(la.min(), self.arr.min())
+        self.assertEqual(la.max(), self.arr.max())
+        self.assertAlmostEqual(la.mean(), self.arr.mean())
+        self.assertEqual(la.threshold(100).count(), numpy.count_nonzero(self.arr > 100))
+
+    def test_region(self):
+        la = lazy(self.zarr_arr, (1, 0, slice(1, 3)))
+        self.assertEqual(la.shape, (1, 1, 2, 4, 4))
+        numpy.testing.assert_array_equal(la.compute(), self.arr[1:2, 0:1, 1:3])
+        self.assertEqual(la.sum(max_workers=1), self.arr[1:2, 0:1, 1:3].sum())
+
+    def test_elementwise(self):
+        a = lazy(self.zarr_arr).astype('float32')
+        b = lazy(self.zarr_arr, (slice(None), slice(None)))
+        expr = (a * 2 + 1) / (b + 1) - (b > 50)
+        self.assertEqual(expr.dtype, numpy.float32)
+        ref = (self.arr.astype('float32') * 2 + 1) / (self.arr + 1) - (self.arr > 50)
+        numpy.testing.assert_allclose(expr.compute(), ref, rtol=1e-6)
+        self.assertEqual(((b > 10) & (b < 200)).count(),
+                         numpy.count_nonzero((self.arr > 10) & (self.arr < 200)))
+        with self.assertRaises(ValueError):
+            a + lazy(self.zarr_arr, (0,))
+
+    def test_map_blocks_to_zarr(self):
+        img = visor.Image(self.vsr_path, image_type='raw', image_name='slice_2_10x', create=True)
+        target = img.save(None, resolution='0', dtype='uint16', shape=self.arr.shape,
+                          shard_size=(1,1,4,4,4), chunk_size=(1,1,2,2,2),
+                          compressors=BloscCodec(cname="zstd", clevel=5))
+        lazy(self.zarr_arr).map_blocks(lambda x: x // 2).to_zarr(target)
+        numpy.testing.assert_array_equal(img.load('0')[:], self.arr // 2)
+
+    def test_to_image(self):
+        # target shards are coarser than the blocks, writes are locked
+        img = visor.Image(self.vsr_path, image_type='raw', image_name='slice_2_10x', create=True)
+        img.save(None, resolution='0', dtype='uint16', shape=(2,2,2,4,4),
+                 shard_size=(2,2,2,4,4), chunk_size=(1,1,2,2,2),
+                 compressors=BloscCodec(cname="zstd", clevel=5))
+        la = lazy(self.zarr_arr, (slice(None), slice(None), slice(1, 3))) + 1
+        with self.assertRaises(ValueError):
+            la.to_zarr(img)
+        la.to_zarr(img, resolution='0')
+        numpy.testing.assert_array_equal(img.load('0')[:], self.arr[:, :, 1:3] + 1)
+        self.assertTrue((lock_dir(self.another_image_path)/'0'/'0.0.0.0.0.lock').exists())
+        self.assertIn('c/0/0/0/0/0', load_manifest(self.another_image_path)['0'])
+
+    def test_shard_grid(self):
+        # blocks follow the absolute shard grid, not the region origin
+        img = visor.Image(self.vsr_path, image_type='raw', image_name='slice_2_10x', create=True)
+        arr = img.save(numpy.arange(16**3, dtype='uint16').reshape(1,1,16,16,16), resolution='0',
+                       dtype='uint16', shape=(1,1,16,16,16), shard_size=(1,1,8,8,8),
+                       chunk_size=(1,1,4,4,4), compressors=BloscCodec(cname="zstd", clevel=5))
+        la = lazy(arr, (0, 0, slice(3, 13), slice(0, 8)))
+        self.assertEqual([(r[2].start, r[2].stop, r[4].start) for r in la._regions()],
+                         [(0, 5, 0), (0, 5, 8), (5, 10, 0), (5, 10, 8)])
+        self.assertEqual(la.sum(), arr[0, 0, 3:13, 0:8].sum(dtype='uint64'))
+
+
+if __name__ == '__main__':
+    unittest.main()
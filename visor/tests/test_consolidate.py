@@ -0,0 +1,123 @@
+# Run test at root directory with below:
+#   python -m unittest visor/tests/test_consolidate.py
+
+from pathlib import Path
+import json
+import shutil
+import tempfile
+import unittest
+import numpy
+from zarr.codecs import BloscCodec
+import visor
+from visor.consolidate import VSR_META
+from visor.storage import LocalStorage, ObjectStorage, LocalObjectClient
+
+class TestBase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = Path(tempfile.mkdtemp())
+        self.vsr_path = self.tmp/'VISOR001.vsr'
+        shutil.copytree(Path(__file__).parent/'data'/'VISOR001.vsr', self.vsr_path)
+        self.vsr = visor.VSR(self.vsr_path)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+
+class TestConsolidate(TestBase):
+
+    def test_same_listings(self):
+        images, transforms, info = self.vsr.images(), self.vsr.transforms(), self.vsr.info()
+        self.vsr.consolidate()
+        self.assertTrue((self.vsr_path/VSR_META).is_file())
+        vsr = visor.VSR(self.vsr_path)
+        self.assertEqual(vsr.images(), images)
+        self.assertEqual(vsr.transforms(), transforms)
+        self.assertEqual(sorted(vsr.info()['image_types']), sorted(info['image_types']))
+
+    def test_image_group(self):
+        self.vsr.consolidate()
+        with open(self.vsr_path/'visor_raw_images'/'slice_1_10x.zarr'/'zarr.json') as f:
+            meta = json.load(f)
+        self.assertIn('0', meta['consolidated_metadata']['metadata'])
+        img = visor.Image(self.vsr_path, image_type='raw', image_name='slice_1_10x')
+        self.assertIsNotNone(img.zgroup.metadata.consolidated_metadata)
+        self.assertEqual(img.load('0').shape, (2, 2, 4, 4, 4))
+
+    def test_single_read(self):
+        self.vsr.consolidate()
+        clients = []
+        def client():
+            clients.append(LocalObjectClient(self.tmp/'bucket'))
+            return clients[-1]
+        storage = ObjectStorage('VISOR001.vsr', client)
+        local = LocalStorage(self.vsr_path)
+        for k in local.list():
+            storage.put(k, local.get(k))
+        for c in clients:
+            c.n_requests = 0
+        vsr = visor.VSR(storage)
+        # root listing and the consolidated document, read once per VSR
+        n_requests = sum(c.n_requests for c in clients)
+        self.assertLessEqual(n_requests, 3)
+        vsr.images()
+        vsr.transforms()
+        vsr.info()
+        self.assertEqual(sum(c.n_requests for c in clients), n_requests)
+
+    def test_sync(self):
+        self.vsr.consolidate()
+        img = visor.Image(self.vsr_path, image_type='raw', image_name='slice_1_10x')
+        scale = [1.0, 1.0, 2.0, 2.0, 2.0]
+        datasets = img.attrs['ome']['multiscales'][0]['datasets'] + \
+            [{'path': '1', 'coordinateTransformations': [{'type': 'scale', 'scale': scale}]}]
+        img.update_attrs({'ome': {'multiscales': [dict(img.attrs['ome']['multiscales'][0],
+                                                       datasets=datasets)]}})
+        arr = numpy.ones((2, 2, 2, 2, 2), dtype='uint16')
+        img.save(arr, '1', dtype='uint16', shape=arr.shape, shard_size=(1, 1, 2, 2, 2),
+                 chunk_size=(1, 1, 2, 2, 2), compressors=BloscCodec())
+        self.assertEqual(visor.VSR(self.vsr_path).images('raw')[0]['resolutions']['1'], scale)
+        img = visor.Image(self.vsr_path, image_type='raw', image_name='slice_1_10x')
+        self.assertIn('1', img.zgroup.metadata.consolidated_metadata.metadata)
+        numpy.testing.assert_array_equal(img.load('1')[:], arr)
+
+        xfm = visor.Transform(self.vsr_path, recon_version='xxx_20250525', slice_name='slice_1_10x')
+        recon = self.vsr.transforms('xxx_20250525')
+        recon['spaces'].append('atlas')
+        xfm.update_meta(recon=recon)
+        self.assertIn('atlas', visor.VSR(self.vsr_path).transforms('xxx_20250525')['spaces'])
+        self.assertNotIn('atlas', self.vsr.transforms('xxx_20250525')['spaces'])
+        self.vsr.refresh()
+        self.assertIn('atlas', self.vsr.transforms('xxx_20250525')['spaces'])
+
+    def test_version_without_recon(self):
+        self.vsr.consolidate()
+        xfm = visor.Transform(self.vsr_path, recon_version='yyy_20260101', slice_name='slice_1_10x',
+                              create=True)
+        xfm.update_meta(trans=[{'name': 'raw_to_brain', 'type': 'affine', 'format': 'tfm'}])
+        self.vsr.refresh()
+        self.assertEqual(self.vsr.transforms('yyy_20260101'), {'spaces': [], 'slices': []})
+        self.vsr.consolidate()
+        self.assertEqual(self.vsr.transforms('yyy_20260101'), {'spaces': [], 'slices': []})
+
+    def test_sync_unconsolidated(self):
+        # nothing to update, nor any lock file in the .vsr root
+        img = visor.Image(self.vsr_path, image_type='raw', image_name='slice_1_10x')
+        img.update_attrs({'visor': img.attrs['visor']})
+        self.assertFalse((self.vsr_path/VSR_META).exists())
+        self.assertFalse((self.vsr_path/'.locks').exists())
+
+    def test_appender_sync(self):
+        img = visor.Image(self.vsr_path, image_type='raw', image_name='slice_1_10x')
+        img.save(None, '1', dtype='uint16', shape=(1, 1, 0, 4, 4), shard_size=(1, 1, 2, 4, 4),
+                 chunk_size=(1, 1, 2, 4, 4), compressors=BloscCodec())
+        img.consolidate()
+        with img.open_appender('1', 0, 0) as app:
+            app.append(numpy.ones((3, 4, 4), dtype='uint16'))
+        img = visor.Image(self.vsr_path, image_type='raw', image_name='slice_1_10x')
+        self.assertEqual(img.zgroup.metadata.consolidated_metadata.metadata['1'].shape, (1, 1, 3, 4, 4))
+        self.assertEqual(img.load('1')[:].sum(), 48)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,85 @@
+# Run test at root directory with below:
+#   python -m unittest visor/tests/test_decode.py
+
+from pathlib import Path
+import shutil
+import tempfile
+import unittest
+import numpy
+from zarr.codecs import BloscCodec
+import visor
+from visor.decode import DecodePool
+from visor.memory import budget
+from visor.storage import MemoryStorage
+
+class TestBase(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.pool = DecodePool(max_workers=2, ring_size=3, slot_bytes=4096)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.pool.close()
+
+    def setUp(self):
+        self.tmp_path = Path(tempfile.mkdtemp())
+        self.vsr_path = self.tmp_path/'VISOR001.vsr'
+        shutil.copytree(Path(__file__).parent/'data'/'VISOR001.vsr', self.vsr_path)
+        self.arr = numpy.random.default_rng(0).integers(0, 1000, (2, 2, 16, 16, 16), dtype='uint16')
+        self.img = visor.Image(self.vsr_path, image_type='raw', image_name='slice_3', create=True)
+        self.img.save(self.arr, '0', dtype='uint16', shape=self.arr.shape,
+                      shard_size=(1, 1, 16, 16, 16), chunk_size=(1, 1, 4, 8, 8),
+                      compressors=BloscCodec(cname='zstd', clevel=5))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_path)
+
+
+class TestDecodePool(TestBase):
+
+    def test_read(self):
+        numpy.testing.assert_array_equal(self.pool.read(self.img, '0'), self.arr)
+        region = (1, slice(0, 2), slice(3, 13), 5, slice(None))
+        numpy.testing.assert_array_equal(self.pool.read(self.img, '0', region), self.arr[region])
+
+    def test_blocks(self):
+        n = self.pool.n_blocks
+        out = numpy.zeros_like(self.arr)
+        for block, view in self.pool.blocks(self.img, '0'):
+            # shards of 8 KiB are split into slots of 4 KiB along z chunks
+            self.assertEqual(view.shape, (1, 1, 8, 16, 16))
+            out[block] = view
+        numpy.testing.assert_array_equal(out, self.arr)
+        self.assertEqual(self.pool.n_blocks - n, 8)
+        self.assertEqual(len(self.pool._free), 3)
+
+    def test_roi(self):
+        roi = visor.ROI(self.img.path, resolution='0', ranges=(0, 1),
+                        pipeline=visor.Pipeline().astype('float32').bin((1, 2, 2)))
+        numpy.testing.assert_array_equal(roi.load(pool=self.pool), roi.load())
+
+    def test_memory_storage(self):
+        storage = MemoryStorage('decode_test.vsr')
+        storage.put('info.json', (self.vsr_path/'info.json').read_bytes())
+        try:
+            img = visor.Image(storage, image_type='raw', image_name='slice_1', create=True)
+            img.save(self.arr, '0', dtype='uint16', shape=self.arr.shape,
+                     shard_size=(1, 1, 16, 16, 16), chunk_size=(1, 1, 4, 8, 8),
+                     compressors=BloscCodec(cname='zstd', clevel=5))
+            with self.assertRaises(ValueError):
+                self.pool.read(img, '0')
+        finally:
+            MemoryStorage.drop('decode_test.vsr')
+
+    def test_close(self):
+        used = budget.stats()['used']
+        with DecodePool(max_workers=1, ring_size=2, slot_bytes=2**16) as pool:
+            self.assertEqual(budget.stats()['used'], used + 2**17)
+        self.assertEqual(budget.stats()['used'], used)
+        with self.assertRaises(ValueError):
+            list(pool.blocks(self.img, '0'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,47 @@
+# Run test at root directory with below:
+#   python -m unittest visor/tests/test_discovery.py
+
+from pathlib import Path
+import unittest
+from visor.discovery import scan_dirs, read_jsons
+
+class TestBase(unittest.TestCase):
+
+    def setUp(self):
+        self.vsr_path = Path(__file__).parent/'data'/'VISOR001.vsr'
+
+
+class TestDiscovery(TestBase):
+
+    def setUp(self):
+        super().setUp()
+
+    def test_scan_dirs(self):
+        self.assertEqual(sorted(scan_dirs(self.vsr_path, 'visor_', '_images')),
+                         ['visor_compr_images', 'visor_raw_images'])
+        # files are skipped
+        self.assertNotIn('selected.json', scan_dirs(self.vsr_path/'visor_raw_images'))
+        self.assertEqual(sorted(scan_dirs(self.vsr_path/'visor_raw_images', suffix='.zarr')),
+                         ['slice_1_10x.zarr', 'slice_1_10x_1.zarr'])
+
+    def test_scan_dirs_not_exist(self):
+        self.assertEqual(scan_dirs(self.vsr_path/'not_exist'), [])
+
+    def test_read_jsons(self):
+        raw_path = self.vsr_path/'visor_raw_images'
+        paths = [raw_path/'slice_1_10x_1.zarr'/'zarr.json',
+                 raw_path/'slice_1_10x.zarr'/'zarr.json',
+                 raw_path/'selected.json']
+        metas = read_jsons(paths, max_workers=2)
+        self.assertEqual(len(metas), 3)
+        self.assertEqual(metas[0]['attributes']['ome']['multiscales'][0]['name'], 'slice_1_10x_1')
+        self.assertEqual(metas[1]['attributes']['ome']['multiscales'][0]['name'], 'slice_1_10x')
+        self.assertEqual(metas[2][0]['name'], 'slice_1_10x')
+
+    def test_read_jsons_not_exist(self):
+        with self.assertRaises(FileNotFoundError):
+            read_jsons([self.vsr_path/'info.json', self.vsr_path/'not_exist.json'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,61 @@
+# Run test at root directory with below:
+#   python -m unittest visor/tests/test_export.py
+
+from pathlib import Path
+import importlib.util
+import unittest
+import shutil
+import tempfile
+import visor
+import numpy
+
+class TestBase(unittest.TestCase):
+
+    def setUp(self):
+        self.vsr_path = Path(__file__).parent/'data'/'VISOR001.vsr'
+        self.img = visor.Image(self.vsr_path, image_type='raw', image_name='slice_1_10x')
+        self.arr = self.img.load('0')[:]
+        self.tmp_path = Path(tempfile.mkdtemp())
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_path)
+
+
+class TestExport(TestBase):
+
+    def test_export_raw(self):
+        out = self.tmp_path/'out.raw'
+        meta = self.img.export(out, format='raw', stack='stack_2', channel='561')
+        self.assertEqual(meta, {'shape': (4, 4, 4), 'dtype': '<u2', 'offset': 0})
+        data = numpy.fromfile(out, dtype='<u2').reshape(meta['shape'])
+        numpy.testing.assert_array_equal(data, self.arr[1, 1])
+
+    def test_export_raw_region(self):
+        out = self.tmp_path/'out.raw'
+        meta = self.img.export(out, format='raw', stack=0, channel=1,
+                               region=(slice(1, 4), 2, slice(None, 3)))
+        self.assertEqual(meta['shape'], (3, 1, 3))
+        data = numpy.fromfile(out, dtype='<u2').reshape(meta['shape'])
+        numpy.testing.assert_array_equal(data, self.arr[0, 1, 1:4, 2:3, :3])
+
+    def test_export_invalid_format(self):
+        with self.assertRaises(ValueError):
+            self.img.export(self.tmp_path/'out.png', format='png')
+
+    @unittest.skipUnless(importlib.util.find_spec('tifffile'), 'requires tifffile')
+    def test_export_ome_tiff(self):
+        import tifffile
+        for bigtiff in (False, True):
+            out = self.tmp_path/f'out_{bigtiff}.ome.tif'
+            self.img.export(out, stack=1, channel=0, bigtiff=bigtiff)
+            with tifffile.TiffFile(out) as tif:
+                self.assertEqual(tif.is_bigtiff, bigtiff)
+                self.assertTrue(tif.is_ome)
+                self.assertEqual(len(tif.pages), 4)
+                numpy.testing.assert_array_equal(tif.asarray(), self.arr[1, 0])
+                self.assertIn('PhysicalSizeZ="3.5"', tif.ome_metadata)
+                self.assertIn('Name="488"', tif.ome_metadata)
+
+
+if __name__ == '__main__':
+    unittest.main()
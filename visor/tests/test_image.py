@@ -2,9 +2,12 @@
 #   python -m unittest visor/tests/test_image.py
 
 from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
 import unittest
 import shutil
 import visor
+from visor.lock import lock_dir, sidecar
+from visor.shard import assign_shards, shard_region
 import zarr
 import numpy
 import dask.array as da
@@ -29,6 +32,7 @@ class TestImage(TestBase):
     def tearDown(self):
         if self.another_image_path.exists():
             shutil.rmtree(self.another_image_path)
+        shutil.rmtree(sidecar(self.another_image_path), ignore_errors=True)
 
     def test_init(self):
         img = visor.Image(
@@ -143,6 +147,7 @@ class TestImageSave(TestBase):
     def tearDown(self):
         if self.another_image_path.exists():
             shutil.rmtree(self.another_image_path)
+        shutil.rmtree(sidecar(self.another_image_path), ignore_errors=True)
 
     def test_save(self):
 
@@ -189,6 +194,142 @@ class TestImageSave(TestBase):
         self.assertNotEqual(updated_part.sum(), 0) # should be updated
         self.assertEqual(not_updated_part.sum(), 0) # should not be updated
 
+    def test_save_with_data(self):
+        arr = numpy.random.randint(1, 255, size=self.new_arr_shape, dtype=self.dtype)
+        self.img.save(
+            arr,
+            resolution='0',
+            dtype=self.dtype,
+            shape=self.new_arr_shape,
+            shard_size=self.new_arr_shard_size,
+            chunk_size=self.new_arr_chunk_size,
+            compressors=BloscCodec(cname="zstd", clevel=5),
+        )
+        numpy.testing.assert_array_equal(self.img.load(resolution='0')[:], arr)
+
+
+class TestImageWrite(TestBase):
+
+    def setUp(self):
+        super().setUp()
+        self.new_arr_shape      = (2,2,4,4,4)
+        self.new_arr_shard_size = (1,1,4,4,4)
+        self.new_arr_chunk_size = (1,1,2,2,2)
+        self.dtype = 'uint16'
+
+        self.img = visor.Image(
+            self.vsr_path,
+            image_type=self.image_type,
+            image_name=self.another_image_name,
+            create=True,
+        )
+        self.random_partial_arr = numpy.random.randint(
+            1, 255,
+            size=[1,2,4,4,4],
+            dtype=self.dtype,
+        )
+        self.img.save(
+            None,
+            resolution='0',
+            dtype=self.dtype,
+            shape=self.new_arr_shape,
+            shard_size=self.new_arr_shard_size,
+            chunk_size=self.new_arr_chunk_size,
+            compressors=BloscCodec(cname="zstd", clevel=5),
+        )
+
+    def tearDown(self):
+        if self.another_image_path.exists():
+            shutil.rmtree(self.another_image_path)
+        shutil.rmtree(sidecar(self.another_image_path), ignore_errors=True)
+
+    def test_write_region(self):
+        self.img.write(self.random_partial_arr, resolution='0', region=(1,), lock=True)
+        arr = self.img.load(resolution='0')
+        numpy.testing.assert_array_equal(arr[1:2], self.random_partial_arr)
+        self.assertEqual(arr[0:1].sum(), 0)
+        self.assertTrue((lock_dir(self.another_image_path)/'0'/'1.0.0.0.0.lock').exists())
+        self.assertFalse((self.another_image_path/'.locks').exists())
+
+    def test_write_planned_shards(self):
+        full = numpy.random.randint(1, 255, size=self.new_arr_shape, dtype=self.dtype)
+        arr = self.img.load(resolution='0')
+
+        def writer(shards):
+            for s in shards:
+                region = shard_region(arr, s)
+                self.img.write(full[region], resolution='0', region=region)
+
+        with ThreadPoolExecutor(max_workers=4) as pool:
+            list(pool.map(writer, assign_shards(arr, 4)))
+        numpy.testing.assert_array_equal(self.img.load(resolution='0')[:], full)
+
+    def test_write_overlapping_with_lock(self):
+        # every writer updates one z plane of the same shard
+        planes = numpy.random.randint(1, 255, size=(1,1,4,4,4), dtype=self.dtype)
+
+        def writer(z):
+            self.img.write(planes[:,:,z:z+1], resolution='0',
+                           region=(0, 0, slice(z, z+1)), lock=True)
+
+        with ThreadPoolExecutor(max_workers=4) as pool:
+            list(pool.map(writer, range(4)))
+        numpy.testing.assert_array_equal(self.img.load(resolution='0')[0:1,0:1], planes)
+
+
+class TestImageUpdateAttrs(TestBase):
+
+    def setUp(self):
+        super().setUp()
+        self.img = visor.Image(
+            self.vsr_path,
+            image_type=self.image_type,
+            image_name=self.another_image_name,
+            create=True,
+        )
+
+    def tearDown(self):
+        if self.another_image_path.exists():
+            shutil.rmtree(self.another_image_path)
+        shutil.rmtree(sidecar(self.another_image_path), ignore_errors=True)
+
+    def test_update_attrs(self):
+        self.img.update_attrs({'visor': {'visor_stacks': [{'index': 0, 'label': 'stack_1'}]}})
+        self.assertEqual(self.img.attrs['visor']['visor_stacks'][0]['label'], 'stack_1')
+        self.img.update_attrs({'ome': {'version': '0.5'}})
+        self.assertIn('visor', self.img.attrs)
+        # top-level keys are replaced, not merged
+        self.img.update_attrs({'visor': {'channels': []}})
+        self.assertEqual(self.img.attrs['visor'], {'channels': []})
+        self.assertIn('ome', visor.Image(
+            self.vsr_path,
+            image_type=self.image_type,
+            image_name=self.another_image_name,
+        ).attrs)
+
+    def test_merge_attrs_concurrently(self):
+        # stale Image objects, e.g. one per writer process
+        imgs = [visor.Image(
+            self.vsr_path,
+            image_type=self.image_type,
+            image_name=self.another_image_name,
+        ) for _ in range(8)]
+
+        def writer(i):
+            imgs[i].merge_attrs({'visor': {'visor_stacks': [
+                {'index': i, 'label': f'stack_{i+1}'}
+            ]}})
+
+        with ThreadPoolExecutor(max_workers=8) as pool:
+            list(pool.map(writer, range(8)))
+        img = visor.Image(
+            self.vsr_path,
+            image_type=self.image_type,
+            image_name=self.another_image_name,
+        )
+        self.assertEqual([s['index'] for s in img.attrs['visor']['visor_stacks']],
+                         list(range(8)))
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,138 @@
+# Run test at root directory with below:
+#   python -m unittest visor/tests/test_importer.py
+
+from pathlib import Path
+import importlib.util
+import json
+import unittest
+import shutil
+import tempfile
+import visor
+from visor.lock import sidecar
+import numpy
+from visor.importer import import_image, main
+
+class TestBase(unittest.TestCase):
+
+    def setUp(self):
+        self.vsr_path = Path(__file__).parent/'data'/'VISOR001.vsr'
+        self.image_name = 'slice_2_10x'
+        self.image_path = self.vsr_path/'visor_raw_images'/f'{self.image_name}.zarr'
+        self.tmp_path = Path(tempfile.mkdtemp())
+        self.dtype = 'uint16'
+        # 2 stacks x 2 channels, stack_2 is shorter
+        self.frames = [[numpy.random.randint(0, 4096, size=(n,6,5), dtype=self.dtype)
+                        for _ in range(2)] for n in (10, 7)]
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_path)
+        if self.image_path.exists():
+            shutil.rmtree(self.image_path)
+        shutil.rmtree(sidecar(self.image_path), ignore_errors=True)
+
+    def write_raw(self, offset=0):
+        files = []
+        for st, s in enumerate(self.frames):
+            files.append([])
+            for ch, f in enumerate(s):
+                path = self.tmp_path/f'{st}_{ch}.raw'
+                with open(path, 'wb') as rf:
+                    rf.write(b'\0' * offset)
+                    rf.write(f.tobytes())
+                files[-1].append(path)
+        return files
+
+    def check_image(self):
+        img = visor.Image(self.vsr_path, image_type='raw', image_name=self.image_name)
+        arr = img.load('0')
+        self.assertEqual(arr.shape, (2,2,10,6,5))
+        for st, s in enumerate(self.frames):
+            for ch, f in enumerate(s):
+                numpy.testing.assert_array_equal(arr[st:st+1,ch:ch+1,:len(f)], f[None,None])
+        self.assertEqual(img.label_to_index('stack', 'stack_2'), 1)
+        self.assertEqual(img.label_to_index('channel', '561'), 1)
+        self.assertEqual(img.attrs['ome']['multiscales'][0]['coordinateTransformations'][0]['scale'],
+                         [1.0, 1.0, 3.5, 1.03, 1.03])
+
+
+class TestImporter(TestBase):
+
+    def test_import_raw(self):
+        stats = import_image(
+            self.vsr_path, self.image_name, self.write_raw(offset=16),
+            stacks=['stack_1', 'stack_2'], channels=['488', '561'],
+            dtype=self.dtype, frame_shape=(6,5), offset=16,
+            voxel_size=(3.5, 1.03, 1.03), shard_size=(1,1,4,6,5), chunk_size=(1,1,2,3,5),
+            max_workers=3,
+        )
+        self.check_image()
+        self.assertEqual(stats['n_blocks'], 2*3 + 2*2)
+        self.assertEqual(stats['n_written'], stats['n_blocks'])
+        self.assertEqual(stats['n_bytes'], sum(f.nbytes for s in self.frames for f in s))
+        self.assertIn('raw', visor.VSR(self.vsr_path).images())
+
+    def test_import_resume(self):
+        files = self.write_raw()
+        kwargs = dict(stacks=['stack_1', 'stack_2'], channels=['488', '561'],
+                      dtype=self.dtype, frame_shape=(6,5), voxel_size=(3.5, 1.03, 1.03),
+                      shard_size=(2,2,4,6,5), chunk_size=(1,1,2,3,5))
+        import_image(self.vsr_path, self.image_name, files, **kwargs)
+        # forget the last 3 blocks as if the import was interrupted
+        done_file = sidecar(self.image_path)/'import'/'0.json'
+        with open(done_file) as f:
+            done = json.load(f)
+        with open(done_file, 'w') as f:
+            json.dump(done[:-3], f)
+        stats = import_image(self.vsr_path, self.image_name, files, **kwargs)
+        self.assertEqual(stats['n_written'], 3)
+        self.assertEqual(stats['n_skipped'], len(done) - 3)
+        self.check_image()
+
+        with self.assertRaises(FileExistsError):
+            import_image(self.vsr_path, self.image_name, files, resume=False, **kwargs)
+
+    @unittest.skipUnless(importlib.util.find_spec('tifffile'), 'requires tifffile')
+    def test_import_tiff_cli(self):
+        import tifffile
+        files = []
+        for st, s in enumerate(self.frames):
+            for ch, f in enumerate(s):
+                path = self.tmp_path/f'{st}_{ch}.tif'
+                tifffile.imwrite(path, f)
+                files.append(str(path))
+        main([str(self.vsr_path), self.image_name,
+              '--stacks', 'stack_1', 'stack_2', '--channels', '488', '561',
+              '--files'] + files + ['--voxel-size', '3.5', '1.03', '1.03',
+              '--shard-size', '1', '1', '4', '6', '5'])
+        self.check_image()
+
+    def test_import_defaults(self):
+        # default chunks divide default shards for any frame count and shape
+        for n_z, frame in ((20, (300, 300)), (20, (64, 64)), (70, (6, 5))):
+            self.frames = [[numpy.random.randint(0, 4096, size=(n_z,) + frame, dtype=self.dtype)]]
+            import_image(self.vsr_path, self.image_name, self.write_raw(), stacks=['stack_1'],
+                         channels=['488'], dtype=self.dtype, frame_shape=frame, resume=False)
+            arr = visor.Image(self.vsr_path, image_type='raw', image_name=self.image_name).load('0')
+            self.assertTrue(all(0 == s % c for s, c in zip(arr.shards, arr.chunks)))
+            numpy.testing.assert_array_equal(arr[0, 0], self.frames[0][0])
+            shutil.rmtree(self.image_path)
+            shutil.rmtree(sidecar(self.image_path), ignore_errors=True)
+
+    def test_import_mismatch(self):
+        with self.assertRaises(ValueError):
+            import_image(self.vsr_path, self.image_name, [['a.raw']],
+                         stacks=['stack_1', 'stack_2'], channels=['488'])
+
+    def test_import_empty(self):
+        with self.assertRaises(ValueError):
+            import_image(self.vsr_path, self.image_name, [], stacks=[], channels=['488'])
+        path = self.tmp_path/'empty.raw'
+        path.touch()
+        with self.assertRaisesRegex(ValueError, 'no frames'):
+            import_image(self.vsr_path, self.image_name, [[path]], stacks=['stack_1'], channels=['488'],
+                         dtype=self.dtype, frame_shape=(6,5))
+        self.assertFalse(self.image_path.exists())
+
+
+if __name__ == '__main__':
+    unittest.main()
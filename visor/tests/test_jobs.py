@@ -0,0 +1,125 @@
+# Run test at root directory with below:
+#   python -m unittest visor/tests/test_jobs.py
+
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+import multiprocessing
+import shutil
+import tempfile
+import time
+import unittest
+import numpy
+from zarr.codecs import BloscCodec
+import visor
+from visor.jobs import Job, create_job, run_worker, main
+
+
+def double(image, resolution, region, out_name):
+    """
+    Operation writing twice the input into another image
+    """
+    out = visor.Image(image.storage, image_type='raw', image_name=out_name)
+    out.write(image.load(resolution)[region] * 2, resolution, region=region)
+
+
+def broken(image, resolution, region):
+    if region[2].start > 0:
+        raise RuntimeError('broken shard')
+
+
+class TestBase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_path = Path(tempfile.mkdtemp())
+        self.vsr_path = self.tmp_path/'VISOR001.vsr'
+        self.job_dir = self.tmp_path/'job'
+        shutil.copytree(Path(__file__).parent/'data'/'VISOR001.vsr', self.vsr_path)
+        self.arr = numpy.random.default_rng(0).integers(0, 1000, (2, 2, 8, 8, 4), dtype='uint16')
+        kwargs = dict(dtype='uint16', shape=self.arr.shape, shard_size=(1, 1, 4, 4, 4),
+                      chunk_size=(1, 1, 2, 2, 2), compressors=BloscCodec(cname='zstd', clevel=5))
+        img = visor.Image(self.vsr_path, image_type='raw', image_name='slice_3', create=True)
+        img.save(self.arr, '0', **kwargs)
+        out = visor.Image(self.vsr_path, image_type='raw', image_name='slice_3_out', create=True)
+        out.save(None, '0', **kwargs)
+        self.out = out
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_path)
+
+    def create(self, **kwargs):
+        return create_job(self.job_dir, self.vsr_path, 'slice_3', '0', double,
+                          params={'out_name': 'slice_3_out'}, **kwargs)
+
+
+class TestJob(TestBase):
+
+    def test_manifest(self):
+        job = self.create(region=(1, slice(0, 1)), shards_per_task=3)
+        self.assertEqual([len(t['keys']) for t in job.tasks], [3, 1])
+        self.assertEqual(job.tasks[0]['shards'][0], [[1, 2], [0, 1], [0, 4], [0, 4], [0, 4]])
+        self.assertEqual(job.manifest['operation'], f'{__name__}:double')
+        with self.assertRaises(FileExistsError):
+            self.create()
+        with self.assertRaises(ValueError):
+            create_job(self.tmp_path/'other', self.vsr_path, 'slice_3', '0', 'double')
+
+    def test_processes(self):
+        job = self.create(shards_per_task=2)
+        ctx = multiprocessing.get_context('spawn')
+        workers = [ctx.Process(target=run_worker, args=(self.job_dir, f'node_{i}'),
+                               kwargs={'poll': 0.05}) for i in range(3)]
+        for w in workers:
+            w.start()
+        for w in workers:
+            w.join(60)
+            self.assertEqual(0, w.exitcode)
+        status = job.status()
+        self.assertEqual(status['done'], 8)
+        self.assertEqual(status['n_shards_done'], 16)
+        numpy.testing.assert_array_equal(self.out.load('0')[:], self.arr * 2)
+
+    def test_resume(self):
+        job = self.create(shards_per_task=4, lease_seconds=0.2)
+        # a worker crashes after checkpointing one shard of the first task
+        task, state = job.claim('crashed')
+        job.checkpoint(task['id'], 'crashed', task['keys'][0])
+        time.sleep(0.3)
+        stats = run_worker(self.job_dir, 'node_0', wait=False)
+        self.assertEqual(stats['n_done'], 4)
+        self.assertEqual(stats['n_skipped'], 1)
+        self.assertEqual(stats['n_shards'], 15)
+        self.assertEqual(job.state(task['id'])['attempts'], 2)
+        self.assertFalse(job.complete(task['id'], 'crashed'))
+        self.assertTrue(job.finished())
+
+    def test_threads_share_job(self):
+        # heartbeats and state changes of one Job from many threads
+        job = self.create(shards_per_task=1)
+        claimed = [job.claim('node_0') for _ in range(4)]
+        def renew(i):
+            task = claimed[i % 4][0]
+            return job.renew(task['id'], 'node_0') and \
+                job.checkpoint(task['id'], 'node_0', task['keys'][0])
+        with ThreadPoolExecutor(max_workers=8) as pool:
+            self.assertTrue(all(pool.map(renew, range(200))))
+        self.assertEqual(job.status()['n_shards_done'], 4)
+
+    def test_failure(self):
+        job = create_job(self.job_dir, self.vsr_path, 'slice_3', '0', broken, max_attempts=2)
+        stats = run_worker(self.job_dir, 'node_0', wait=False)
+        self.assertEqual(stats['n_failed'], 16)
+        status = job.status()
+        self.assertEqual((status['done'], status['failed']), (8, 8))
+        self.assertIn('broken shard', list(status['errors'].values())[0])
+        job.reset()
+        self.assertEqual(Job(self.job_dir).status()['pending'], 8)
+
+    def test_main(self):
+        self.create()
+        main(['run', str(self.job_dir), '--no-wait'])
+        self.assertEqual(Job(self.job_dir).status()['done'], 16)
+        numpy.testing.assert_array_equal(self.out.load('0')[:], self.arr * 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
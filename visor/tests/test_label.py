@@ -0,0 +1,75 @@
+# Run test at root directory with below:
+#   python -m unittest visor/tests/test_label.py
+
+from pathlib import Path
+import shutil
+import unittest
+import numpy
+import visor
+from visor.checksum import load_manifest
+
+class TestBase(unittest.TestCase):
+
+    def setUp(self):
+        self.vsr_path = Path(__file__).parent/'data'/'VISOR001.vsr'
+        self.label_path = self.vsr_path/'visor_label_images'
+        self.arr = numpy.zeros((1, 1, 8, 8, 8), dtype='uint32')
+        self.arr[0, 0, 1:3, 2:6, 2:4] = 7
+        self.arr[0, 0, 5:8, 0:8, 6] = 3
+        self.arr[0, 0, 0, 0, 0] = 2**31
+        self.img = visor.LabelImage(self.vsr_path, image_name='slice_1_cells', create=True)
+        self.img.save(self.arr, '0', dtype='uint32', shape=self.arr.shape,
+                      shard_size=(1, 1, 4, 4, 4), chunk_size=(1, 1, 2, 2, 2))
+
+    def tearDown(self):
+        shutil.rmtree(self.label_path)
+
+
+class TestLabelImage(TestBase):
+
+    def test_index(self):
+        numpy.testing.assert_array_equal(self.img.labels(), [3, 7, 2**31])
+        info = self.img.label_info(7)
+        self.assertEqual(info['count'], 2 * 4 * 2)
+        self.assertEqual(info['bbox'], (slice(0, 1), slice(0, 1), slice(1, 3), slice(2, 6), slice(2, 4)))
+        numpy.testing.assert_allclose(info['centroid'], [0, 0, 1.5, 3.5, 2.5])
+        self.assertEqual(self.img.label_info(3)['count'], 3 * 8)
+
+    def test_get_label(self):
+        bbox, mask = self.img.get_label(3)
+        self.assertEqual(mask.shape, (1, 1, 3, 8, 1))
+        self.assertTrue(mask.all())
+        with self.assertRaises(KeyError):
+            self.img.get_label(5)
+
+    def test_reopen(self):
+        img = visor.LabelImage(self.vsr_path, image_name='slice_1_cells')
+        self.assertEqual(img.label_info(2**31)['count'], 1)
+        self.assertIn('label', visor.VSR(self.vsr_path).image_types)
+        # rebuild after writing labels
+        img.write(numpy.full((1, 1, 1, 1, 1), 9, dtype='uint32'), '0', region=(0, 0, 7, 7, 7))
+        self.assertEqual(img.build_index('0'), 4)
+        self.assertEqual(img.label_info(3)['count'], 3 * 8)
+        self.assertEqual(img.label_info(9)['count'], 1)
+
+    def test_index_group(self):
+        # the index is not an array of the multiscale group
+        self.assertEqual(list(self.img.zgroup.array_keys()), ['0'])
+        self.assertTrue((self.label_path/'slice_1_cells.zarr'/'label_index'/'0'/'zarr.json').is_file())
+        self.img.consolidate()
+        img = visor.LabelImage(self.vsr_path, image_name='slice_1_cells')
+        self.assertEqual(list(img.zgroup.array_keys()), ['0'])
+        self.assertEqual(img.label_info(7)['count'], 2 * 4 * 2)
+        # its shards are checksummed like those of the label array
+        report = img.verify()
+        self.assertEqual(report['extra'], [])
+        self.assertEqual(list(load_manifest(img.path)['label_index/0']), ['c/0/0'])
+
+    def test_invalid_dtype(self):
+        with self.assertRaises(ValueError):
+            self.img.save(None, '1', dtype='float32', shape=(1, 1, 2, 2, 2),
+                          shard_size=(1, 1, 2, 2, 2), chunk_size=(1, 1, 2, 2, 2))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,86 @@
+# Run test at root directory with below:
+#   python -m unittest visor/tests/test_memory.py
+
+from pathlib import Path
+import threading
+import time
+import unittest
+import visor
+from visor.memory import MemoryBudget, budget, parse_bytes, memory_usage
+from visor.compute import lazy
+
+class TestBase(unittest.TestCase):
+
+    def setUp(self):
+        self.vsr_path = Path(__file__).parent/'data'/'VISOR001.vsr'
+
+
+class TestMemoryBudget(TestBase):
+
+    def test_parse_bytes(self):
+        self.assertEqual(parse_bytes('512MB'), 512 * 10**6)
+        self.assertEqual(parse_bytes('2GiB'), 2 * 2**30)
+        self.assertEqual(parse_bytes(100), 100)
+        self.assertIsNone(parse_bytes(None))
+        with self.assertRaises(ValueError):
+            parse_bytes('12 apples')
+
+    def test_acquire_blocks_until_released(self):
+        b = MemoryBudget(100)
+        b.acquire(80)
+        acquired = threading.Event()
+        t = threading.Thread(target=lambda: (b.acquire(50), acquired.set()))
+        t.start()
+        time.sleep(0.05)
+        self.assertFalse(acquired.is_set())
+        self.assertEqual(b.stats()['waiting'], 1)
+        b.release(80)
+        t.join(1)
+        self.assertTrue(acquired.is_set())
+        stats = b.stats()
+        self.assertEqual(stats['used'], 50)
+        self.assertEqual(stats['peak'], 80)
+        self.assertEqual(stats['available'], 50)
+        self.assertEqual(stats['n_waits'], 1)
+
+    def test_oversized_and_timeout(self):
+        b = MemoryBudget(100)
+        # larger than the limit is admitted alone
+        with b.reserve(500):
+            self.assertEqual(b.used, 500)
+            with self.assertRaises(TimeoutError):
+                b.acquire(1, timeout=0.01)
+        self.assertEqual(b.used, 0)
+
+    def test_try_acquire(self):
+        b = MemoryBudget(100)
+        self.assertTrue(b.try_acquire(60))
+        self.assertFalse(b.try_acquire(60))
+        self.assertEqual(b.stats()['n_refused'], 1)
+
+    def test_config(self):
+        with visor.config.set({'memory.limit': '1KB'}):
+            self.assertEqual(budget.limit, 1000)
+            self.assertEqual(memory_usage()['limit'], 1000)
+        self.assertIsNone(budget.limit)
+
+
+class TestBudgetedIO(TestBase):
+
+    def test_readers_release(self):
+        img = visor.Image(self.vsr_path, image_type='raw', image_name='slice_1_10x')
+        arr = img.load('0')
+        with visor.config.set({'memory.limit': 64}):
+            budget.reset_stats()
+            expected = arr[:].sum()
+            self.assertEqual(lazy(arr).sum(max_workers=4), expected)
+            p = visor.Pipeline().astype('float32')
+            self.assertEqual(img.load('0', pipeline=p)[:].sum(), expected)
+            img.sample_points([[0, 0, 0], [2, 2, 2]], '0')
+            stats = memory_usage()
+        self.assertEqual(stats['used'], 0)
+        self.assertGreater(stats['n_acquired'], 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
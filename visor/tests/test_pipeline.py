@@ -0,0 +1,96 @@
+# Run test at root directory with below:
+#   python -m unittest visor/tests/test_pipeline.py
+
+from pathlib import Path
+import unittest
+import visor
+import numpy
+
+class TestBase(unittest.TestCase):
+
+    def setUp(self):
+        self.vsr_path = Path(__file__).parent/'data'/'VISOR001.vsr'
+        self.image_path = self.vsr_path/'visor_raw_images'/'slice_1_10x.zarr'
+        self.img = visor.Image(self.vsr_path, image_type='raw', image_name='slice_1_10x')
+        self.arr = self.img.load('0')[:]
+
+
+class TestPipeline(TestBase):
+
+    def test_fused_pointwise(self):
+        p = visor.Pipeline().window(10, 200, out_max=255).astype('uint8')
+        # two pointwise steps on uint16 become one lookup table
+        fused = p._fused(numpy.dtype('uint16'))
+        self.assertEqual(len(fused), 1)
+        self.assertIsInstance(fused[0], numpy.ndarray)
+
+        out = self.img.load('0', pipeline=p)[:]
+        ref = numpy.clip((self.arr.astype('float32') - 10) * 255 / 190, 0, 255)
+        ref = numpy.rint(ref).astype('uint8')
+        self.assertEqual(out.dtype, numpy.uint8)
+        numpy.testing.assert_array_equal(out, ref)
+
+    def test_lut(self):
+        table = numpy.arange(2**16, dtype='uint32') * 3
+        out = self.img.load('0', pipeline=visor.Pipeline().lut(table))[:1, :1]
+        numpy.testing.assert_array_equal(out, self.arr[:1, :1].astype('uint32') * 3)
+
+    def test_flatfield_bin(self):
+        field = numpy.linspace(0.5, 2.0, 16).reshape(4, 4)
+        p = visor.Pipeline().flatfield(field, dark=2).bin((1, 2, 2))
+        arr = self.img.load('0', pipeline=p)
+        self.assertEqual(arr.shape, (2, 2, 4, 2, 2))
+        self.assertEqual(arr.dtype, numpy.float32)
+
+        out = arr[:, :, 1:3]
+        ref = (self.arr[:, :, 1:3].astype('float32') - 2) / field.astype('float32')
+        ref = ref.reshape(2, 2, 2, 2, 2, 2, 2).mean(axis=(4, 6))
+        numpy.testing.assert_allclose(out, ref, rtol=1e-6)
+
+    def test_bin_unaligned_region(self):
+        # bins start at the region, not at the shard grid
+        p = visor.Pipeline().bin((2, 1, 1), reduce='max')
+        out = p.read(visor.Image(self.vsr_path, image_type='raw', image_name='slice_1_10x').load('0'),
+                     (0, slice(0, 1), slice(1, 4)))
+        self.assertEqual(out.shape, (1, 1, 4, 4))
+        numpy.testing.assert_array_equal(out[0, 0], self.arr[0, 0, 1:3].max(axis=0))
+        with self.assertRaises(ValueError):
+            visor.Pipeline().bin((1, 2, 2), reduce='median')
+
+    def test_output_coordinates(self):
+        # regions are given in binned coordinates, like shape
+        arr = self.img.load('0', pipeline=visor.Pipeline().bin((2, 2, 2), reduce='max'))
+        self.assertEqual(arr.shape, (2, 2, 2, 2, 2))
+        out = arr[1, :, 1:, -1]
+        self.assertEqual(out.shape, (2, 1, 2))
+        ref = self.arr[1, :, 2:4, 2:4].reshape(2, 1, 2, 1, 2, 2, 2).max(axis=(2, 4, 6))
+        numpy.testing.assert_array_equal(out, ref[:, 0])
+        numpy.testing.assert_array_equal(arr[:], self.arr.reshape(2, 2, 2, 2, 2, 2, 2, 2).max(axis=(3, 5, 7)))
+
+    def test_astype_clip(self):
+        # narrowing integers clip instead of wrapping, also through the fused table
+        p = visor.Pipeline().astype('uint8')
+        self.assertEqual(p._fused(numpy.dtype('uint16'))[0][[300, 5]].tolist(), [255, 5])
+        out = self.img.load('0', pipeline=p)[:]
+        numpy.testing.assert_array_equal(out, numpy.clip(self.arr, 0, 255).astype('uint8'))
+        f = visor.pipeline._astype(numpy.dtype('uint16'))
+        self.assertEqual(f(numpy.array([-3, 70000], dtype='int32')).tolist(), [0, 65535])
+
+    def test_lut_float(self):
+        with self.assertRaisesRegex(TypeError, 'astype'):
+            self.img.load('0', pipeline=visor.Pipeline().astype('float32').lut(numpy.arange(10)))[:]
+
+    def test_roi_pipeline(self):
+        roi = visor.ROI(
+            self.image_path,
+            resolution='0',
+            ranges=(1, 1, slice(2, 3), slice(None), slice(None)),
+            pipeline=visor.Pipeline().astype('float32').map(numpy.sqrt),
+        )
+        np_arr = roi.load()
+        self.assertEqual(np_arr.shape, (1, 4, 4))
+        numpy.testing.assert_allclose(np_arr, numpy.sqrt(self.arr[1, 1, 2:3].astype('float32')))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,104 @@
+# Run test at root directory with below:
+#   python -m unittest visor/tests/test_preview.py
+
+from pathlib import Path
+import os
+import shutil
+import tempfile
+import unittest
+import numpy
+from zarr.codecs import BloscCodec
+import visor
+from visor.preview import PREVIEWS, make_preview, preview_level, _pool
+
+
+class TestBase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_path = Path(tempfile.mkdtemp())
+        self.vsr_path = self.tmp_path/'VISOR001.vsr'
+        shutil.copytree(Path(__file__).parent/'data'/'VISOR001.vsr', self.vsr_path)
+        self.vsr = visor.VSR(self.vsr_path)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_path)
+
+
+class TestPreview(TestBase):
+
+    def test_pool(self):
+        mip = numpy.arange(2 * 5 * 3).reshape(2, 5, 3)
+        pooled = _pool(mip, 2)
+        self.assertEqual(pooled.shape, (2, 3, 2))
+        self.assertEqual(pooled[0, 0, 0], mip[0, :2, :2].max())
+        self.assertEqual(pooled[1, 2, 1], mip[1, 4, 2])
+        # negative edges are not raised by the padding
+        pooled = _pool(-numpy.ones((3, 3), dtype='int16'), 2)
+        numpy.testing.assert_array_equal(pooled, -numpy.ones((2, 2)))
+
+    def test_make_preview(self):
+        img = visor.Image(self.vsr_path, image_type='raw', image_name='slice_1_10x')
+        preview = make_preview(img)
+        numpy.testing.assert_array_equal(preview['mip'], img.load('0')[:].max(axis=2))
+        self.assertEqual(preview['stacks'], ['stack_1', 'stack_2'])
+        self.assertEqual(preview['channels'], ['488', '561'])
+        self.assertEqual(preview['scale'], [1.03, 1.03])
+
+        preview = make_preview(img, max_size=3)
+        self.assertEqual(preview['factor'], 2)
+        self.assertEqual(preview['mip'].shape, (2, 2, 2, 2))
+        self.assertEqual(preview['scale'], [2.06, 2.06])
+
+    def test_negative(self):
+        arr = -numpy.arange(1, 2 * 3 * 4 * 5 + 1, dtype='float32').reshape(1, 2, 3, 4, 5)
+        img = visor.Image(self.vsr_path, image_type='raw', image_name='slice_2', create=True)
+        img.save(arr, '0', dtype='float32', shape=arr.shape, shard_size=(1, 1, 2, 4, 5),
+                 chunk_size=(1, 1, 1, 2, 5), compressors=BloscCodec(cname='zstd', clevel=5))
+        preview = make_preview(img)
+        numpy.testing.assert_array_equal(preview['mip'], arr.max(axis=2))
+        self.assertEqual(make_preview(img, max_size=3)['mip'][0, 1, 1, 2], arr[0, 1, :, 2:, 4:].max())
+
+    def test_previews(self):
+        previews = self.vsr.previews()
+        self.assertEqual(set(previews), {'raw', 'compr'})
+        self.assertEqual(set(previews['raw']), {'slice_1_10x', 'slice_1_10x_1'})
+        self.assertTrue((self.vsr_path/PREVIEWS).is_file())
+        mtime = os.stat(self.vsr_path/PREVIEWS).st_mtime_ns
+
+        # unchanged images are not read again nor the file rewritten
+        previews = self.vsr.previews()
+        self.assertEqual(os.stat(self.vsr_path/PREVIEWS).st_mtime_ns, mtime)
+        loaded = self.vsr.previews(image_types=['raw'], update=False)
+        self.assertEqual(list(loaded), ['raw'])
+        numpy.testing.assert_array_equal(loaded['raw']['slice_1_10x']['mip'],
+                                         previews['raw']['slice_1_10x']['mip'])
+
+    def test_incremental(self):
+        old = self.vsr.previews()
+        img = visor.Image(self.vsr_path, image_type='raw', image_name='slice_1_10x')
+        arr = img.load('0')[:]
+        arr[1, 0, 2, 1, 3] = 60000
+        img.write(arr, '0')
+        new = visor.Image(self.vsr_path, image_type='raw', image_name='slice_2', create=True)
+        new.save(arr, '0', dtype='uint16', shape=arr.shape, shard_size=(1, 1, 4, 4, 4),
+                 chunk_size=(1, 1, 2, 2, 2), compressors=BloscCodec(cname='zstd', clevel=5))
+
+        previews = self.vsr.previews()
+        self.assertEqual(previews['raw']['slice_1_10x']['mip'][1, 0, 1, 3], 60000)
+        self.assertNotEqual(previews['raw']['slice_1_10x']['fingerprint'],
+                            old['raw']['slice_1_10x']['fingerprint'])
+        self.assertEqual(previews['raw']['slice_1_10x_1']['fingerprint'],
+                         old['raw']['slice_1_10x_1']['fingerprint'])
+        self.assertIn('slice_2', previews['raw'])
+
+        shutil.rmtree(self.vsr_path/'visor_raw_images'/'slice_2.zarr')
+        self.assertNotIn('slice_2', self.vsr.previews()['raw'])
+
+    def test_preview_level(self):
+        img = visor.Image(self.vsr_path, image_type='raw', image_name='slice_1_10x')
+        self.assertEqual(preview_level(img), '0')
+        self.assertEqual(preview_level(img, max_size=2), '0')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,100 @@
+# Run test at root directory with below:
+#   python -m unittest visor/tests/test_registration.py
+
+from pathlib import Path
+import shutil
+import tempfile
+import unittest
+import numpy
+from zarr.codecs import BloscCodec
+import visor
+from visor.registration import phase_correlation, overlap, register_stacks
+
+class TestBase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = Path(tempfile.mkdtemp())
+        self.vsr_path = self.tmp/'VISOR001.vsr'
+        visor.VSR(self.vsr_path, create=True)
+        rng = numpy.random.default_rng(0)
+        vol = rng.random((8, 96, 48))
+        # smooth so coarse levels keep structure
+        for axis in (1, 2):
+            vol = (vol + numpy.roll(vol, 1, axis) + numpy.roll(vol, 2, axis)) / 3
+        vol = (vol * 1000).astype('uint16')
+        # stack_2 starts 28 voxels further along y, its nominal position says 30
+        self.true_dy = 28
+        arr = numpy.stack([vol[:, 0:48], vol[:, self.true_dy:self.true_dy+48]])[:, None]
+        img = visor.Image(self.vsr_path, image_type='raw', image_name='slice_1', create=True)
+        level = {'type': 'scale', 'scale': [1.0, 1.0, 1.0, 1.0, 1.0]}
+        img.update_attrs({
+            'ome': {'multiscales': [{
+                'name': 'slice_1',
+                'datasets': [{'path': '0', 'coordinateTransformations': [level]},
+                             {'path': '1', 'coordinateTransformations': [
+                                 dict(level, scale=[1.0, 1.0, 2.0, 2.0, 2.0])]}],
+                'coordinateTransformations': [{'type': 'scale', 'scale': [1.0, 1.0, 2.0, 1.0, 1.0]}],
+            }]},
+            'visor': {
+                'visor_stacks': [{'index': 0, 'label': 'stack_1', 'position': [10.0, 20.0]},
+                                 {'index': 1, 'label': 'stack_2', 'position': [10.0, 20.030]}],
+                'channels': [{'index': 0, 'wavelength': '488'}],
+            },
+        })
+        for res, a in (('0', arr), ('1', arr.reshape(2, 1, 4, 2, 24, 2, 24, 2).mean(axis=(3, 5, 7)))):
+            img.save(a.astype('uint16'), res, dtype='uint16', shape=a.shape,
+                     shard_size=(1, 1) + a.shape[2:], chunk_size=(1, 1) + a.shape[2:],
+                     compressors=BloscCodec())
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+
+class TestPhaseCorrelation(unittest.TestCase):
+
+    def test_shift(self):
+        rng = numpy.random.default_rng(1)
+        vol = rng.random((20, 64, 64))
+        a, b = vol[:, 0:40, 5:45], vol[:, 3:43, 2:42]
+        shift, peak = phase_correlation(a, b)
+        numpy.testing.assert_allclose(shift, [0, 3, -3], atol=0.5)
+        self.assertGreater(peak, 0.1)
+
+    def test_overlap(self):
+        ra, rb = overlap((8, 48, 48), numpy.array([0, 30, -2]))
+        self.assertEqual(ra, (slice(0, 8), slice(30, 48), slice(0, 46)))
+        self.assertEqual(rb, (slice(0, 8), slice(0, 18), slice(2, 48)))
+        with self.assertRaises(ValueError):
+            overlap((8, 48, 48), numpy.array([0, 50, 0]))
+
+
+class TestRegisterStacks(TestBase):
+
+    def test_threads(self):
+        out = register_stacks(self.vsr_path, 'slice_1', '488', 'v1', processes=False)
+        pair = out['pairs'][0]
+        numpy.testing.assert_allclose(pair['nominal'], [0, 30, 0])
+        numpy.testing.assert_allclose(pair['offset'], [0, self.true_dy, 0], atol=0.5)
+        # saved transforms map stack_2 voxels next to stack_1
+        xfm = visor.Transform(self.vsr_path, recon_version='v1', slice_name='slice_1')
+        t0 = xfm.load('raw', 'ortho', [0, 0])
+        t1 = xfm.load('raw', 'ortho', [1, 0])
+        p0 = numpy.array(t0.TransformPoint((5.0, float(self.true_dy), 1.0)))
+        p1 = numpy.array(t1.TransformPoint((5.0, 0.0, 1.0)))
+        numpy.testing.assert_allclose(p0, p1, atol=0.5)
+        # the new recon version is listed
+        recon = visor.VSR(self.vsr_path).transforms('v1')
+        self.assertEqual(recon['spaces'], ['raw', 'ortho'])
+        self.assertEqual(recon['slices'], [{'name': 'slice_1', 'transforms': ['raw_to_ortho']}])
+        with self.assertRaises(FileExistsError):
+            register_stacks(self.vsr_path, 'slice_1', '488', 'v1', processes=False)
+
+    def test_processes(self):
+        out = register_stacks(self.vsr_path, 'slice_1', '488', 'v1', levels=['1', '0'],
+                              processes=True, max_workers=1, overwrite=True)
+        numpy.testing.assert_allclose(out['pairs'][0]['offset'], [0, self.true_dy, 0], atol=0.5)
+        self.assertAlmostEqual(out['translations'][1][1] - out['translations'][0][1], self.true_dy, 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -51,6 +51,42 @@ class TestROILoad(TestBase):
         self.assertEqual(np_arr.ndim, 3)
         self.assertEqual(np_arr.shape, (1, 4, 4))
 
+    def test_load_basic_indexing(self):
+        # steps and Ellipsis index the array directly without a pipeline
+        arr = zarr.open_array(self.image_path/self.resolution, mode='r')[:]
+        roi = visor.ROI(self.image_path, resolution=self.resolution, ranges=(1, ..., slice(None, None, 2)))
+        numpy.testing.assert_array_equal(roi.load(), arr[1, ..., ::2])
+
+
+class TestROIPlan(TestBase):
+
+    def test_plan(self):
+        ranges = (1, 1, slice(2, 3), slice(None), slice(1, 2))
+        roi = visor.ROI(self.image_path, resolution=self.resolution, ranges=ranges)
+        plan = roi.plan()
+        self.assertEqual(plan['n_shards'], 1)
+        self.assertEqual(plan['n_chunks'], 2)
+        self.assertEqual(plan['requested_bytes'], 4 * 2)
+        self.assertEqual(plan['decoded_bytes'], 2 * 8 * 2)
+        self.assertEqual(plan['amplification'], 4.0)
+        self.assertEqual(plan['split'], [(slice(1, 2), slice(1, 2), slice(2, 3),
+                                          slice(0, 4), slice(1, 2))])
+        self.assertEqual(len(plan['suggestions']), 2)
+        self.assertIn('along z', plan['suggestions'][0])
+        self.assertIn('along x', plan['suggestions'][1])
+        # all chunks: compressed bytes and index make up the shard file
+        plan = visor.ROI(self.image_path, resolution=self.resolution, ranges=(1, 1)).plan()
+        size = (self.image_path/'0'/'c'/'1'/'1'/'0'/'0'/'0').stat().st_size
+        self.assertEqual(plan['compressed_bytes'] + plan['index_bytes'], size)
+        self.assertEqual(plan['amplification'], 1.0)
+
+    def test_explain(self):
+        roi = visor.ROI(self.image_path, resolution=self.resolution,
+                        ranges=(0, 0, slice(None), slice(1, 3), slice(None)))
+        text = roi.explain()
+        self.assertIn('shards:        1', text)
+        self.assertIn('amplification: 2.00x', text)
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,78 @@
+# Run test at root directory with below:
+#   python -m unittest visor/tests/test_sampling.py
+
+from pathlib import Path
+import unittest
+import visor
+import numpy
+
+class TestBase(unittest.TestCase):
+
+    def setUp(self):
+        self.vsr_path = Path(__file__).parent/'data'/'VISOR001.vsr'
+        self.img = visor.Image(self.vsr_path, image_type='raw', image_name='slice_1_10x')
+        self.arr = self.img.load('0')[:]
+        rng = numpy.random.default_rng(0)
+        self.coords = rng.uniform(0, 3, size=(500, 3))
+
+
+class TestSamplePoints(TestBase):
+
+    def test_nearest(self):
+        out = self.img.sample_points(self.coords, '0')
+        self.assertEqual(out.shape, (500, 2, 2))
+        self.assertEqual(out.dtype, self.arr.dtype)
+        z, y, x = numpy.floor(self.coords + 0.5).astype(int).T
+        numpy.testing.assert_array_equal(out, self.arr[:, :, z, y, x].transpose(2, 0, 1))
+
+    def test_linear(self):
+        out = self.img.sample_points(self.coords, '0', stacks=['stack_2'],
+                                     channels=['561', '488'], interp='linear')
+        self.assertEqual(out.shape, (500, 1, 2))
+        # reference trilinear interpolation over the whole array
+        vol = self.arr[1][[1, 0]].astype('float64')
+        b = numpy.floor(self.coords).astype(int)
+        f = self.coords - b
+        ref = 0
+        for dz in (0, 1):
+            for dy in (0, 1):
+                for dx in (0, 1):
+                    w = (f[:, 0] if dz else 1 - f[:, 0]) * (f[:, 1] if dy else 1 - f[:, 1]) \
+                        * (f[:, 2] if dx else 1 - f[:, 2])
+                    ref = ref + w * vol[:, b[:, 0] + dz, b[:, 1] + dy, b[:, 2] + dx]
+        numpy.testing.assert_allclose(out[:, 0], ref.T, rtol=1e-4)
+
+    def test_outside_and_edges(self):
+        coords = [[-1, 0, 0], [3, 3, 3], [3.6, 0, 0], [0, 0, 4.2]]
+        out = self.img.sample_points(coords, '0', stacks=[0], channels=[0])
+        self.assertEqual(out[:, 0, 0].tolist(), [0, self.arr[0, 0, 3, 3, 3], 0, 0])
+        out = self.img.sample_points(coords, '0', stacks=[0], channels=[0], interp='linear')
+        self.assertEqual(out[1, 0, 0], self.arr[0, 0, 3, 3, 3])
+        with self.assertRaises(ValueError):
+            self.img.sample_points(coords, '0', interp='cubic')
+
+    def test_empty(self):
+        out = self.img.sample_points(self.coords, '0', stacks=[], interp='linear')
+        self.assertEqual(out.shape, (500, 0, 2))
+        out = self.img.sample_points(self.coords, '0', channels=[])
+        self.assertEqual(out.shape, (500, 2, 0))
+        self.assertEqual(self.img.sample_points(numpy.empty((0, 3)), '0').shape, (0, 2, 2))
+
+    def test_chunks_decoded_once(self):
+        # points on chunk edges read their margin from the neighbour chunks
+        arr = self.img.load('0')
+        reads = []
+        class Counting:
+            shape, chunks, shards, dtype = arr.shape, arr.chunks, arr.shards, arr.dtype
+            def __getitem__(self, selection):
+                reads.append(str(selection))
+                return arr[selection]
+        coords = numpy.array([[0.5, 1.5, 1.5], [1.2, 1.7, 0.3], [2.5, 2.5, 2.5]])
+        out = visor.sampling.sample_points(Counting(), coords, [0], [0], interp='linear')
+        ref = self.img.sample_points(coords, '0', stacks=[0], channels=[0], interp='linear')
+        numpy.testing.assert_array_equal(out, ref)
+        self.assertEqual(len(reads), len(set(reads)))
+
+
+if __name__ == '__main__':
+    unittest.main()
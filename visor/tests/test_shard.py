@@ -0,0 +1,63 @@
+# Run test at root directory with below:
+#   python -m unittest visor/tests/test_shard.py
+
+from pathlib import Path
+import unittest
+import visor
+from visor.shard import (normalize_region, shard_grid, shard_region, shard_key,
+                         shards_in_region, is_shard_aligned, assign_shards)
+
+class TestBase(unittest.TestCase):
+
+    def setUp(self):
+        self.vsr_path = Path(__file__).parent/'data'/'VISOR001.vsr'
+        img = visor.Image(self.vsr_path, image_type='raw', image_name='slice_1_10x')
+        # shape (2,2,4,4,4), shards (1,1,4,4,4), chunks (1,1,2,2,2)
+        self.arr = img.load(resolution='0')
+
+
+class TestShard(TestBase):
+
+    def setUp(self):
+        super().setUp()
+
+    def test_normalize_region(self):
+        self.assertEqual(normalize_region((1, -1, slice(2, 3)), (2, 2, 4, 4, 4)),
+                         (slice(1, 2), slice(1, 2), slice(2, 3), slice(0, 4), slice(0, 4)))
+        self.assertEqual(normalize_region(None, (2, 3)), (slice(0, 2), slice(0, 3)))
+        with self.assertRaises(ValueError):
+            normalize_region((slice(None, None, 2),), (4,))
+        with self.assertRaises(IndexError):
+            normalize_region((4,), (4,))
+
+    def test_grid(self):
+        self.assertEqual(shard_grid(self.arr), (2, 2, 1, 1, 1))
+        self.assertEqual(shard_region(self.arr, (1, 0, 0, 0, 0)),
+                         (slice(1, 2), slice(0, 1), slice(0, 4), slice(0, 4), slice(0, 4)))
+        self.assertEqual(shard_key((1, 0, 0, 0, 0)), 'c/1/0/0/0/0')
+        self.assertTrue((self.arr.store.root/'0'/shard_key((1, 0, 0, 0, 0))).exists())
+
+    def test_shards_in_region(self):
+        self.assertEqual(len(shards_in_region(self.arr)), 4)
+        self.assertEqual(shards_in_region(self.arr, (1, slice(None), slice(2, 3))),
+                         [(1, 0, 0, 0, 0), (1, 1, 0, 0, 0)])
+        self.assertEqual(shards_in_region(self.arr, (slice(0, 0),)), [])
+
+    def test_is_shard_aligned(self):
+        self.assertTrue(is_shard_aligned(self.arr, (0,)))
+        self.assertFalse(is_shard_aligned(self.arr, (0, 0, slice(0, 2))))
+
+    def test_assign_shards(self):
+        plan = assign_shards(self.arr, 3)
+        self.assertEqual([len(p) for p in plan], [2, 1, 1])
+        self.assertEqual(sorted(s for p in plan for s in p), shards_in_region(self.arr))
+
+        plan = assign_shards(self.arr, 2, axis=0)
+        self.assertEqual(plan, [[(0, 0, 0, 0, 0), (0, 1, 0, 0, 0)],
+                                [(1, 0, 0, 0, 0), (1, 1, 0, 0, 0)]])
+        with self.assertRaises(ValueError):
+            assign_shards(self.arr, 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
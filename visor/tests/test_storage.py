@@ -0,0 +1,131 @@
+# Run test at root directory with below:
+#   python -m unittest visor/tests/test_storage.py
+
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+import shutil
+import tempfile
+import unittest
+import numpy
+import zarr
+import zarrs
+from zarr.codecs import BloscCodec
+import visor
+from visor.storage import (open_storage, LocalStorage, MemoryStorage, ZipStorage,
+                           ObjectStorage, LocalObjectClient, pack_zip)
+
+class TestBase(unittest.TestCase):
+
+    def setUp(self):
+        self.vsr_path = Path(__file__).parent/'data'/'VISOR001.vsr'
+        self.tmp = Path(tempfile.mkdtemp())
+        self.ref = visor.Image(self.vsr_path, image_type='raw', image_name='slice_1_10x').load('0')[:]
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+        MemoryStorage.drop('VISOR001.vsr')
+        MemoryStorage.drop('NEW.vsr')
+
+    def copy_to(self, storage):
+        local = LocalStorage(self.vsr_path)
+        for k in local.list():
+            storage.put(k, local.get(k))
+        return storage
+
+    def check_read(self, storage):
+        vsr = visor.VSR(storage)
+        self.assertEqual(sorted(vsr.image_types), ['compr', 'raw'])
+        self.assertEqual(vsr.recon_versions, ['xxx_20250525'])
+        self.assertEqual(vsr.images('raw')[0]['channels'], ['488', '561'])
+        self.assertEqual(vsr.transforms('xxx_20250525')['spaces'], ['raw', 'ortho', 'brain'])
+        img = visor.Image(storage, image_type='raw', image_name='slice_1_10x')
+        numpy.testing.assert_array_equal(img.load('0')[:], self.ref)
+        numpy.testing.assert_array_equal(img.load('0')[1, 0, 1:3, :, 2], self.ref[1, 0, 1:3, :, 2])
+
+
+class TestStorage(TestBase):
+
+    def test_open_storage(self):
+        self.assertIsInstance(open_storage(self.vsr_path), LocalStorage)
+        self.assertIsInstance(open_storage('memory://VISOR001.vsr'), MemoryStorage)
+        with self.assertRaises(ValueError):
+            open_storage('ftp://host/VISOR001.vsr')
+
+    def test_memory(self):
+        self.check_read(self.copy_to(MemoryStorage('VISOR001.vsr')))
+        # storages of the same name share objects
+        self.check_read(open_storage('memory://VISOR001.vsr'))
+
+    def test_zip(self):
+        pack_zip(self.vsr_path, self.tmp/'VISOR001.vsr.zip')
+        storage = open_storage(f'zip://{self.tmp}/VISOR001.vsr.zip')
+        self.assertIsInstance(storage, ZipStorage)
+        self.check_read(storage)
+        with self.assertRaises(PermissionError):
+            storage.put('info.json', b'{}')
+        # every thread reads through its own handle
+        keys = [k for k in storage.list('visor_raw_images') if '/c/' in k]
+        with ThreadPoolExecutor(max_workers=4) as pool:
+            data = list(pool.map(lambda k: storage.get_range(k, 1, 9), keys * 4))
+        self.assertEqual(data, [(self.vsr_path/k).read_bytes()[1:9] for k in keys * 4])
+        self.assertIsNot(storage._thread_zip(), storage._zip)
+        handles = list(storage._opened)
+        self.assertGreater(len(handles), 2)
+        storage.close()
+        self.assertTrue(all(h.fp is None for h in handles))
+        storage.close()
+
+    def test_object_store(self):
+        clients = []
+        def client():
+            clients.append(LocalObjectClient(self.tmp/'bucket'))
+            return clients[-1]
+        storage = self.copy_to(ObjectStorage('data/VISOR001.vsr', client, pool_size=4))
+        self.assertTrue((self.tmp/'bucket'/'data'/'VISOR001.vsr'/'info.json').is_file())
+        self.check_read(storage)
+        self.assertLessEqual(storage.n_clients, 4)
+        self.assertGreater(sum(c.n_requests for c in clients), 0)
+
+    def test_codec_pipeline(self):
+        # the pipeline is chosen per array, the global config is left alone
+        storage = self.copy_to(MemoryStorage('VISOR001.vsr'))
+        arr = visor.Image(storage, image_type='raw', image_name='slice_1_10x').load('0')
+        self.assertEqual(zarr.config.get('codec_pipeline.path'), 'zarrs.ZarrsCodecPipeline')
+        self.assertNotIsInstance(arr._async_array.codec_pipeline, zarrs.ZarrsCodecPipeline)
+        arr = visor.Image(self.vsr_path, image_type='raw', image_name='slice_1_10x').load('0')
+        self.assertIsInstance(arr._async_array.codec_pipeline, zarrs.ZarrsCodecPipeline)
+
+    def test_ranges(self):
+        storage = self.copy_to(MemoryStorage('VISOR001.vsr'))
+        data = storage.get('info.json')
+        self.assertEqual(storage.get_ranges([('info.json', 0, 5), ('info.json', -3, None),
+                                             ('missing.json', 0, 1)]),
+                         [data[:5], data[-3:], None])
+
+    def test_write_memory(self):
+        storage = MemoryStorage('NEW.vsr')
+        visor.VSR(storage, create=True)
+        with self.assertRaises(FileExistsError):
+            visor.VSR(storage, create=True)
+        img = visor.Image(storage, image_type='raw', image_name='slice_1', create=True)
+        arr = numpy.arange(2*1*8*4*4, dtype='uint16').reshape(2, 1, 8, 4, 4)
+        img.save(arr, '0', dtype='uint16', shape=arr.shape, shard_size=(1, 1, 4, 4, 4),
+                 chunk_size=(1, 1, 2, 4, 4), compressors=BloscCodec())
+        img.update_attrs({'visor': {'visor_stacks': [{'index': 0, 'label': 'stack_1'}]}})
+        img = visor.Image('memory://NEW.vsr', image_type='raw', image_name='slice_1')
+        numpy.testing.assert_array_equal(img.load('0')[:], arr)
+        self.assertEqual(img.label_to_index('stack', 'stack_1'), 0)
+        with self.assertRaisesRegex(ValueError, 'requires local storage'):
+            img.verify()
+        with self.assertRaisesRegex(ValueError, 'requires local storage'):
+            visor.VSR(storage).verify()
+
+        xfm = visor.Transform(storage, recon_version='v1', slice_name='slice_1', create=True)
+        xfm.save('raw', 'brain', 'affine', 'tfm', [0, 0, 1, 0, 0, 0, 1, 0, 0, 0, 1, 5, 6, 7])
+        xfm.update_meta(trans=[{'name': 'raw_to_brain', 'type': 'affine', 'format': 'tfm'}])
+        t = xfm.load('raw', 'brain', [0, 0])
+        self.assertEqual(t.GetTranslation(), (5.0, 6.0, 7.0))
+
+
+if __name__ == '__main__':
+    unittest.main()
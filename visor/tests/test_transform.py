@@ -3,8 +3,10 @@
 
 from pathlib import Path
 import json
+import os
 import unittest
 import shutil
+import tempfile
 import visor
 import SimpleITK as sitk
 import numpy as np
@@ -185,6 +187,26 @@ class TestTransformSave(TestBase):
                           3.5, 0.5410816484822616, 0.0,
                           0.0, 0.0, 0.0))
 
+    def test_save_affine_tfm_multiple_stacks(self):
+        for st in (0, 1):
+            self.xfm.save(
+                from_space=self.from_space,
+                to_space=self.to_space,
+                t_type='affine',
+                t_format='tfm',
+                params=[st] + self.params[1:],
+            )
+        space_path = self.another_transform_path/f'{self.from_space}_to_{self.to_space}'
+        self.assertTrue((space_path/'1'/str(self.channel_idx)/'affine.tfm').exists())
+        with self.assertRaises(FileExistsError):
+            self.xfm.save(
+                from_space=self.from_space,
+                to_space=self.to_space,
+                t_type='affine',
+                t_format='tfm',
+                params=self.params,
+            )
+
     def test_save_affine_tfm_with_incorrect_params(self):
         with self.assertRaises(ValueError) as context:
             self.xfm.save(
@@ -196,3 +218,115 @@ class TestTransformSave(TestBase):
             )
         self.assertEqual(str(context.exception),
                          'Saving affine transform requires [stack_index, channel_index, affine_mat, affine_vec] in params.')
+
+
+class TestAffineTable(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_path = Path(tempfile.mkdtemp())
+        self.vsr_path = self.tmp_path/'VISOR001.vsr'
+        shutil.copytree(Path(__file__).parent/'data'/'VISOR001.vsr', self.vsr_path)
+        self.recon_version = 'xxx_20250525'
+        self.recon_path = self.vsr_path/'visor_recon_transforms'/self.recon_version
+        rng = np.random.default_rng(0)
+        self.params = rng.normal(size=(12, 12))
+        self.fixed = rng.normal(size=(12, 3))
+        self.keys = [(f'slice_{i}', s, c) for i in (2, 3, 4) for s in (0, 1) for c in (0, 1)]
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_path)
+
+    def save(self, **kwargs):
+        table = visor.AffineTable(self.vsr_path, self.recon_version)
+        table.save([k[0] for k in self.keys], 'raw_to_brain', [k[1] for k in self.keys],
+                   [k[2] for k in self.keys], self.params, self.fixed, **kwargs)
+        return table
+
+    def test_save(self):
+        self.save()
+        table = visor.AffineTable(self.vsr_path, self.recon_version)
+        self.assertEqual(len(table), 12)
+        self.assertTrue((self.recon_path/'affines.npz').is_file())
+        np.testing.assert_array_equal(table.rows(slice_name='slice_3', stack=1), [6, 7])
+        row = table.row('slice_3', 'raw_to_brain', 1, 0)
+        np.testing.assert_array_equal(table.params[row], self.params[6])
+        self.assertIsNone(table.get('slice_3', 'raw_to_brain', 2, 0))
+
+        # matrices map points like the SimpleITK transforms
+        t = table.transform(row)
+        self.assertIsInstance(t, sitk.AffineTransform)
+        p = (1.0, 2.0, 3.0)
+        np.testing.assert_allclose(table.matrices([row])[0] @ np.append(p, 1.0),
+                                   np.append(t.TransformPoint(p), 1.0))
+
+        # transforms.json lists the table, Transform.load reads from it
+        with open(self.recon_path/'slice_3'/'transforms.json') as f:
+            self.assertEqual(json.load(f), [{'name': 'raw_to_brain', 'type': 'affine', 'format': 'table'}])
+        xfm = visor.Transform(self.vsr_path, recon_version=self.recon_version, slice_name='slice_3')
+        t = xfm.load(from_space='raw', to_space='brain', params=[1, 0])
+        self.assertEqual(t.GetParameters(), tuple(self.params[6]))
+        with self.assertRaises(FileNotFoundError):
+            xfm.load(from_space='raw', to_space='brain', params=[2, 0])
+
+        with self.assertRaises(FileExistsError):
+            self.save()
+        self.params[0] = 0
+        table = self.save(overwrite=True)
+        self.assertEqual(len(table.rows()), 12)
+        np.testing.assert_array_equal(table.params[table.row('slice_2', 'raw_to_brain', 0, 0)], 0)
+
+    def test_save_tfm(self):
+        self.save(tfm=True)
+        t = sitk.ReadTransform(str(self.recon_path/'slice_4'/'raw_to_brain'/'1'/'0'/'affine.tfm'))
+        np.testing.assert_array_equal(t.GetParameters(), self.params[10])
+        np.testing.assert_array_equal(t.GetFixedParameters(), self.fixed[10])
+        with open(self.recon_path/'slice_4'/'transforms.json') as f:
+            self.assertEqual(json.load(f)[0]['format'], 'tfm')
+
+        # tfm files are packed back into an equal table
+        (self.recon_path/'affines.npz').unlink()
+        table = visor.AffineTable(self.vsr_path, self.recon_version)
+        self.assertEqual(table.pack(), 13)
+        row = table.row('slice_4', 'raw_to_brain', 1, 0)
+        np.testing.assert_array_equal(table.params[row], self.params[10])
+        np.testing.assert_array_equal(table.fixed[row], self.fixed[10])
+
+    def test_pack(self):
+        table = visor.AffineTable(self.vsr_path, self.recon_version)
+        self.assertEqual(len(table), 0)
+        self.assertEqual(table.pack(), 1)
+        self.assertEqual(visor.AffineTable(self.vsr_path, self.recon_version).get(
+            'slice_1_10x', 'raw_to_ortho', 0, 0).GetParameters(),
+            (0.0, 0.876430630270142, 0.0,
+             0.0, 0.0, 1.03,
+             3.5, 0.5410816484822616, 0.0,
+             0.0, 0.0, 0.0))
+
+        # saving .tfm files leaves the table to pack, loads fall back to the file
+        mtime = os.stat(self.recon_path/'affines.npz').st_mtime_ns
+        xfm = visor.Transform(self.vsr_path, recon_version=self.recon_version, slice_name='slice_1_10x')
+        xfm.save('raw', 'ortho', 'affine', 'tfm', [1, 0] + list(range(12)))
+        self.assertEqual(os.stat(self.recon_path/'affines.npz').st_mtime_ns, mtime)
+        self.assertEqual(xfm.load('raw', 'ortho', [1, 0]).GetParameters(), tuple(map(float, range(12))))
+        table = visor.AffineTable(self.vsr_path, self.recon_version)
+        self.assertIsNone(table.row('slice_1_10x', 'raw_to_ortho', 1, 0))
+        self.assertEqual(table.pack(), 2)
+        np.testing.assert_array_equal(table.params[table.row('slice_1_10x', 'raw_to_ortho', 1, 0)],
+                                      range(12))
+
+    def test_tfm_replaces_row(self):
+        # a .tfm saved after a table row of the same transform is not shadowed by it
+        xfm = visor.Transform(self.vsr_path, recon_version=self.recon_version, slice_name='slice_1_10x')
+        xfm.save('raw', 'brain', 'affine', 'table', [1, 0] + [0.0] * 12)
+        xfm.save('raw', 'brain', 'affine', 'tfm', [1, 0] + list(range(12)))
+        table = visor.AffineTable(self.vsr_path, self.recon_version)
+        self.assertIsNone(table.row('slice_1_10x', 'raw_to_brain', 1, 0))
+        self.assertEqual(xfm._load_trans('raw_to_brain', 'affine', 'tfm', [1, 0]).GetParameters(),
+                         tuple(map(float, range(12))))
+        self.assertEqual(table.delete('slice_1_10x', 'raw_to_brain', 1, 0), 0)
+
+    def test_save_duplicates(self):
+        self.keys[1] = self.keys[0]
+        with self.assertRaises(ValueError):
+            self.save()
+        self.assertFalse((self.recon_path/'affines.npz').exists())
@@ -0,0 +1,76 @@
+# Run test at root directory with below:
+#   python -m unittest visor/tests/test_tune.py
+
+from pathlib import Path
+import shutil
+import tempfile
+import unittest
+import numpy
+from zarr.codecs import BloscCodec
+import visor
+from visor.tune import tune, rechunk, make_config, save_config, load_config
+
+class TestBase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_path = Path(tempfile.mkdtemp())
+        self.vsr_path = self.tmp_path/'VISOR001.vsr'
+        shutil.copytree(Path(__file__).parent/'data'/'VISOR001.vsr', self.vsr_path)
+        rng = numpy.random.default_rng(0)
+        self.arr = (rng.normal(400, 20, (1, 2, 24, 40, 40)) +
+                    numpy.arange(40)[None, None, None, None, :]).astype('uint16')
+        self.img = visor.Image(self.vsr_path, image_type='raw', image_name='slice_3', create=True)
+        self.img.save(self.arr, '0', dtype='uint16', shape=self.arr.shape,
+                      shard_size=(1, 1, 8, 40, 40), chunk_size=(1, 1, 8, 8, 8),
+                      compressors=BloscCodec(cname='lz4', clevel=1))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_path)
+
+
+class TestTune(TestBase):
+
+    def test_tune(self):
+        codecs = [{'cname': 'zstd', 'clevel': 5, 'shuffle': 'shuffle'},
+                  {'cname': 'lz4', 'clevel': 1, 'shuffle': 'noshuffle'}]
+        layouts = [((4, 8, 8), (16, 16, 16)), ((8, 16, 16), (64, 64, 64))]
+        result = tune(self.img, n_samples=2, sample_shape=(16, 32, 32), codecs=codecs,
+                      layouts=layouts, n_rois=4, roi_shape=(4, 8, 8), work_dir=self.tmp_path)
+        self.assertEqual(result['samples']['shape'], (16, 32, 32))
+        self.assertEqual(len(result['codecs']), 2)
+        ratios = {r['codec']['cname']: r['ratio'] for r in result['codecs']}
+        self.assertGreater(ratios['zstd'], max(1.0, ratios['lz4']))
+        self.assertTrue(all(r['decode_mbps'] > 0 for r in result['codecs']))
+        self.assertEqual(result['codecs'][0]['codec'], result['recommended']['compressors'])
+        # shards are clipped to the sample shape
+        self.assertEqual({m['shard'] for m in result['layouts']}, {(16, 16, 16), (16, 32, 32)})
+        self.assertEqual(result['config']['chunk_size'][:2], (1, 1))
+        self.assertEqual(sorted(p.name for p in self.tmp_path.iterdir()), ['VISOR001.vsr'])
+
+        # the recommendation is consumed by the writer
+        save_config(self.tmp_path/'tuned.json', result['recommended'])
+        config = load_config(self.tmp_path/'tuned.json', self.arr.shape)
+        self.assertEqual(config['chunk_size'], result['config']['chunk_size'])
+        out = visor.Image(self.vsr_path, image_type='raw', image_name='slice_3_tuned', create=True)
+        out.save(self.arr, '0', dtype='uint16', shape=self.arr.shape, **config)
+        numpy.testing.assert_array_equal(out.load('0')[:], self.arr)
+
+    def test_make_config(self):
+        config = make_config({'compressors': {'cname': 'zstd', 'clevel': 3, 'shuffle': 'bitshuffle'},
+                              'chunk_size': [16, 128, 128], 'shard_size': [64, 256, 256]},
+                             (2, 2, 20, 100, 300))
+        self.assertEqual(config['chunk_size'], (1, 1, 16, 100, 128))
+        self.assertEqual(config['shard_size'], (1, 1, 32, 100, 256))
+        self.assertEqual(config['compressors'].clevel, 3)
+
+    def test_rechunk(self):
+        out = visor.Image(self.vsr_path, image_type='raw', image_name='slice_3_rechunked', create=True)
+        config = make_config({'compressors': {'cname': 'zstd', 'clevel': 3, 'shuffle': 'shuffle'},
+                              'chunk_size': [4, 8, 8], 'shard_size': [12, 16, 16]}, self.arr.shape)
+        arr = rechunk(self.img, '0', out, **config)
+        self.assertEqual(arr.shards, (1, 1, 12, 16, 16))
+        numpy.testing.assert_array_equal(arr[:], self.arr)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,38 +1,52 @@
 from pathlib import Path
-import json
+import io
+import re
+import numpy
 import zarr
 import zarrs
 zarr.config.set({"codec_pipeline.path": "zarrs.ZarrsCodecPipeline"})
 import SimpleITK as sitk
+from .storage import Storage, open_storage, local_copy
+from .consolidate import update_vsr
+from .lock import storage_lock
+
+# Columnar table of the affine transforms of a recon version
+AFFINES = 'affines.npz'
+# Header of .tfm files of 3-d affine transforms, as written by SimpleITK
+_TFM_HEADER = '#Insight Transform File V1.0\n#Transform 0\nTransform: AffineTransform_double_3_3\n'
 
 class Transform:
 
-    def __init__(self, vsr_path:str|Path,
+    def __init__(self, vsr_path:str|Path|Storage,
                  recon_version:str, slice_name:str, create=False):
         """
         Constructor of Transform
 
         Parameters:
-            vsr_path:      path to the .vsr file
+            vsr_path:      path or url to the .vsr file, or its Storage,
+                           see visor.storage.open_storage
             recon_version: reconstruction version, see vsr.info()['recon_versions']
             slice_name:    slice directory name, see vsr.transforms()
             create:        boolean
         """
-        vsr_path = Path(vsr_path)
+        storage = open_storage(vsr_path)
         # Validate vsr path
-        if vsr_path.suffix != '.vsr':
-            raise ValueError(f'The path {vsr_path} is not valid, must contain .vsr extension.')
-        if not vsr_path.exists() or not vsr_path.is_dir():
-            raise NotADirectoryError(f'The path {vsr_path} is not a directory.')
+        if not storage.name.endswith('.vsr'):
+            raise ValueError(f'The path {storage.path()} is not valid, must contain .vsr extension.')
+        if not storage.is_dir():
+            raise NotADirectoryError(f'The path {storage.path()} is not a directory.')
         
-        transform_path = vsr_path/'visor_recon_transforms'/recon_version/slice_name
+        key = f'visor_recon_transforms/{recon_version}/{slice_name}'
         if create:
-            transform_path.mkdir(parents=True, exist_ok=True)
-            with open(transform_path/'transforms.json', 'w') as trans_json:
-                trans_json.write('{\n  "_comment": "see https://visor-tech.github.io/visor-data-schema/"\n}')
-        if not transform_path.exists() or not transform_path.is_dir():
-            raise NotADirectoryError(f'The path {transform_path} is not a directory.')
-        self.path = transform_path
+            storage.mkdir(key)
+            storage.put(f'{key}/transforms.json',
+                        b'{\n  "_comment": "see https://visor-tech.github.io/visor-data-schema/"\n}')
+        if not storage.is_dir(key):
+            raise NotADirectoryError(f'The path {storage.path(key)} is not a directory.')
+        self.storage = storage
+        self.key  = key
+        self.path = storage.path(key)
+        self._affines = None
 
 
     def load(self, from_space:str, to_space:str, params):
@@ -47,11 +61,9 @@ class Transform:
         Return:
             depends on transform type and format
         """
-        t_meta_file = self.path/'transforms.json'
-        if not t_meta_file.exists():
+        if not self.storage.is_file(f'{self.key}/transforms.json'):
             raise FileNotFoundError(f'Metadata file transforms.json is not found in {self.path}.')
-        with open(t_meta_file) as f:
-            t_list = json.load(f)
+        t_list = self.storage.read_json(f'{self.key}/transforms.json')
 
         t_name = f'{from_space}_to_{to_space}'
         t_inv_name = f'{to_space}_to_{from_space}'
@@ -76,15 +88,25 @@ class Transform:
 
     def _load_trans(self, t_name:str, t_type:str, t_format:str, params):
 
-        if 'affine' == t_type and 'tfm' == t_format:
+        if 'affine' == t_type and t_format in ('tfm', 'table'):
             if (not isinstance(params, list)) or (2 != len(params)):
                 raise ValueError('Loading affine transform requires [stack_index, channel_index] in params.')
             st_idx = params[0]
             ch_idx = params[1]
-            trans_path = self.path/t_name/str(st_idx)/str(ch_idx)/f'{t_type}.{t_format}'
-            if not trans_path.exists():
-                raise NotADirectoryError(f'The path {trans_path} is not a directory.')
-            return sitk.ReadTransform(trans_path)
+            # the table of the recon version answers without opening .tfm files
+            t = self.affines().get(self.key.split('/')[2], t_name, st_idx, ch_idx)
+            if t is not None:
+                return t
+            if 'table' == t_format:
+                raise FileNotFoundError(f'Transform {t_name} of stack {st_idx} and channel {ch_idx} '
+                                        f'is not in {self.affines().path}.')
+            trans_key = f'{self.key}/{t_name}/{st_idx}/{ch_idx}/{t_type}.{t_format}'
+            if not self.storage.is_file(trans_key):
+                raise NotADirectoryError(f'The path {self.storage.path(trans_key)} is not a directory.')
+            if self.storage.local_path() is not None:
+                return sitk.ReadTransform(self.storage.local_path(trans_key))
+            with local_copy(self.storage.get(trans_key), suffix=f'.{t_format}') as p:
+                return sitk.ReadTransform(p)
 
 
     def _load_inv_trans(self, t_name:str, t_type:str, t_format:str):
@@ -104,24 +126,48 @@ class Transform:
             params:     parameters to identify transform
         """
         t_name = f'{from_space}_to_{to_space}'
-        if (self.path/t_name).exists():
-            raise FileExistsError(f'The transform {self.path/t_name} already exists.')
 
-        if 'affine' == t_type and 'tfm' == t_format:
+        if 'affine' == t_type and t_format in ('tfm', 'table'):
             if (not isinstance(params, list)) or (14 != len(params)):
                 raise ValueError('Saving affine transform requires [stack_index, channel_index, affine_mat, affine_vec] in params.')
             st_idx = params[0]
             ch_idx = params[1]
-            t_path = self.path/t_name/str(st_idx)/str(ch_idx)/f'{t_type}.{t_format}'
-            t_path.parent.mkdir(parents=True)
-            t_path.touch()
-
             t_mat = params[2:-3]
             t_vec = params[-3:]
-            t = sitk.AffineTransform(3)
-            t.SetMatrix(t_mat)
-            t.SetTranslation(t_vec)
-            sitk.WriteTransform(t, t_path)
+            if 'tfm' == t_format:
+                t_key = f'{self.key}/{t_name}/{st_idx}/{ch_idx}/{t_type}.{t_format}'
+                if self.storage.is_file(t_key):
+                    raise FileExistsError(f'The transform {self.storage.path(t_key)} already exists.')
+                t = sitk.AffineTransform(3)
+                t.SetMatrix(t_mat)
+                t.SetTranslation(t_vec)
+                with local_copy(b'', suffix=f'.{t_format}') as p:
+                    sitk.WriteTransform(t, p)
+                    with open(p, 'rb') as f:
+                        self.storage.put(t_key, f.read())
+
+            # .tfm files are packed into the table by AffineTable.pack, load
+            # falls back to them meanwhile, a row of an earlier transform
+            # would shadow the new file
+            table = self.affines()
+            if 'table' == t_format:
+                table.save(self.key.split('/')[2], t_name, st_idx, ch_idx,
+                           [list(t_mat) + list(t_vec)], update_meta=False)
+            elif table.row(self.key.split('/')[2], t_name, st_idx, ch_idx) is not None:
+                table.delete(self.key.split('/')[2], t_name, st_idx, ch_idx)
+
+
+    def affines(self):
+        """
+        Get the affine transform table of the recon version, read once
+        per Transform
+
+        Returns:
+            visor.transform.AffineTable
+        """
+        if self._affines is None:
+            self._affines = AffineTable(self.storage, self.key.split('/')[1])
+        return self._affines
 
 
     def update_meta(self, recon:dict=None, trans:list=None):
@@ -131,11 +177,331 @@ class Transform:
         Parameters:
             attrs: new attributes
         """  
+        _, recon_version, slice_name = self.key.split('/')
         if recon:
-            recon_json = self.path.parent/'recon.json'
-            with open(recon_json, 'w') as rj:
-                json.dump(recon, rj)
+            self.storage.write_json(f"{self.key.rpartition('/')[0]}/recon.json", recon)
+            update_vsr(self.storage, ['recon_versions', recon_version, 'recon'], recon)
         if trans:
-            trans_json = self.path/'transforms.json'
-            with open(trans_json, 'w') as tj:
-                json.dump(trans, tj)
+            self.storage.write_json(f'{self.key}/transforms.json', trans)
+            update_vsr(self.storage, ['recon_versions', recon_version, 'slices', slice_name], trans)
+
+
+class AffineTable:
+
+    def __init__(self, vsr_path:str|Path|Storage, recon_version:str):
+        """
+        Constructor of AffineTable, the affine transforms of a recon
+        version in one columnar table, affines.npz in the recon version
+        directory, with a row of slice, transform name, stack, channel,
+        12 affine parameters (matrix then translation) and 3 fixed
+        parameters (center) per transform
+
+        The table is read in a single request, lookups and matrices are
+        vectorized, SimpleITK transforms are only built on request. The
+        .tfm files of Transform stay readable, pack() converts them.
+
+        Parameters:
+            vsr_path:      path or url to the .vsr file, or its Storage,
+                           see visor.storage.open_storage
+            recon_version: reconstruction version, see vsr.info()['recon_versions']
+        """
+        storage = open_storage(vsr_path)
+        if not storage.name.endswith('.vsr'):
+            raise ValueError(f'The path {storage.path()} is not valid, must contain .vsr extension.')
+        key = f'visor_recon_transforms/{recon_version}'
+        if not storage.is_dir(key):
+            raise NotADirectoryError(f'The path {storage.path(key)} is not a directory.')
+        self.storage = storage
+        self.key  = key
+        self.path = storage.path(f'{key}/{AFFINES}')
+        self._read()
+
+
+    def _read(self):
+        """
+        Private method to read the table, empty if it does not exist
+        """
+        self.exists = self.storage.is_file(f'{self.key}/{AFFINES}')
+        if self.exists:
+            with numpy.load(io.BytesIO(self.storage.get(f'{self.key}/{AFFINES}'))) as npz:
+                columns = {k: npz[k] for k in npz.files}
+        else:
+            columns = _columns([], [], [], [], numpy.zeros((0, 12)), numpy.zeros((0, 3)))
+        self._set(columns)
+
+
+    def _set(self, columns:dict):
+        """
+        Private method to set columns and reset lookups
+        """
+        self.slices   = columns['slice']
+        self.names    = columns['name']
+        self.stacks   = columns['stack']
+        self.channels = columns['channel']
+        self.params   = columns['params']
+        self.fixed    = columns['fixed']
+        self._index = None
+        self._sitk = {}
+
+
+    def __len__(self):
+        return len(self.slices)
+
+
+    def rows(self, slice_name:str=None, t_name:str=None, stack:int=None, channel:int=None):
+        """
+        Select rows, None matches all
+
+        Parameters:
+            slice_name: slice name
+            t_name:     transform name, e.g. raw_to_brain
+            stack:      stack index
+            channel:    channel index
+
+        Returns:
+            numpy.ndarray of row indices
+        """
+        mask = numpy.ones(len(self), dtype=bool)
+        for column, value in ((self.slices, slice_name), (self.names, t_name),
+                              (self.stacks, stack), (self.channels, channel)):
+            if value is not None:
+                mask &= column == value
+        return numpy.flatnonzero(mask)
+
+
+    def row(self, slice_name:str, t_name:str, stack:int, channel:int):
+        """
+        Get the row of a transform
+
+        Returns:
+            int, or None if not in the table
+        """
+        if self._index is None:
+            self._index = {k: i for i, k in enumerate(zip(self.slices.tolist(), self.names.tolist(),
+                                                           self.stacks.tolist(), self.channels.tolist()))}
+        return self._index.get((slice_name, t_name, int(stack), int(channel)))
+
+
+    def matrices(self, rows=None):
+        """
+        Get homogeneous matrices of transforms, mapping (x,y,z,1) points
+        like the SimpleITK transforms
+
+        Parameters:
+            rows: row indices, default all
+
+        Returns:
+            numpy.ndarray (n,4,4)
+        """
+        params = self.params if rows is None else self.params[rows]
+        fixed  = self.fixed if rows is None else self.fixed[rows]
+        m = params[:, :9].reshape(-1, 3, 3)
+        out = numpy.zeros((len(params), 4, 4))
+        out[:, :3, :3] = m
+        # y = M (x - c) + c + t
+        out[:, :3, 3] = params[:, 9:] + fixed - numpy.einsum('nij,nj->ni', m, fixed)
+        out[:, 3, 3] = 1.0
+        return out
+
+
+    def transform(self, row:int):
+        """
+        Get the SimpleITK transform of a row, built once on request
+
+        Returns:
+            SimpleITK.AffineTransform
+        """
+        row = int(row)
+        if row not in self._sitk:
+            t = sitk.AffineTransform(3)
+            t.SetParameters(self.params[row].tolist())
+            t.SetFixedParameters(self.fixed[row].tolist())
+            self._sitk[row] = t
+        return self._sitk[row]
+
+
+    def get(self, slice_name:str, t_name:str, stack:int, channel:int):
+        """
+        Get the SimpleITK transform of a slice, stack and channel
+
+        Returns:
+            SimpleITK.AffineTransform, or None if not in the table
+        """
+        row = self.row(slice_name, t_name, stack, channel)
+        return None if row is None else self.transform(row)
+
+
+    def save(self, slice_names, t_name, stacks, channels, params, fixed=None,
+             overwrite:bool=False, tfm:bool=False, update_meta:bool=True):
+        """
+        Save transforms in bulk, the table is rewritten once, save many
+        transforms per call rather than one at a time
+
+        Parameters:
+            slice_names: slice name, or one per transform
+            t_name:      transform name (e.g. raw_to_brain), or one per transform
+            stacks:      stack index, or one per transform
+            channels:    channel index, or one per transform
+            params:      (n,12) affine matrices (row major) then translations
+            fixed:       (n,3) centers, default 0
+            overwrite:   replace transforms already in the table
+            tfm:         also write .tfm files readable by Transform.load
+            update_meta: add missing transforms to transforms.json of the
+                         slices, with format 'tfm' or 'table'
+        """
+        params = numpy.asarray(params, dtype=numpy.float64).reshape(-1, 12)
+        n = len(params)
+        fixed = numpy.zeros((n, 3)) if fixed is None else \
+            numpy.broadcast_to(numpy.asarray(fixed, dtype=numpy.float64), (n, 3))
+        new = _columns(*(numpy.broadcast_to(numpy.asarray(c), (n,))
+                         for c in (slice_names, t_name, stacks, channels)), params, fixed)
+        keys = list(zip(new['slice'].tolist(), new['name'].tolist(),
+                        new['stack'].tolist(), new['channel'].tolist()))
+        if len(set(keys)) != n:
+            dup = next(k for i, k in enumerate(keys) if k in keys[:i])
+            raise ValueError(f'The transform {dup[1]} of {dup[0]} stack {dup[2]} channel {dup[3]} '
+                             f'is given more than once.')
+
+        with storage_lock(self.storage, self.key, AFFINES):
+            self._read()
+            keep = numpy.ones(len(self), dtype=bool)
+            for i in range(n):
+                row = self.row(new['slice'][i], new['name'][i], new['stack'][i], new['channel'][i])
+                if row is None:
+                    continue
+                if not overwrite:
+                    raise FileExistsError(f"The transform {new['name'][i]} of {new['slice'][i]} stack "
+                                          f"{new['stack'][i]} channel {new['channel'][i]} already exists "
+                                          f"in {self.path}.")
+                keep[row] = False
+            self._write(keep, new)
+
+        if tfm:
+            for i in range(n):
+                self.storage.put(f"{self.key}/{new['slice'][i]}/{new['name'][i]}/{new['stack'][i]}/"
+                                 f"{new['channel'][i]}/affine.tfm", _tfm(params[i], fixed[i]))
+        if update_meta:
+            for slice_name in numpy.unique(new['slice']).tolist():
+                names = numpy.unique(new['name'][new['slice'] == slice_name]).tolist()
+                self._update_meta(slice_name, names, 'tfm' if tfm else 'table')
+
+
+    def delete(self, slice_names, t_name, stacks, channels):
+        """
+        Delete transforms in bulk, the table is rewritten once if any of
+        them is in it
+
+        Parameters:
+            slice_names: slice name, or one per transform
+            t_name:      transform name (e.g. raw_to_brain), or one per transform
+            stacks:      stack index, or one per transform
+            channels:    channel index, or one per transform
+
+        Returns:
+            number of transforms deleted
+        """
+        n = max(numpy.size(c) for c in (slice_names, t_name, stacks, channels))
+        keys = zip(*(numpy.broadcast_to(numpy.asarray(c), (n,)).tolist()
+                     for c in (slice_names, t_name, stacks, channels)))
+        with storage_lock(self.storage, self.key, AFFINES):
+            self._read()
+            rows = {r for r in (self.row(*k) for k in keys) if r is not None}
+            if rows:
+                keep = numpy.ones(len(self), dtype=bool)
+                keep[list(rows)] = False
+                self._write(keep, _columns([], [], [], [], numpy.zeros((0, 12)), numpy.zeros((0, 3))))
+        return len(rows)
+
+
+    def _write(self, keep:numpy.ndarray, new:dict):
+        """
+        Private method to rewrite the table with the kept rows and new
+        columns appended, the caller must hold the table lock
+        """
+        old = {'slice': self.slices, 'name': self.names, 'stack': self.stacks,
+               'channel': self.channels, 'params': self.params, 'fixed': self.fixed}
+        columns = {k: numpy.concatenate([old[k][keep], new[k]]) for k in old}
+        buf = io.BytesIO()
+        numpy.savez(buf, **columns)
+        self.storage.put(f'{self.key}/{AFFINES}', buf.getvalue())
+        self._set(columns)
+        self.exists = True
+
+
+    def _update_meta(self, slice_name:str, t_names:list, t_format:str):
+        """
+        Private method to add transforms to transforms.json of a slice
+        """
+        key = f'{self.key}/{slice_name}'
+        create = not self.storage.is_file(f'{key}/transforms.json')
+        xfm = Transform(self.storage, self.key.split('/')[1], slice_name, create=create)
+        meta = self.storage.read_json(f'{key}/transforms.json')
+        trans = meta if isinstance(meta, list) else []
+        missing = [n for n in t_names if n not in [t['name'] for t in trans]]
+        if missing:
+            xfm.update_meta(trans=trans + [{'name': n, 'type': 'affine', 'format': t_format}
+                                           for n in missing])
+
+
+    def pack(self, max_workers:int=None):
+        """
+        Convert the affine .tfm files of the recon version into the table,
+        read concurrently and parsed without SimpleITK. The files are kept,
+        transforms already in the table are replaced.
+
+        Parameters:
+            max_workers: number of concurrent reads
+
+        Returns:
+            number of transforms packed
+        """
+        pattern = re.compile(r'([^/]+)/([^/]+)/(\d+)/(\d+)/affine\.tfm')
+        found = [m for m in (pattern.fullmatch(k.removeprefix(f'{self.key}/'))
+                             for k in self.storage.list(self.key)) if m]
+        if not found:
+            return 0
+        texts = self.storage.get_many([f'{self.key}/{m.group(0)}' for m in found], max_workers)
+        params, fixed = zip(*(_parse_tfm(t.decode(), m.group(0)) for t, m in zip(texts, found)))
+        self.save([m.group(1) for m in found], [m.group(2) for m in found],
+                  [int(m.group(3)) for m in found], [int(m.group(4)) for m in found],
+                  numpy.array(params), numpy.array(fixed), overwrite=True, update_meta=False)
+        return len(found)
+
+
+def _columns(slices, names, stacks, channels, params, fixed):
+    """
+    Private function to build table columns with their dtypes
+    """
+    return {
+        'slice':   numpy.asarray(slices, dtype=str),
+        'name':    numpy.asarray(names, dtype=str),
+        'stack':   numpy.asarray(stacks, dtype=numpy.int32),
+        'channel': numpy.asarray(channels, dtype=numpy.int32),
+        'params':  numpy.asarray(params, dtype=numpy.float64).reshape(-1, 12),
+        'fixed':   numpy.asarray(fixed, dtype=numpy.float64).reshape(-1, 3),
+    }
+
+
+def _tfm(params:numpy.ndarray, fixed:numpy.ndarray):
+    """
+    Private function to format an affine transform as a .tfm file
+    """
+    return (_TFM_HEADER +
+            f"Parameters: {' '.join(repr(float(v)) for v in params)}\n"
+            f"FixedParameters: {' '.join(repr(float(v)) for v in fixed)}\n").encode()
+
+
+def _parse_tfm(text:str, name:str):
+    """
+    Private function to parse the parameters of a 3-d affine .tfm file
+
+    Returns:
+        (12 parameters, 3 fixed parameters)
+    """
+    fields = dict(line.split(':', 1) for line in text.splitlines() if ':' in line)
+    if fields.get('Transform', '').strip() != 'AffineTransform_double_3_3':
+        raise ValueError(f"Transform {name} is {fields.get('Transform', '').strip()}, "
+                         f"not AffineTransform_double_3_3.")
+    params = numpy.array(fields['Parameters'].split(), dtype=numpy.float64)
+    fixed = numpy.array(fields['FixedParameters'].split(), dtype=numpy.float64)
+    return params, fixed
@@ -0,0 +1,315 @@
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+import itertools
+import json
+import math
+import os
+import shutil
+import tempfile
+import time
+import numpy
+import zarr
+from zarr.codecs import BloscCodec
+from .memory import budget
+from .shard import shard_grid, shard_region
+
+# Candidate Blosc codecs, typesize follows the array dtype
+CODECS = [
+    {'cname': 'zstd',  'clevel': 1, 'shuffle': 'shuffle'},
+    {'cname': 'zstd',  'clevel': 3, 'shuffle': 'shuffle'},
+    {'cname': 'zstd',  'clevel': 5, 'shuffle': 'shuffle'},
+    {'cname': 'zstd',  'clevel': 5, 'shuffle': 'bitshuffle'},
+    {'cname': 'zstd',  'clevel': 9, 'shuffle': 'shuffle'},
+    {'cname': 'lz4',   'clevel': 5, 'shuffle': 'shuffle'},
+    {'cname': 'lz4',   'clevel': 5, 'shuffle': 'bitshuffle'},
+    {'cname': 'lz4hc', 'clevel': 5, 'shuffle': 'shuffle'},
+]
+
+# Candidate (z,y,x) chunk and shard shapes, clipped to the sample shape
+LAYOUTS = [
+    ((16, 128, 128), (64, 256, 256)),
+    ((16, 256, 256), (64, 256, 256)),
+    ((32, 64, 64),   (64, 256, 256)),
+    ((64, 64, 64),   (64, 256, 256)),
+    ((8, 256, 256),  (32, 256, 256)),
+    ((16, 128, 128), (32, 128, 128)),
+]
+
+ACCESS = ('sequential', 'random', 'mixed')
+
+
+def tune(image, resolution:str='0', n_samples:int=4, sample_shape:tuple=(64, 256, 256),
+         codecs:list=None, layouts:list=None, bandwidth_mbps:float=500.0,
+         access:str='mixed', n_rois:int=32, roi_shape:tuple=(16, 64, 64),
+         seed:int=0, work_dir:str|Path=None):
+    """
+    Measure codecs and chunk/shard layouts on blocks sampled from an
+    image and recommend a configuration for writing similar data
+
+    Sampled (z,y,x) blocks are written to a temporary directory and read
+    back through the zarrs pipeline. Codecs are compared on compression
+    ratio, encode and decode MB/s, and ranked by effective read MB/s from
+    storage of bandwidth_mbps, 1 / (1 / (ratio * bandwidth) + 1 / decode).
+    Layouts are compared with the best codec on sequential shard-by-shard
+    reads and on latency of random ROI reads.
+
+    Parameters:
+        image:          visor.Image to sample
+        resolution:     resolution level, see vsr.images()
+        n_samples:      number of sampled blocks
+        sample_shape:   (z,y,x) shape of sampled blocks
+        codecs:         candidate Blosc configurations, default CODECS
+        layouts:        candidate ((z,y,x) chunk, (z,y,x) shard), default LAYOUTS
+        bandwidth_mbps: storage bandwidth in MB/s, lower favours ratio
+        access:         rank layouts for 'sequential', 'random' or 'mixed' access
+        n_rois:         number of random ROI reads per layout
+        roi_shape:      (z,y,x) shape of random ROIs
+        seed:           random seed of samples and ROIs
+        work_dir:       directory for temporary arrays, on the filesystem
+                        to tune for, default system temporary directory
+
+    Returns:
+        dict with 'codecs' and 'layouts' measurements, best first,
+        'recommended' as JSON, and 'config' of shard_size, chunk_size and
+        compressors for the image shape, to pass to Image.save, import_image
+        or rechunk
+    """
+    if access not in ACCESS:
+        raise ValueError(f'Invalid access {access}. Must be one of {ACCESS}')
+    arr = image.load(resolution)
+    if arr.ndim != 5:
+        raise ValueError(f'Tuning requires a 5-dimensional array, got {arr.ndim}.')
+    rng = numpy.random.default_rng(seed)
+    sample_shape = tuple(min(s, n) for s, n in zip(sample_shape, arr.shape[2:]))
+    samples = _samples(arr, n_samples, sample_shape, rng)
+    layouts = _layouts(layouts or LAYOUTS, sample_shape)
+    if not layouts:
+        raise ValueError(f'No layout fits in sample shape {sample_shape}.')
+
+    tmp = Path(tempfile.mkdtemp(dir=work_dir))
+    try:
+        results = []
+        for cfg in codecs or CODECS:
+            r = _measure_codec(tmp, samples, cfg, layouts[0][0])
+            r['read_mbps'] = 1 / (1 / (r['ratio'] * bandwidth_mbps) + 1 / r['decode_mbps'])
+            results.append(r)
+        results.sort(key=lambda r: -r['read_mbps'])
+        best = results[0]['codec']
+
+        measured = [_measure_layout(tmp, samples, best, chunk, shard, n_rois,
+                                    tuple(min(r, s) for r, s in zip(roi_shape, sample_shape)), rng)
+                    for chunk, shard in layouts]
+        seq = max(min(m['seq_seconds'] for m in measured), 1e-9)
+        roi = max(min(m['roi_ms_median'] for m in measured), 1e-9)
+        for m in measured:
+            m['score'] = {'sequential': m['seq_seconds'] / seq,
+                          'random':     m['roi_ms_median'] / roi,
+                          'mixed':      m['seq_seconds'] / seq + m['roi_ms_median'] / roi}[access]
+        measured.sort(key=lambda m: m['score'])
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+
+    recommended = {
+        'compressors': best,
+        'chunk_size':  list(measured[0]['chunk']),
+        'shard_size':  list(measured[0]['shard']),
+    }
+    return {
+        'samples':     {'n': len(samples), 'shape': sample_shape, 'dtype': str(arr.dtype)},
+        'codecs':      results,
+        'layouts':     measured,
+        'recommended': recommended,
+        'config':      make_config(recommended, arr.shape),
+    }
+
+
+def make_config(recommended:dict, shape:tuple):
+    """
+    Build writer arguments from a recommendation
+
+    Parameters:
+        recommended: dict of 'compressors' Blosc configuration and (z,y,x)
+                     'chunk_size' and 'shard_size', e.g. from tune() or
+                     load_config()
+        shape:       (vs,ch,z,y,x) shape of the array to write, chunk and
+                     shard shapes are clipped to it
+
+    Returns:
+        dict of shard_size, chunk_size and compressors, to pass to
+        Image.save(arr, resolution, dtype, shape, **config)
+    """
+    chunk = tuple(min(c, max(n, 1)) for c, n in zip(recommended['chunk_size'], shape[2:]))
+    shard = tuple(min(s, math.ceil(max(n, 1) / c) * c)
+                  for s, c, n in zip(recommended['shard_size'], chunk, shape[2:]))
+    return {
+        'shard_size':  (1, 1) + shard,
+        'chunk_size':  (1, 1) + chunk,
+        'compressors': BloscCodec(**recommended['compressors']),
+    }
+
+
+def save_config(path:str|Path, recommended:dict):
+    """
+    Save a recommendation as JSON, e.g. result['recommended'] of tune()
+    """
+    with open(path, 'w') as f:
+        json.dump(recommended, f, indent=2)
+
+
+def load_config(path:str|Path, shape:tuple):
+    """
+    Load a recommendation saved with save_config
+
+    Returns:
+        dict of writer arguments, see make_config
+    """
+    with open(path) as f:
+        return make_config(json.load(f), shape)
+
+
+def rechunk(image, resolution:str, out, shard_size:tuple, chunk_size:tuple,
+            compressors:BloscCodec, out_resolution:str=None, max_workers:int=None):
+    """
+    Copy an array into another image with a new layout and codec, shard
+    by shard of the output, so concurrent writes never share a shard
+
+    Parameters:
+        image:          visor.Image to read
+        resolution:     resolution level to read
+        out:            visor.Image to write, the array must not exist
+        shard_size:     zarr array shard_size
+        chunk_size:     zarr array chunk_size
+        compressors:    zarr array compressors
+        out_resolution: resolution level to write, default resolution
+        max_workers:    number of threads
+
+    Returns:
+        zarr.Array written
+    """
+    src = image.load(resolution)
+    out_resolution = str(resolution if out_resolution is None else out_resolution)
+    dst = out.save(None, out_resolution, dtype=str(src.dtype), shape=src.shape,
+                   shard_size=shard_size, chunk_size=chunk_size, compressors=compressors)
+
+    def copy(index):
+        region = shard_region(dst, index)
+        with budget.reserve(math.prod(r.stop - r.start for r in region) * src.dtype.itemsize):
+            out.write(src[region], out_resolution, region=region)
+
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        list(pool.map(copy, itertools.product(*map(range, shard_grid(dst)))))
+    return out.load(out_resolution)
+
+
+def _samples(arr, n_samples:int, shape:tuple, rng:numpy.random.Generator):
+    """
+    Private function to read random (z,y,x) blocks of random stacks and
+    channels
+    """
+    samples = []
+    for _ in range(n_samples):
+        st, ch = (int(rng.integers(n)) for n in arr.shape[:2])
+        origin = [int(rng.integers(n - s + 1)) for n, s in zip(arr.shape[2:], shape)]
+        region = (st, ch) + tuple(slice(o, o + s) for o, s in zip(origin, shape))
+        samples.append(arr[region])
+    return samples
+
+
+def _layouts(layouts:list, sample_shape:tuple):
+    """
+    Private function to clip candidate layouts to the sample shape, with
+    shards kept a multiple of chunks
+    """
+    out = []
+    for chunk, shard in layouts:
+        chunk = tuple(min(c, n) for c, n in zip(chunk, sample_shape))
+        shard = tuple(max(c, min(s, n) // c * c) for c, s, n in zip(chunk, shard, sample_shape))
+        if (chunk, shard) not in out:
+            out.append((chunk, shard))
+    return out
+
+
+def _nbytes(path:Path):
+    return sum(os.path.getsize(os.path.join(d, f)) for d, _, fs in os.walk(path) for f in fs
+               if f != 'zarr.json')
+
+
+def _create(path:Path, sample:numpy.ndarray, codec:dict, chunk:tuple, shard:tuple=None):
+    return zarr.create_array(
+        store=str(path),
+        dtype=sample.dtype,
+        shape=sample.shape,
+        chunks=chunk,
+        shards=shard,
+        compressors=BloscCodec(typesize=sample.dtype.itemsize, **codec),
+        overwrite=True,
+    )
+
+
+def _measure_codec(tmp:Path, samples:list, codec:dict, chunk:tuple):
+    """
+    Private function to measure compression ratio, encode and decode
+    speed of a codec on samples
+    """
+    raw, stored, t_enc, t_dec = 0, 0, 0.0, 0.0
+    for i, sample in enumerate(samples):
+        path = tmp/'codec'/str(i)
+        z = _create(path, sample, codec, chunk)
+        t0 = time.perf_counter()
+        z[...] = sample
+        t1 = time.perf_counter()
+        z[...]
+        t2 = time.perf_counter()
+        raw += sample.nbytes
+        stored += _nbytes(path)
+        t_enc += t1 - t0
+        t_dec += t2 - t1
+        shutil.rmtree(path)
+    return {
+        'codec':       dict(codec),
+        'ratio':       raw / max(stored, 1),
+        'encode_mbps': raw / 1e6 / max(t_enc, 1e-9),
+        'decode_mbps': raw / 1e6 / max(t_dec, 1e-9),
+    }
+
+
+def _measure_layout(tmp:Path, samples:list, codec:dict, chunk:tuple, shard:tuple,
+                    n_rois:int, roi_shape:tuple, rng:numpy.random.Generator):
+    """
+    Private function to measure sequential and random ROI reads of a
+    chunk and shard layout on samples
+    """
+    arrays = []
+    raw, stored = 0, 0
+    for i, sample in enumerate(samples):
+        path = tmp/'layout'/str(i)
+        z = _create(path, sample, codec, chunk, shard)
+        z[...] = sample
+        arrays.append(zarr.open_array(str(path), mode='r'))
+        raw += sample.nbytes
+        stored += _nbytes(path)
+
+    t0 = time.perf_counter()
+    for z in arrays:
+        for index in itertools.product(*map(range, shard_grid(z))):
+            z[shard_region(z, index)]
+    seq = time.perf_counter() - t0
+
+    latencies = []
+    for _ in range(n_rois):
+        z = arrays[int(rng.integers(len(arrays)))]
+        origin = [int(rng.integers(n - s + 1)) for n, s in zip(z.shape, roi_shape)]
+        region = tuple(slice(o, o + s) for o, s in zip(origin, roi_shape))
+        t0 = time.perf_counter()
+        z[region]
+        latencies.append((time.perf_counter() - t0) * 1000)
+    shutil.rmtree(tmp/'layout')
+    return {
+        'chunk':         chunk,
+        'shard':         shard,
+        'ratio':         raw / max(stored, 1),
+        'seq_seconds':   seq,
+        'seq_mbps':      raw / 1e6 / max(seq, 1e-9),
+        'roi_ms_median': float(numpy.median(latencies)) if latencies else 0.0,
+        'roi_ms_p95':    float(numpy.percentile(latencies, 95)) if latencies else 0.0,
+    }
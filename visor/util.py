@@ -0,0 +1,46 @@
+import numpy
+
+
+def level_scale(img, resolution:str):
+    """
+    Get the (z,y,x) scale of a resolution level relative to level 0,
+    from ome multiscales datasets
+
+    Parameters:
+        img:        visor.Image
+        resolution: resolution level
+
+    Returns:
+        numpy.ndarray
+    """
+    datasets = img.attrs['ome']['multiscales'][0]['datasets']
+    scales = {d['path']: d['coordinateTransformations'][0]['scale'] for d in datasets}
+    level = numpy.asarray(scales[str(resolution)][2:], dtype=numpy.float64)
+    return level / numpy.asarray(scales[datasets[0]['path']][2:], dtype=numpy.float64)
+
+
+def trilinear(block:numpy.ndarray, local:numpy.ndarray, frac:numpy.ndarray):
+    """
+    Trilinear interpolation in a (ch,z,y,x) block
+
+    Parameters:
+        block: (ch, z, y, x) block
+        local: (n, 3) integer base coordinates in the block
+        frac:  (n, 3) fractional offsets from base
+
+    Returns:
+        numpy.ndarray (ch, n) float32
+    """
+    hi = numpy.minimum(local + 1, numpy.array(block.shape[1:]) - 1)
+    values = numpy.zeros((block.shape[0], len(local)), dtype=numpy.float32)
+    for dz in (0, 1):
+        z = hi[:, 0] if dz else local[:, 0]
+        wz = frac[:, 0] if dz else 1 - frac[:, 0]
+        for dy in (0, 1):
+            y = hi[:, 1] if dy else local[:, 1]
+            wy = frac[:, 1] if dy else 1 - frac[:, 1]
+            for dx in (0, 1):
+                x = hi[:, 2] if dx else local[:, 2]
+                wx = frac[:, 2] if dx else 1 - frac[:, 2]
+                values += (wz * wy * wx).astype(numpy.float32) * block[:, z, y, x]
+    return values
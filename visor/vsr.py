@@ -1,62 +1,78 @@
 from pathlib import Path
-import json
+import copy
 import zarr
 import zarrs
 zarr.config.set({"codec_pipeline.path": "zarrs.ZarrsCodecPipeline"})
+from .checksum import verify_image
+from .brain import BrainVolume
+from .storage import Storage, open_storage
+from .consolidate import consolidate_vsr, load_vsr
+from .preview import MAX_SIZE, load_previews, update_previews
 
 class VSR:
 
-    def __init__(self, vsr_path:str | Path, create=False):
+    def __init__(self, vsr_path:str|Path|Storage, create=False):
         """
         Constructor of VSR
 
         Parameters:
-            vsr_path: path to the .vsr file
+            vsr_path: path or url to the .vsr file, or its Storage,
+                      see visor.storage.open_storage
             create:   boolean
         """
-        vsr_path = Path(vsr_path)
-        if vsr_path.suffix != '.vsr':
-            raise ValueError(f'The path {vsr_path} does not have .vsr extension.')
+        storage = open_storage(vsr_path)
+        if not storage.name.endswith('.vsr'):
+            raise ValueError(f'The path {storage.path()} does not have .vsr extension.')
 
         if create:
-            self._create_vsr(vsr_path)
-        if not vsr_path.exists() or not vsr_path.is_dir():
-            raise NotADirectoryError(f'The path {vsr_path} is not a directory.')
+            self._create_vsr(storage)
+        if not storage.is_dir():
+            raise NotADirectoryError(f'The path {storage.path()} is not a directory.')
 
-        self.path = vsr_path
-        self.image_types = [d.name.split('_')[1] for d in self.path.glob('visor_*_images')]
-        self.recon_versions = []
-        if (self.path/'visor_recon_transforms').is_dir():
-            self.recon_versions = \
-                [i.name for i in (self.path/'visor_recon_transforms').iterdir() if i.is_dir()]
+        self.storage = storage
+        self.path = storage.path()
+        self.refresh()
 
 
-    def _create_vsr(self, vsr_path:Path):
+    def refresh(self):
+        """
+        Reload the consolidated metadata document and the listings of the
+        VSR. The document is read once per VSR, refresh after changing
+        images or transforms, e.g. with Image.save or Transform.update_meta.
+        """
+        # consolidated metadata answers listings with a single read
+        self._meta = load_vsr(self.storage)
+        if self._meta is not None:
+            self.image_types = list(self._meta['images'])
+            self.recon_versions = list(self._meta['recon_versions'])
+        else:
+            self.image_types = [d.split('_')[1] for d in self.storage.scan_dirs('', 'visor_', '_images')]
+            self.recon_versions = self.storage.scan_dirs('visor_recon_transforms')
+
+
+    def _create_vsr(self, storage:Storage):
         """
         Create a .vsr directory
 
         Parameters:
-            vsr_path : path to the .vsr file
+            storage : storage of the .vsr file
         """
         # Validate vsr path
-        if vsr_path.suffix != '.vsr':
-            raise ValueError(f'The path {vsr_path} is not valid, must contain .vsr extension.')
+        if not storage.name.endswith('.vsr'):
+            raise ValueError(f'The path {storage.path()} is not valid, must contain .vsr extension.')
         
         # Create vsr directory
-        try:
-            vsr_path.mkdir()
-        except FileExistsError:
-            raise FileExistsError(f'VSR {vsr_path} already exists.')
+        if storage.exists(''):
+            raise FileExistsError(f'VSR {storage.path()} already exists.')
+        storage.mkdir('')
 
         # Create an empty info.json file with comment
-        with open(vsr_path/'info.json', 'w') as info_json:
-            info_json.write('{\n  "_comment": "see https://visor-tech.github.io/visor-data-schema/"\n}')
+        comment = b'{\n  "_comment": "see https://visor-tech.github.io/visor-data-schema/"\n}'
+        storage.put('info.json', comment)
         
         # Create visor_raw_images directory
-        raw_image_path = vsr_path/'visor_raw_images'
-        raw_image_path.mkdir()
-        with open(raw_image_path/'selected.json', 'w') as selected_json:
-            selected_json.write('{\n  "_comment": "see https://visor-tech.github.io/visor-data-schema/"\n}')
+        storage.mkdir('visor_raw_images')
+        storage.put('visor_raw_images/selected.json', comment)
 
 
     def info(self):
@@ -69,11 +85,12 @@ class VSR:
         Returns:
             JSON like object
         """
-        info_file = self.path/'info.json'
-        if not info_file.exists():
+        if self._meta is not None:
+            info = copy.deepcopy(self._meta['info'])
+        elif not self.storage.is_file('info.json'):
             raise FileNotFoundError(f'Metadata file info.json is not found in {self.path}.')
-        with open(info_file) as f:
-            info = json.load(f)
+        else:
+            info = self.storage.read_json('info.json')
 
         info['image_types'] = self.image_types
         info['recon_versions'] = self.recon_versions
@@ -88,22 +105,24 @@ class VSR:
         Returns:
             Collection of image descriptions
         """
-        images = {}
-        for t in self.image_types:
-
-            dir = self.path/f'visor_{t}_images'
+        types = [t for t in self.image_types if image_type in (None, t)]
+        if self._meta is not None:
+            return self._images_consolidated(self._meta, types, image_type)
 
+        # List image directories, then read all zarr.json files in one batch
+        images = {}
+        for t in types:
+            dir = f'visor_{t}_images'
             if 'raw' == t:
-                with open(dir/'selected.json') as sf:
-                    images['raw'] = json.load(sf)
-                for i in images['raw']:
-                    i['resolutions'] = self._resolutions(dir/f"{i['name']}.zarr"/'zarr.json')
+                images['raw'] = self.storage.read_json(f'{dir}/selected.json')
             else:
-                images[t] = [{
-                    'name': d.name.replace('.zarr',''),
-                    'channels': self._channels(dir/d/'zarr.json'),
-                    'resolutions': self._resolutions(dir/d/'zarr.json')
-                } for d in dir.iterdir() if d.suffix == '.zarr']
+                images[t] = [{'name': d.replace('.zarr','')}
+                             for d in self.storage.scan_dirs(dir, suffix='.zarr')]
+
+        entries = [(t, i) for t in types for i in images[t]]
+        metas = self.storage.read_jsons([f"visor_{t}_images/{i['name']}.zarr/zarr.json"
+                                         for t, i in entries])
+        self._describe(entries, metas)
 
         if image_type:
             images = images[image_type]
@@ -111,39 +130,59 @@ class VSR:
         return images
 
 
+    def _images_consolidated(self, consolidated:dict, types:list, image_type:str):
+        """
+        Private method to collect images from consolidated metadata
+        """
+        images = {}
+        for t in types:
+            groups = consolidated['images'][t]['groups']
+            if 'raw' == t:
+                images['raw'] = copy.deepcopy(consolidated['images'][t]['selected'])
+            else:
+                images[t] = [{'name': n} for n in groups]
+        entries = [(t, i) for t in types for i in images[t]]
+        self._describe(entries, [consolidated['images'][t]['groups'][i['name']]
+                                 for t, i in entries])
+        return images[image_type] if image_type else images
+
+
+    def _describe(self, entries:list, metas:list):
+        """
+        Private method to add channels and resolutions to image entries
+        """
+        for (t, i), meta in zip(entries, metas):
+            if 'raw' != t:
+                i['channels'] = self._channels(meta)
+            i['resolutions'] = self._resolutions(meta)
+
+
     @staticmethod
-    def _channels(meta_file):
+    def _channels(meta):
         """
-        Private method to get channel list from metadata file
+        Private method to get channel list from metadata
 
         Parameters:
-            meta_file : path to the metadata file
+            meta : content of the zarr.json metadata file
 
         Returns:
             List of channel wavelengths
         """
-
-        with open(meta_file) as mf:
-            meta = json.load(mf)
         return [c['wavelength'] for c in meta['attributes']['visor']['channels']]
 
 
     @staticmethod
-    def _resolutions(meta_file):
+    def _resolutions(meta):
         """
-        Private method to get resolutions list from metadata file
+        Private method to get resolutions list from metadata
 
         Parameters:
-            meta_file : path to the metadata file
+            meta : content of the zarr.json metadata file
 
         Returns:
             List of resolutions
         """
-
         resolutions = {}
-
-        with open(meta_file) as mf:
-            meta = json.load(mf)
         for r in meta['attributes']['ome']['multiscales'][0]['datasets']:
             resolutions[r['path']] = r['coordinateTransformations'][0]['scale']
 
@@ -159,16 +198,113 @@ class VSR:
         """
         transforms = {}
 
-        dir = self.path/f'visor_recon_transforms'
-        for v in self.recon_versions:
-            with open(dir/v/'recon.json') as rf:
-                recon_info = json.load(rf)
+        # versions without a recon.json yet have no spaces nor slices
+        if self._meta is not None:
+            recon_infos = [copy.deepcopy(self._meta['recon_versions'][v].get('recon') or {})
+                           for v in self.recon_versions]
+        else:
+            keys = [f'visor_recon_transforms/{v}/recon.json' for v in self.recon_versions]
+            found = [k for k in keys if self.storage.is_file(k)]
+            metas = dict(zip(found, self.storage.read_jsons(found)))
+            recon_infos = [metas.get(k, {}) for k in keys]
+        for v, recon_info in zip(self.recon_versions, recon_infos):
             transforms[v] = {
-                "spaces": recon_info['spaces'],
-                "slices": recon_info['slices']
+                "spaces": recon_info.get('spaces', []),
+                "slices": recon_info.get('slices', [])
             }
 
         if recon_version:
             transforms = transforms[recon_version]
 
         return transforms
+
+
+    def consolidate(self, images:bool=True):
+        """
+        Write consolidated metadata of the VSR into consolidated.json, so
+        opening and listing it costs a single read. It is kept in sync by
+        Image.save, Image.update_attrs and Transform.update_meta, run it
+        again after changing files by other means.
+
+        Parameters:
+            images: also consolidate the arrays of every image group
+        """
+        consolidate_vsr(self.storage, images=images)
+        self.refresh()
+
+
+    def previews(self, image_types:list=None, update:bool=True,
+                 max_size:int=MAX_SIZE, max_workers:int=None):
+        """
+        Get quick-look previews of all images, z maximum intensity
+        projections of every stack and channel at a coarse level, kept
+        together in previews.npz of the .vsr so an overview of the whole
+        sample loads in a single read
+
+        Parameters:
+            image_types: image types, default all
+            update:      make previews of new or changed images first,
+                         in parallel, and rewrite previews.npz if needed
+            max_size:    maximum edge in pixels of a thumbnail
+            max_workers: number of threads to make previews
+
+        Returns:
+            Collection of previews by image type and image name, each a
+            dict with 'mip' numpy.ndarray (vs,ch,y,x), 'resolution',
+            'factor', 'scale', 'stacks', 'channels' and 'fingerprint',
+            see visor.preview.make_preview
+        """
+        if update:
+            previews = update_previews(self.storage, image_types, max_size, max_workers)
+        else:
+            previews = load_previews(self.storage)
+        out = {}
+        for k, p in previews.items():
+            t, name = k.split('/')
+            if image_types is None or t in image_types:
+                out.setdefault(t, {})[name] = p
+        return out
+
+
+    def verify(self, incremental:bool=False, processes:bool=False):
+        """
+        Verify shard files of all images against their recorded checksums
+
+        Parameters:
+            incremental: only re-hash shards changed since last verification
+            processes:   hash on a process pool instead of a thread pool
+
+        Returns:
+            Collection of reports by image type and image name,
+            see Image.verify()
+        """
+        path = self.storage.local_path()
+        if path is None:
+            raise self.storage.local_only_error('Verifying')
+        reports = {}
+        for t in self.image_types:
+            dir = f'visor_{t}_images'
+            reports[t] = {d.replace('.zarr',''): verify_image(path/dir/d, incremental, processes)
+                          for d in self.storage.scan_dirs(dir, suffix='.zarr')}
+        return reports
+
+
+    def brain_volume(self, recon_version:str, channel:str, resolution:str,
+                     space:str='brain', voxel_size:tuple=None, interp:str='nearest'):
+        """
+        Get a lazy array of the reconstructed sample, assembled on request
+        from all slices and stacks with affine raw_to_{space} transforms
+
+        Parameters:
+            recon_version: reconstruction version, see info()['recon_versions']
+            channel:       channel label (wavelength)
+            resolution:    resolution level of raw images to read
+            space:         target space
+            voxel_size:    (z,y,x) output voxel size in micrometer
+            interp:        'nearest' or 'linear'
+
+        Returns:
+            visor.brain.BrainVolume, slice it like a (z,y,x) numpy array
+        """
+        return BrainVolume(self, recon_version, channel, resolution, space=space,
+                           voxel_size=voxel_size, interp=interp)